@@ -1,8 +1,8 @@
 import asyncio
 from concurrent.futures import ThreadPoolExecutor
-import httpx
 from typing import List, Dict
-from app.core.config import OLLAMA_SERVER_URL, CUSTOM_MODEL_NAME
+from app.core.config import CUSTOM_MODEL_NAME
+from app.core.llm_client import llm_client
 
 class AIBatchProcessor:
     """
@@ -12,7 +12,6 @@ class AIBatchProcessor:
     def __init__(self):
         self.executor = ThreadPoolExecutor(max_workers=4)
         self.batch_size = 5
-        self.timeout = 120.0
     
     async def batch_ai_calls(self, prompts: List[str], model: str = CUSTOM_MODEL_NAME) -> List[Dict]:
         """
@@ -25,26 +24,21 @@ class AIBatchProcessor:
         batches = [prompts[i:i+self.batch_size] for i in range(0, len(prompts), self.batch_size)]
         results = []
         
-        async with httpx.AsyncClient(timeout=self.timeout) as client:
-            for batch in batches:
-                # Process batch in parallel
-                batch_results = await asyncio.gather(*[
-                    self._call_ai(client, prompt, model) 
-                    for prompt in batch
-                ])
-                results.extend(batch_results)
+        for batch in batches:
+            # Process batch in parallel
+            batch_results = await asyncio.gather(*[
+                self._call_ai(prompt, model) 
+                for prompt in batch
+            ])
+            results.extend(batch_results)
         
         return results
     
-    async def _call_ai(self, client, prompt: str, model: str) -> Dict:
+    async def _call_ai(self, prompt: str, model: str) -> Dict:
         """Single AI call with retry logic"""
         for attempt in range(3):
             try:
-                response = await client.post(
-                    OLLAMA_SERVER_URL,
-                    json={"model": model, "prompt": prompt, "stream": False},
-                    timeout=60.0
-                )
+                response = await llm_client.generate(prompt, timeout='short', model=model)
                 if response.status_code == 200:
                     return response.json()
             except Exception as e:
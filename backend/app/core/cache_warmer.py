@@ -5,6 +5,7 @@ import httpx
 from datetime import datetime, timedelta
 from typing import List
 from app.core.config import supabase
+from app.core.llm_scheduler import LLM_PRIORITY_HEADER
 
 class CacheWarmer:
     """
@@ -69,7 +70,7 @@ class CacheWarmer:
         """Internal warming call"""
         try:
             async with httpx.AsyncClient(timeout=30.0) as client:
-                response = await client.get(f"http://localhost:8000{url}")
+                response = await client.get(f"http://localhost:8000{url}", headers={LLM_PRIORITY_HEADER: "warming"})
                 if response.status_code == 200:
                     print(f"  ✅ Warmed: {url}")
                 else:
@@ -0,0 +1,293 @@
+import asyncio
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import AsyncIterator, Dict, Optional, Tuple, Union
+
+import httpx
+
+from app.core.config import OLLAMA_SERVER_URL, CUSTOM_MODEL_NAME
+from app.core.llm_scheduler import llm_scheduler
+from app.core.redis_cache import redis_cache
+
+# --- CONFIGURATION ---
+LLM_MAX_CONNECTIONS = int(os.getenv('LLM_MAX_CONNECTIONS', '32'))
+LLM_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv('LLM_MAX_KEEPALIVE_CONNECTIONS', '16'))
+LLM_KEEPALIVE_EXPIRY_SECONDS = float(os.getenv('LLM_KEEPALIVE_EXPIRY_SECONDS', '60'))
+LLM_CONNECT_TIMEOUT_SECONDS = float(os.getenv('LLM_CONNECT_TIMEOUT_SECONDS', '5'))
+# How long a request may wait for a free pooled connection.
+LLM_POOL_TIMEOUT_SECONDS = float(os.getenv('LLM_POOL_TIMEOUT_SECONDS', '30'))
+# HTTP/2 needs the 'h2' package and only applies to https endpoints (e.g. a TLS proxy in front of Ollama).
+LLM_HTTP2 = os.getenv('LLM_HTTP2', 'false').lower() in ('1', 'true', 'yes')
+# Read timeouts per kind of generation; override with LLM_TIMEOUT_<NAME>_SECONDS.
+LLM_TIMEOUTS = {
+    name: float(os.getenv(f'LLM_TIMEOUT_{name.upper()}_SECONDS', str(seconds)))
+    for name, seconds in {
+        'quick': 30,      # titles, one-line summaries, scores
+        'short': 60,      # single paragraphs
+        'medium': 90,     # short multi-part analyses
+        'standard': 120,  # RAG answers and chat
+        'long': 180,      # reports and multi-section JSON
+    }.items()
+}
+LLM_STATS_SAMPLES = 1000
+# Exact-prompt response cache for calls made with cache=True: identical (model, prompt, options)
+# within the TTL never reach Ollama twice.
+LLM_PROMPT_CACHE_ENABLED = os.getenv('LLM_PROMPT_CACHE_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+LLM_PROMPT_CACHE_TTL_SECONDS = int(os.getenv('LLM_PROMPT_CACHE_TTL_SECONDS', '1800'))
+LLM_PROMPT_CACHE_SIZE = int(os.getenv('LLM_PROMPT_CACHE_SIZE', '2000'))
+LLM_PROMPT_CACHE_KEY_PREFIX = 'llm:prompt:'
+
+
+def prompt_cache_key(model: str, prompt: str, options: Dict) -> str:
+    payload = json.dumps({"model": model, "prompt": prompt, "options": options}, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class PromptCache:
+    """
+    Completed /api/generate bodies by content hash: an in-process LRU in front
+    of Redis, so every worker reuses a completion any of them produced.
+    """
+    def __init__(self, max_size: int = LLM_PROMPT_CACHE_SIZE, ttl: int = LLM_PROMPT_CACHE_TTL_SECONDS):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._memory: "OrderedDict[str, Tuple[float, Dict]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.redis_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def _remember(self, key: str, data: Dict, expires: float):
+        with self._lock:
+            self._memory[key] = (expires, data)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_size:
+                self._memory.popitem(last=False)
+
+    async def get(self, key: str) -> Optional[Dict]:
+        with self._lock:
+            cached = self._memory.get(key)
+            if cached is not None:
+                if cached[0] > time.time():
+                    self._memory.move_to_end(key)
+                    self.memory_hits += 1
+                    return cached[1]
+                del self._memory[key]
+        data = await redis_cache.get(LLM_PROMPT_CACHE_KEY_PREFIX + key)
+        if data is not None:
+            # The Redis copy may be older; expire the local one no later than a fresh TTL.
+            self._remember(key, data, time.time() + self.ttl)
+            with self._lock:
+                self.redis_hits += 1
+            return data
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def note_coalesced(self):
+        with self._lock:
+            self.coalesced += 1
+
+    async def set(self, key: str, data: Dict):
+        self._remember(key, data, time.time() + self.ttl)
+        await redis_cache.set(LLM_PROMPT_CACHE_KEY_PREFIX + key, data, ttl=self.ttl)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            hits = self.memory_hits + self.redis_hits
+            return {
+                "enabled": LLM_PROMPT_CACHE_ENABLED,
+                "entries": len(self._memory),
+                "memory_hits": self.memory_hits,
+                "redis_hits": self.redis_hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                # Coalesced calls missed the cache first, so they are already among the misses.
+                "hit_rate": f"{(hits + self.coalesced) / max(1, hits + self.misses) * 100:.1f}%",
+            }
+
+
+def llm_timeout(timeout: Union[str, float]) -> httpx.Timeout:
+    """Request timeout for a named profile (or a number of seconds) on top of the shared connect/pool limits."""
+    read = LLM_TIMEOUTS[timeout] if isinstance(timeout, str) else float(timeout)
+    return httpx.Timeout(read, connect=LLM_CONNECT_TIMEOUT_SECONDS, pool=LLM_POOL_TIMEOUT_SECONDS)
+
+
+class LLMClient:
+    """
+    Application-scoped HTTP client for the Ollama server. Every route shares one
+    connection pool (keep-alive, bounded connections) instead of opening and
+    tearing down a client per call. httpx pools are bound to an event loop, so
+    background jobs that run their own loop (asyncio.run in scheduler threads)
+    get a pool of their own, which is dropped once that loop has closed.
+    """
+    def __init__(self):
+        self._clients: Dict[asyncio.AbstractEventLoop, httpx.AsyncClient] = {}
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        # Time from sending a streaming request to Ollama's first token.
+        self._first_token_ms = deque(maxlen=LLM_STATS_SAMPLES)
+        self.prompt_cache = PromptCache()
+        # Single flight: the request in progress for each (event loop, prompt key).
+        self._in_flight: Dict[Tuple[asyncio.AbstractEventLoop, str], asyncio.Future] = {}
+
+    def _new_client(self) -> httpx.AsyncClient:
+        limits = httpx.Limits(max_connections=LLM_MAX_CONNECTIONS,
+                              max_keepalive_connections=LLM_MAX_KEEPALIVE_CONNECTIONS,
+                              keepalive_expiry=LLM_KEEPALIVE_EXPIRY_SECONDS)
+        try:
+            return httpx.AsyncClient(limits=limits, timeout=llm_timeout('standard'), http2=LLM_HTTP2)
+        except ImportError as e:
+            print(f"⚠️ HTTP/2 unavailable for the LLM client, using HTTP/1.1: {e}")
+            return httpx.AsyncClient(limits=limits, timeout=llm_timeout('standard'))
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        """The pooled client of the running event loop."""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            for closed in [other for other in self._clients if other.is_closed()]:
+                del self._clients[closed]
+            client = self._clients.get(loop)
+            if client is None or client.is_closed:
+                client = self._clients[loop] = self._new_client()
+            return client
+
+    async def generate(self, prompt: str, timeout: Union[str, float] = 'standard', model: str = CUSTOM_MODEL_NAME,
+                       priority: Optional[str] = None, cache: bool = False, **options) -> httpx.Response:
+        """
+        Non-streaming /api/generate call; extra keyword arguments (e.g. format,
+        options) are added to the request body. Returns the response unchecked,
+        like client.post, so callers keep their own status handling.
+
+        The call waits for a scheduler slot at the given priority (default: the
+        caller's llm_priority) and raises LLMOverloadedError when it is shed.
+
+        With cache=True, a completion of the same (model, prompt, options) within
+        LLM_PROMPT_CACHE_TTL_SECONDS is returned without calling Ollama, and
+        concurrent identical calls share one request. Only opt in where any
+        completion of the prompt is as good as a fresh sample (titles,
+        summaries of the same inputs); calls that expect a different answer
+        each time keep the default.
+        """
+        if not (cache and LLM_PROMPT_CACHE_ENABLED):
+            return await self._generate(prompt, timeout, model, priority, options)
+        key = prompt_cache_key(model, prompt, options)
+        data = await self.prompt_cache.get(key)
+        if data is not None:
+            return self._cached_response(data)
+
+        loop = asyncio.get_running_loop()
+        flight = self._in_flight.get((loop, key))
+        if flight is not None:
+            try:
+                response = await asyncio.shield(flight)
+                self.prompt_cache.note_coalesced()
+                return response
+            except asyncio.CancelledError:
+                if not flight.cancelled():
+                    raise
+                # The leading request was cancelled; make our own.
+                return await self._generate(prompt, timeout, model, priority, options)
+
+        flight = self._in_flight[(loop, key)] = loop.create_future()
+        try:
+            response = await self._generate(prompt, timeout, model, priority, options)
+            if response.status_code == 200:
+                data = response.json()
+                if data.get('response'):
+                    # The token context is only needed to continue a conversation and can be large.
+                    data.pop('context', None)
+                    await self.prompt_cache.set(key, data)
+            flight.set_result(response)
+            return response
+        except asyncio.CancelledError:
+            flight.cancel()
+            raise
+        except BaseException as e:
+            flight.set_exception(e)
+            flight.exception()  # waiters re-raise it; don't log it as unretrieved
+            raise
+        finally:
+            self._in_flight.pop((loop, key), None)
+
+    @staticmethod
+    def _cached_response(data: Dict) -> httpx.Response:
+        return httpx.Response(200, json=data, request=httpx.Request('POST', OLLAMA_SERVER_URL))
+
+    async def _generate(self, prompt: str, timeout: Union[str, float], model: str, priority: Optional[str],
+                        options: Dict) -> httpx.Response:
+        async with llm_scheduler.slot(priority):
+            self.requests += 1
+            try:
+                return await self.client.post(OLLAMA_SERVER_URL, json={"model": model, "prompt": prompt, "stream": False, **options},
+                                              timeout=llm_timeout(timeout))
+            except httpx.HTTPError:
+                self.errors += 1
+                raise
+
+    async def stream(self, prompt: str, timeout: Union[str, float] = 'standard', model: str = CUSTOM_MODEL_NAME,
+                     priority: Optional[str] = None, **options) -> AsyncIterator[str]:
+        """
+        Streaming /api/generate call: yields the completion's text pieces as
+        Ollama produces them. The scheduler slot is held until the stream ends
+        or the consumer stops iterating; status errors raise before the first piece.
+        """
+        async with llm_scheduler.slot(priority):
+            self.requests += 1
+            started = time.perf_counter()
+            first = True
+            try:
+                async with self.client.stream('POST', OLLAMA_SERVER_URL, timeout=llm_timeout(timeout),
+                                              json={"model": model, "prompt": prompt, "stream": True, **options}) as response:
+                    response.raise_for_status()
+                    async for line in response.aiter_lines():
+                        if not line.strip():
+                            continue
+                        data = json.loads(line)
+                        if data.get('error'):
+                            raise RuntimeError(f"Ollama error: {data['error']}")
+                        piece = data.get('response', '')
+                        if piece:
+                            if first:
+                                self._first_token_ms.append((time.perf_counter() - started) * 1000)
+                                first = False
+                            yield piece
+                        if data.get('done'):
+                            break
+            except httpx.HTTPError:
+                self.errors += 1
+                raise
+
+    async def startup(self):
+        """Opens the pool of the application's event loop."""
+        _ = self.client
+        print(f"✅ LLM client ready (pool of {LLM_MAX_CONNECTIONS} connections to {OLLAMA_SERVER_URL})")
+
+    async def shutdown(self):
+        """Closes the pool of the running loop; pools of loops that already closed are discarded."""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            client = self._clients.pop(loop, None)
+            self._clients.clear()
+        if client is not None:
+            await client.aclose()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            pools = len(self._clients)
+        first_token = sorted(self._first_token_ms)
+        return {"pools": pools, "max_connections": LLM_MAX_CONNECTIONS, "requests": self.requests,
+                "errors": self.errors, "http2": LLM_HTTP2, "timeouts": LLM_TIMEOUTS,
+                "first_token_ms_p50": round(first_token[len(first_token) // 2], 1) if first_token else 0.0,
+                "first_token_ms_p95": round(first_token[int(len(first_token) * 0.95)], 1) if first_token else 0.0,
+                "scheduler": llm_scheduler.stats(), "prompt_cache": self.prompt_cache.stats()}
+
+
+llm_client = LLMClient()
@@ -0,0 +1,224 @@
+import asyncio
+import contextvars
+import heapq
+import itertools
+import os
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+from typing import Dict, List, Optional
+
+# --- CONFIGURATION ---
+# Concurrent generations sent to Ollama; match the server's OLLAMA_NUM_PARALLEL.
+LLM_PARALLEL_SLOTS = int(os.getenv('LLM_PARALLEL_SLOTS', os.getenv('OLLAMA_NUM_PARALLEL', '4')))
+# Priority classes, highest first, and their share of the slots when all of them are queued.
+LLM_PRIORITIES = ('interactive', 'on_demand', 'warming')
+LLM_PRIORITY_WEIGHTS = {
+    priority: float(os.getenv(f'LLM_WEIGHT_{priority.upper()}', str(weight)))
+    for priority, weight in zip(LLM_PRIORITIES, (8, 3, 1))
+}
+# Longest a request may wait for a slot before it is shed; override with LLM_QUEUE_SLO_<CLASS>_SECONDS.
+LLM_QUEUE_SLO_SECONDS = {
+    priority: float(os.getenv(f'LLM_QUEUE_SLO_{priority.upper()}_SECONDS', str(seconds)))
+    for priority, seconds in zip(LLM_PRIORITIES, (15, 30, 60))
+}
+LLM_MAX_QUEUE = {
+    priority: int(os.getenv(f'LLM_MAX_QUEUE_{priority.upper()}', str(depth)))
+    for priority, depth in zip(LLM_PRIORITIES, (64, 128, 32))
+}
+LLM_DEFAULT_PRIORITY = 'on_demand'
+# Internal callers (cache warmers) send this header to run their LLM calls at 'warming' priority.
+LLM_PRIORITY_HEADER = 'X-LLM-Priority'
+LLM_SCHEDULER_SAMPLES = 1000
+
+_current_priority = contextvars.ContextVar('llm_priority', default=LLM_DEFAULT_PRIORITY)
+
+
+@contextmanager
+def llm_priority(priority: str):
+    """Runs the LLM calls made inside the block (and tasks it starts) at the given priority."""
+    if priority not in LLM_PRIORITY_WEIGHTS:
+        raise ValueError(f"Unknown LLM priority '{priority}'")
+    token = _current_priority.set(priority)
+    try:
+        yield
+    finally:
+        _current_priority.reset(token)
+
+
+def current_priority() -> str:
+    return _current_priority.get()
+
+
+class LLMOverloadedError(Exception):
+    """The LLM queue is over its SLO; callers should degrade to a fallback or answer 503."""
+    def __init__(self, priority: str, reason: str, retry_after: int):
+        super().__init__(f"AI service is busy ({priority} queue {reason}); please retry in {retry_after}s.")
+        self.priority = priority
+        self.retry_after = retry_after
+
+
+class _Waiter:
+    __slots__ = ('loop', 'future', 'priority', 'finish', 'enqueued', 'granted', 'abandoned')
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, priority: str, finish: float):
+        self.loop = loop
+        self.future = loop.create_future()
+        self.priority = priority
+        self.finish = finish
+        self.enqueued = time.perf_counter()
+        self.granted = False
+        self.abandoned = False
+
+
+def _percentile(samples, fraction: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def _grant(future: asyncio.Future):
+    if not future.done():
+        future.set_result(None)
+
+
+class LLMScheduler:
+    """
+    Global admission control for Ollama. At most LLM_PARALLEL_SLOTS generations
+    run at once; waiting requests are served by weighted fair queuing across
+    the priority classes, so interactive chat overtakes on-demand analyses
+    and cache warming without starving them. A request whose expected or
+    actual queue time exceeds its class SLO is shed with LLMOverloadedError.
+
+    Slots are shared across event loops (scheduler jobs run their own), so
+    state is guarded by a thread lock and waiters are woken on their own loop.
+    """
+    def __init__(self, slots: int = LLM_PARALLEL_SLOTS):
+        self.slots = max(1, slots)
+        self.active = 0
+        self._lock = threading.Lock()
+        self._heap: List = []
+        self._sequence = itertools.count()
+        # Weighted fair queuing: virtual time and the last finish tag of each class.
+        self._virtual_time = 0.0
+        self._last_finish = {priority: 0.0 for priority in LLM_PRIORITIES}
+        self._queued = {priority: 0 for priority in LLM_PRIORITIES}
+        self._served = {priority: 0 for priority in LLM_PRIORITIES}
+        self._shed = {priority: 0 for priority in LLM_PRIORITIES}
+        self._wait_ms = {priority: deque(maxlen=LLM_SCHEDULER_SAMPLES) for priority in LLM_PRIORITIES}
+        # Smoothed time a generation holds its slot, used to predict queue time at admission.
+        self._service_s: Optional[float] = None
+
+    def _estimated_wait(self, priority: str) -> float:
+        """Seconds until a new request of this class would get a slot, under fair sharing."""
+        if self._service_s is None:
+            return 0.0
+        own_weight = LLM_PRIORITY_WEIGHTS[priority]
+        ahead = sum(min(count, (self._queued[priority] + 1) * LLM_PRIORITY_WEIGHTS[other] / own_weight)
+                    for other, count in self._queued.items() if other != priority)
+        return (ahead + self._queued[priority] + 1) * self._service_s / self.slots
+
+    def _shed_locked(self, priority: str, reason: str) -> LLMOverloadedError:
+        self._shed[priority] += 1
+        retry_after = max(1, int(self._estimated_wait(priority)))
+        print(f"⚠️ LLM scheduler shed a {priority} request ({reason}); {self.active} running, queued {self._queued}")
+        return LLMOverloadedError(priority, reason, retry_after)
+
+    async def acquire(self, priority: str) -> float:
+        """Waits for a slot; returns the time it was granted."""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self.active < self.slots:
+                # A free slot means nobody is waiting; only abandoned entries can be left in the heap.
+                self._heap.clear()
+                self.active += 1
+                self._served[priority] += 1
+                self._wait_ms[priority].append(0.0)
+                return time.perf_counter()
+            if self._queued[priority] >= LLM_MAX_QUEUE[priority]:
+                raise self._shed_locked(priority, "full")
+            if self._estimated_wait(priority) > LLM_QUEUE_SLO_SECONDS[priority]:
+                raise self._shed_locked(priority, "over SLO")
+            start = max(self._virtual_time, self._last_finish[priority])
+            finish = start + 1.0 / LLM_PRIORITY_WEIGHTS[priority]
+            self._last_finish[priority] = finish
+            waiter = _Waiter(loop, priority, finish)
+            heapq.heappush(self._heap, (finish, next(self._sequence), waiter))
+            self._queued[priority] += 1
+
+        try:
+            await asyncio.wait_for(waiter.future, timeout=LLM_QUEUE_SLO_SECONDS[priority])
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            with self._lock:
+                if not waiter.granted:
+                    waiter.abandoned = True
+                    self._queued[priority] -= 1
+                    if isinstance(e, asyncio.CancelledError):
+                        raise
+                    raise self._shed_locked(priority, "wait exceeded SLO")
+            # The slot was granted as the wait ended: keep it, unless the caller is gone.
+            if isinstance(e, asyncio.CancelledError):
+                self.release(None)
+                raise
+        granted = time.perf_counter()
+        self._wait_ms[priority].append((granted - waiter.enqueued) * 1000)
+        return granted
+
+    def release(self, granted: Optional[float]):
+        """Frees a slot, handing it straight to the next waiter in fair-queue order."""
+        with self._lock:
+            if granted is not None:
+                held = time.perf_counter() - granted
+                self._service_s = held if self._service_s is None else 0.9 * self._service_s + 0.1 * held
+            while self._heap:
+                finish, _, waiter = heapq.heappop(self._heap)
+                if waiter.abandoned:
+                    continue
+                try:
+                    waiter.loop.call_soon_threadsafe(_grant, waiter.future)
+                except RuntimeError:
+                    # The waiter's event loop has closed.
+                    waiter.abandoned = True
+                    self._queued[waiter.priority] -= 1
+                    continue
+                waiter.granted = True
+                self._queued[waiter.priority] -= 1
+                self._served[waiter.priority] += 1
+                self._virtual_time = finish
+                return
+            self.active -= 1
+
+    @asynccontextmanager
+    async def slot(self, priority: Optional[str] = None):
+        """Holds one generation slot; priority defaults to the caller's llm_priority."""
+        priority = priority or current_priority()
+        granted = await self.acquire(priority)
+        try:
+            yield
+        finally:
+            self.release(granted)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "slots": self.slots,
+                "active": self.active,
+                "service_s": round(self._service_s or 0.0, 2),
+                "classes": {
+                    priority: {
+                        "weight": LLM_PRIORITY_WEIGHTS[priority],
+                        "queue_slo_s": LLM_QUEUE_SLO_SECONDS[priority],
+                        "queued": self._queued[priority],
+                        "served": self._served[priority],
+                        "shed": self._shed[priority],
+                        "wait_ms_p50": round(_percentile(self._wait_ms[priority], 0.5), 1),
+                        "wait_ms_p95": round(_percentile(self._wait_ms[priority], 0.95), 1),
+                    }
+                    for priority in LLM_PRIORITIES
+                },
+            }
+
+
+llm_scheduler = LLMScheduler()
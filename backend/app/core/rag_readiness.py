@@ -0,0 +1,21 @@
+import os
+from fastapi import HTTPException
+from rag_pipeline import rag_system, RAG_READY_TIMEOUT_SECONDS
+
+# Endpoints that work without RAG context only wait briefly for the warm-up.
+OPTIONAL_RAG_WAIT_SECONDS = float(os.getenv('RAG_OPTIONAL_WAIT_SECONDS', '5'))
+
+
+async def require_rag_ready():
+    """Dependency for endpoints that are pure retrieval: waits for the RAG warm-up, else 503."""
+    if not await rag_system.await_ready(RAG_READY_TIMEOUT_SECONDS):
+        raise HTTPException(
+            status_code=503,
+            detail=f"Document search is still loading ({rag_system.load_status['state']}). Please retry shortly.",
+            headers={"Retry-After": "5"}
+        )
+
+
+async def wait_for_rag():
+    """Dependency for endpoints that can answer without RAG context: waits, then proceeds regardless."""
+    await rag_system.await_ready(OPTIONAL_RAG_WAIT_SECONDS)
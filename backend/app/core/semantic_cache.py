@@ -0,0 +1,223 @@
+import base64
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional
+
+import numpy as np
+
+from app.core.redis_cache import redis_cache
+from rag_pipeline import rag_system
+
+# --- CONFIGURATION ---
+SEMANTIC_CACHE_ENABLED = os.getenv('LLM_SEMANTIC_CACHE_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+# Minimum cosine similarity between question embeddings for a cached answer to be reused.
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv('LLM_SEMANTIC_CACHE_THRESHOLD', '0.95'))
+# Share of the new retrieval's chunks that must also have been the cached answer's context (1.0 = same chunks).
+SEMANTIC_CACHE_MIN_CONTEXT_OVERLAP = float(os.getenv('LLM_SEMANTIC_CACHE_MIN_CONTEXT_OVERLAP', '1.0'))
+SEMANTIC_CACHE_TTL_SECONDS = int(os.getenv('LLM_SEMANTIC_CACHE_TTL_SECONDS', '3600'))
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.getenv('LLM_SEMANTIC_CACHE_MAX_ENTRIES', '200'))   # per tenant and kind
+SEMANTIC_CACHE_MAX_NAMESPACES = int(os.getenv('LLM_SEMANTIC_CACHE_MAX_NAMESPACES', '1000'))
+# Entries are shared through Redis; each worker re-reads a namespace at most this often.
+SEMANTIC_CACHE_SYNC_SECONDS = float(os.getenv('LLM_SEMANTIC_CACHE_SYNC_SECONDS', '30'))
+SEMANTIC_CACHE_KEY_PREFIX = 'llm:semantic:'
+
+
+def context_ids(texts: List[str]) -> List[str]:
+    """Content IDs of the retrieved chunks; they change when a document is re-ingested or edited."""
+    return sorted({hashlib.blake2b(text.encode('utf-8'), digest_size=8).hexdigest() for text in texts if text})
+
+
+class _Namespace:
+    """Cached answers of one tenant for one kind of prompt."""
+    __slots__ = ('entries', 'matrix', 'synced')
+
+    def __init__(self):
+        self.entries: List[Dict] = []
+        self.matrix = np.zeros((0, 0), dtype='float32')
+        self.synced = 0.0
+
+    def rebuild(self):
+        if self.entries:
+            # Entries from before an embedding model change cannot be compared; keep the current dimension.
+            dimension = self.entries[-1]['vector'].shape
+            self.entries = [entry for entry in self.entries if entry['vector'].shape == dimension]
+        self.matrix = np.vstack([entry['vector'] for entry in self.entries]) if self.entries else np.zeros((0, 0), dtype='float32')
+
+
+class SemanticCache:
+    """
+    Reuses LLM answers across users. An answer is stored with the embedding of
+    the question and the IDs of the chunks it was grounded on; a later question
+    of the same tenant and kind is answered from the cache when its embedding
+    is within SEMANTIC_CACHE_THRESHOLD and retrieval returned the same context,
+    so a paraphrase hits but a document change or a different data room never does.
+    """
+    def __init__(self):
+        self._namespaces: "OrderedDict[str, _Namespace]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.lookups = 0
+        self.hits = 0
+        self.stores = 0
+        self.llm_seconds_saved = 0.0
+        self._hits_by_kind: Dict[str, int] = {}
+
+    @staticmethod
+    def _key(tenant: str, kind: str) -> str:
+        return f"{SEMANTIC_CACHE_KEY_PREFIX}{kind}:{tenant}"
+
+    async def _embed(self, question: str) -> Optional[np.ndarray]:
+        try:
+            vector = (await rag_system.embedder.encode_async([question]))[0].astype('float32')
+            norm = np.linalg.norm(vector)
+            return vector / norm if norm else None
+        except Exception as e:
+            print(f"⚠️ Semantic cache embedding failed: {e}")
+            return None
+
+    async def _namespace(self, key: str) -> _Namespace:
+        """The local copy of a namespace, re-read from Redis when it is older than the sync interval."""
+        with self._lock:
+            namespace = self._namespaces.get(key)
+            if namespace is not None:
+                self._namespaces.move_to_end(key)
+                if time.time() - namespace.synced < SEMANTIC_CACHE_SYNC_SECONDS:
+                    return namespace
+        raw = None
+        if redis_cache.redis_client:
+            try:
+                raw = await redis_cache.redis_client.lrange(key, 0, -1)
+            except Exception as e:
+                print(f"Redis semantic cache read error: {e}")
+        with self._lock:
+            namespace = self._namespaces.get(key) or _Namespace()
+            if raw is not None:
+                namespace.entries = [entry for entry in (self._decode(item) for item in raw) if entry is not None]
+            now = time.time()
+            namespace.entries = [entry for entry in namespace.entries if now - entry['created'] < SEMANTIC_CACHE_TTL_SECONDS]
+            namespace.entries = namespace.entries[-SEMANTIC_CACHE_MAX_ENTRIES:]
+            namespace.rebuild()
+            namespace.synced = now
+            self._namespaces[key] = namespace
+            self._namespaces.move_to_end(key)
+            while len(self._namespaces) > SEMANTIC_CACHE_MAX_NAMESPACES:
+                self._namespaces.popitem(last=False)
+            return namespace
+
+    @staticmethod
+    def _decode(item: str) -> Optional[Dict]:
+        try:
+            entry = json.loads(item)
+            entry['vector'] = np.frombuffer(base64.b64decode(entry['vector']), dtype='float16').astype('float32')
+            return entry
+        except Exception:
+            return None
+
+    async def lookup(self, tenant: str, kind: str, question: str, context: List[str]) -> Optional[str]:
+        """A cached answer for a similar question over the same retrieved context, else None."""
+        if not SEMANTIC_CACHE_ENABLED:
+            return None
+        vector = await self._embed(question)
+        if vector is None:
+            return None
+        namespace = await self._namespace(self._key(tenant, kind))
+        ids = set(context_ids(context))
+        hit = None
+        with self._lock:
+            self.lookups += 1
+            if namespace.entries and namespace.matrix.shape[1] == vector.shape[0]:
+                similarities = namespace.matrix @ vector
+                for position in np.argsort(-similarities):
+                    if similarities[position] < SEMANTIC_CACHE_THRESHOLD:
+                        break
+                    entry = namespace.entries[position]
+                    if time.time() - entry['created'] >= SEMANTIC_CACHE_TTL_SECONDS:
+                        continue
+                    overlap = len(ids & set(entry['context'])) / len(ids) if ids else float(not entry['context'])
+                    if overlap >= SEMANTIC_CACHE_MIN_CONTEXT_OVERLAP:
+                        hit = entry
+                        break
+            if hit is not None:
+                self.hits += 1
+                self.llm_seconds_saved += hit['seconds']
+                self._hits_by_kind[kind] = self._hits_by_kind.get(kind, 0) + 1
+        if hit is not None:
+            print(f"✅ Semantic cache hit ({kind}, {tenant}): saved {hit['seconds']:.1f}s of generation")
+            return hit['answer']
+        return None
+
+    async def store(self, tenant: str, kind: str, question: str, context: List[str], answer: str, seconds: float):
+        """Records an answer and the time it took to generate."""
+        if not SEMANTIC_CACHE_ENABLED or not answer or not answer.strip():
+            return
+        vector = await self._embed(question)
+        if vector is None:
+            return
+        entry = {'vector': vector, 'context': context_ids(context), 'answer': answer,
+                 'seconds': round(seconds, 3), 'created': time.time()}
+        key = self._key(tenant, kind)
+        namespace = await self._namespace(key)
+        with self._lock:
+            namespace.entries = (namespace.entries + [entry])[-SEMANTIC_CACHE_MAX_ENTRIES:]
+            namespace.rebuild()
+            self.stores += 1
+        if redis_cache.redis_client:
+            try:
+                encoded = json.dumps({**entry, 'vector': base64.b64encode(vector.astype('float16').tobytes()).decode('ascii')})
+                async with redis_cache.redis_client.pipeline(transaction=False) as pipe:
+                    pipe.rpush(key, encoded)
+                    pipe.ltrim(key, -SEMANTIC_CACHE_MAX_ENTRIES, -1)
+                    pipe.expire(key, SEMANTIC_CACHE_TTL_SECONDS)
+                    await pipe.execute()
+            except Exception as e:
+                print(f"Redis semantic cache write error: {e}")
+
+    async def answer(self, tenant: str, kind: str, question: str, context: List[str],
+                     generate: Callable[[], Awaitable[str]]) -> str:
+        """The cached answer if there is one, else generate() timed and stored."""
+        cached = await self.lookup(tenant, kind, question, context)
+        if cached is not None:
+            return cached
+        started = time.perf_counter()
+        answer = await generate()
+        await self.store(tenant, kind, question, context, answer, time.perf_counter() - started)
+        return answer
+
+    async def stream(self, tenant: str, kind: str, question: str, context: List[str],
+                     stream_func: Callable[..., AsyncIterator[str]], *args, **kwargs) -> AsyncIterator[str]:
+        """
+        Streaming counterpart of answer(): replays a cached answer as one piece,
+        else yields stream_func(*args, **kwargs) and stores the answer once the
+        stream has completed.
+        """
+        cached = await self.lookup(tenant, kind, question, context)
+        if cached is not None:
+            yield cached
+            return
+        started = time.perf_counter()
+        pieces = []
+        async for piece in stream_func(*args, **kwargs):
+            pieces.append(piece)
+            yield piece
+        await self.store(tenant, kind, question, context, "".join(pieces).strip(), time.perf_counter() - started)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "enabled": SEMANTIC_CACHE_ENABLED,
+                "threshold": SEMANTIC_CACHE_THRESHOLD,
+                "namespaces": len(self._namespaces),
+                "entries": sum(len(namespace.entries) for namespace in self._namespaces.values()),
+                "lookups": self.lookups,
+                "hits": self.hits,
+                "stores": self.stores,
+                "hit_rate": f"{self.hits / max(1, self.lookups) * 100:.1f}%",
+                "llm_seconds_saved": round(self.llm_seconds_saved, 1),
+                "hits_by_kind": dict(self._hits_by_kind),
+            }
+
+
+semantic_cache = SemanticCache()
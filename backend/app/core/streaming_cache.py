@@ -1,40 +1,84 @@
 from fastapi.responses import StreamingResponse
 import asyncio
 import json
+import time
+from collections import deque
+from typing import Awaitable, Callable, Dict, List, Optional
 from app.core.redis_cache import redis_cache
 
+STREAM_STATS_SAMPLES = 1000
+
 class StreamingCacheResponse:
     """
     Stream AI responses while checking cache in background
     """
-    
-    async def stream_with_cache(self, cache_key: str, ai_func, *args, **kwargs):
+
+    def __init__(self):
+        self.streams = 0
+        self.errors = 0
+        # Time from the start of the request to the first token the client received.
+        self._ttft_ms = deque(maxlen=STREAM_STATS_SAMPLES)
+
+    async def stream_with_cache(self, cache_key: Optional[str], ai_func, *args,
+                                prelude: Optional[List[Dict]] = None,
+                                on_complete: Optional[Callable[[str], Awaitable[Optional[Dict]]]] = None,
+                                started: Optional[float] = None, **kwargs):
         """
-        Stream response while checking cache and fallback
+        Stream response while checking cache and fallback.
+
+        NDJSON events: the prelude events (e.g. sources) first, then one
+        "token" event per piece, then "complete" carrying whatever
+        on_complete(full_text) returned (e.g. the saved message) and the
+        time to first token. A failed stream ends with an "error" event and
+        on_complete is not called. cache_key None skips the Redis cache.
         """
+        started = started or time.perf_counter()
+        self.streams += 1
+        for event in prelude or []:
+            yield json.dumps(event, default=str) + "\n"
+
         # Check cache first
-        cached = await redis_cache.get(cache_key)
+        cached = await redis_cache.get(cache_key) if cache_key else None
         if cached:
             yield json.dumps({"type": "cached", "data": cached}) + "\n"
-            yield json.dumps({"type": "complete"}) + "\n"
+            result = await on_complete(cached) if on_complete and isinstance(cached, str) else None
+            yield json.dumps({"type": "complete", "data": result}, default=str) + "\n"
             return
-        
+
         # Stream AI response
         complete_response = ""
+        ttft_ms = None
+        failed = False
         async for chunk in self._stream_ai(ai_func, *args, **kwargs):
             # Try to extract actual token to cache later if needed
             try:
                 data = json.loads(chunk.strip())
                 if data["type"] == "token":
                     complete_response += data["data"]
+                    if ttft_ms is None:
+                        ttft_ms = (time.perf_counter() - started) * 1000
+                        self._ttft_ms.append(ttft_ms)
+                elif data["type"] == "error":
+                    failed = True
             except Exception:
                 pass
             yield chunk
-            
+
+        if failed:
+            self.errors += 1
+            return
         # Cache the complete response if we got one
-        if complete_response:
+        if complete_response and cache_key:
             await redis_cache.set(cache_key, complete_response, ttl=1800)
-    
+        try:
+            result = await on_complete(complete_response) if on_complete else None
+            yield json.dumps({"type": "complete", "data": result,
+                              "ttft_ms": round(ttft_ms, 1) if ttft_ms is not None else None}, default=str) + "\n"
+        except Exception as e:
+            self.errors += 1
+            print(f"❌ Saving streamed response failed: {e}")
+            yield json.dumps({"type": "error", "data": "The answer could not be saved."}) + "\n"
+
     async def _stream_ai(self, ai_func, *args, **kwargs):
         """Stream AI response token by token"""
         try:
@@ -43,4 +87,18 @@ class StreamingCacheResponse:
         except Exception as e:
             yield json.dumps({"type": "error", "data": str(e)}) + "\n"
 
+    def response(self, events) -> StreamingResponse:
+        """NDJSON response for an event generator, unbuffered by proxies."""
+        return StreamingResponse(events, media_type="application/x-ndjson",
+                                 headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+    def stats(self) -> Dict:
+        ttft = sorted(self._ttft_ms)
+        return {
+            "streams": self.streams,
+            "errors": self.errors,
+            "ttft_ms_p50": round(ttft[len(ttft) // 2], 1) if ttft else 0.0,
+            "ttft_ms_p95": round(ttft[int(len(ttft) * 0.95)], 1) if ttft else 0.0,
+        }
+
 streaming_cache = StreamingCacheResponse()
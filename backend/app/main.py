@@ -14,6 +14,7 @@ from typing import Dict, List, Any
 import httpx
 from fastapi import FastAPI, Depends, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
 from apscheduler.schedulers.background import BackgroundScheduler
 
 app_requests_log = open("requests.log", "a", buffering=1)
@@ -26,11 +27,25 @@ class RequestLoggingMiddleware(BaseHTTPMiddleware):
         app_requests_log.write(f"RESPONSE: {response.status_code}\n")
         return response
 
+class LLMPriorityMiddleware(BaseHTTPMiddleware):
+    """Runs requests from the cache warmers at 'warming' LLM priority (the header can only lower it)."""
+    async def dispatch(self, request: Request, call_next):
+        if request.headers.get(LLM_PRIORITY_HEADER) == 'warming':
+            with llm_priority('warming'):
+                return await call_next(request)
+        return await call_next(request)
+
 from app.core.config import supabase
 from app.core.redis_cache import redis_cache
 from app.core.cache_decorator import cached, smart_cache
 from app.core.cache_warmer import cache_warmer
+from app.core.llm_client import llm_client
+from app.core.llm_scheduler import llm_priority, LLM_PRIORITY_HEADER
+from app.core.streaming_cache import streaming_cache
+from app.core.semantic_cache import semantic_cache
 from app.services.market import market_data, generate_sector_trend
+from rag_pipeline import rag_system, RAG_LOAD_MODE
+from app.services.ingestion import ingestion_monitor, ingest_queue, job_status
 
 # Import AI queries dynamically or normally
 # These are needed for project cache warming functions
@@ -45,6 +60,7 @@ from app.routers.ai import (
 app = FastAPI(title="SynergyAI API")
 
 app.add_middleware(RequestLoggingMiddleware)
+app.add_middleware(LLMPriorityMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["http://localhost:3000", "http://127.0.0.1:3000", "http://localhost:8000"],
@@ -89,7 +105,7 @@ async def warm_market_intel_cache():
         async with httpx.AsyncClient() as client:
             response = await client.get(
                 "http://localhost:8000/api/intelligence/market",
-                headers={"Authorization": f"Bearer mock_token_for_background_refresh"}
+                headers={"Authorization": f"Bearer mock_token_for_background_refresh", LLM_PRIORITY_HEADER: "warming"}
             )
             
             if response.status_code == 200:
@@ -116,9 +132,8 @@ async def warm_market_intel_cache_direct():
 
         sector_trends = []
         if distinct_sectors:
-            async with httpx.AsyncClient() as client:
-                tasks = [generate_sector_trend(client, sector) for sector in distinct_sectors]
-                sector_trends = await asyncio.gather(*tasks)
+            tasks = [generate_sector_trend(sector) for sector in distinct_sectors]
+            sector_trends = await asyncio.gather(*tasks)
         
         # Build the market data object
         market_data_result = {
@@ -458,7 +473,8 @@ async def warm_all_project_caches(project_id: str, user_id: str):
             warm_simulations_cache(project_id, user_id),
             warm_scenarios_cache(project_id, user_id),
         ]
-        await asyncio.gather(*warming_tasks, return_exceptions=True)
+        with llm_priority('warming'):
+            await asyncio.gather(*warming_tasks, return_exceptions=True)
         print(f"✅ All project caches warmed for: {project_id}")
     except Exception as e:
         print(f"⚠️ Error during project cache warming: {e}")
@@ -689,76 +705,82 @@ async def warm_non_critical_project_caches(project_id: str, user_id: str):
             warm_simulations_cache(project_id, user_id),
             warm_scenarios_cache(project_id, user_id),
         ]
-        await asyncio.gather(*non_critical_tasks, return_exceptions=True)
+        with llm_priority('warming'):
+            await asyncio.gather(*non_critical_tasks, return_exceptions=True)
         print(f"✅ Non-critical caches warmed for: {project_id}")
     except Exception as e:
         print(f"⚠️ Error during non-critical cache warming: {e}")
 
+def run_warming_job(warm_func):
+    """Runs a scheduled warming job in its own event loop at 'warming' LLM priority."""
+    with llm_priority('warming'):
+        asyncio.run(warm_func())
+
 # Scheduler runner
 def start_background_scheduler():
     scheduler = BackgroundScheduler()
     scheduler.add_job(
-        lambda: asyncio.run(warm_market_intel_cache_direct()),
+        lambda: run_warming_job(warm_market_intel_cache_direct),
         'interval',
         minutes=3,
         id='market_intel_cache_warmer'
     )
     scheduler.add_job(
-        lambda: asyncio.run(warm_active_projects_caches()),
+        lambda: run_warming_job(warm_active_projects_caches),
         'interval',
         minutes=2,
         id='active_projects_cache_warmer'
     )
     scheduler.add_job(
-        lambda: asyncio.run(warm_ai_recommendations_cache()),
+        lambda: run_warming_job(warm_ai_recommendations_cache),
         'interval', 
         minutes=10,
         id='ai_recommendations_cache_warmer'
     )
     scheduler.add_job(
-        lambda: asyncio.run(warm_dashboard_cache()),
+        lambda: run_warming_job(warm_dashboard_cache),
         'interval',
         minutes=5,
         id='dashboard_cache_warmer'
     )
     scheduler.add_job(
-        lambda: asyncio.run(warm_chat_and_news_cache()),
+        lambda: run_warming_job(warm_chat_and_news_cache),
         'interval',
         minutes=5,
         id='chat_news_cache_warmer'
     )
     scheduler.add_job(
-        lambda: asyncio.run(warm_project_intelligence_cache()),
+        lambda: run_warming_job(warm_project_intelligence_cache),
         'interval',
         minutes=10,
         id='project_intelligence_cache_warmer'
     )
     scheduler.add_job(
-        lambda: asyncio.run(warm_ai_analysis_cache()),
+        lambda: run_warming_job(warm_ai_analysis_cache),
         'interval',
         minutes=15,
         id='ai_analysis_cache_warmer'
     )
     scheduler.add_job(
-        lambda: asyncio.run(warm_document_ai_cache()),
+        lambda: run_warming_job(warm_document_ai_cache),
         'interval',
         minutes=10,
         id='document_ai_cache_warmer'
     )
     scheduler.add_job(
-        lambda: asyncio.run(warm_ai_chats_cache()),
+        lambda: run_warming_job(warm_ai_chats_cache),
         'interval',
         minutes=5,
         id='ai_chats_cache_warmer'
     )
     scheduler.add_job(
-        lambda: asyncio.run(warm_mission_control_cache()),
+        lambda: run_warming_job(warm_mission_control_cache),
         'interval',
         minutes=5,
         id='mission_control_cache_warmer'
     )
     scheduler.add_job(
-        lambda: asyncio.run(warm_comprehensive_cache()),
+        lambda: run_warming_job(warm_comprehensive_cache),
         'interval',
         minutes=5,
         id='comprehensive_cache_warmer'
@@ -769,6 +791,12 @@ def start_background_scheduler():
 @app.on_event("startup")
 async def startup_event():
     """Initialize all services"""
+    # Warm up the RAG model and index without blocking startup
+    if RAG_LOAD_MODE == 'background':
+        rag_system.start_background_load()
+    ingestion_monitor.start()
+    await llm_client.startup()
+
     # Start cache warmer
     cache_warmer.start()
     
@@ -777,6 +805,11 @@ async def startup_event():
     
     print("✅ All cache services initialized")
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Close pooled connections"""
+    await llm_client.shutdown()
+
 @app.post("/api/cache/warm/{user_id}")
 async def warm_user_cache_manually(user_id: str, admin_key: str):
     """Manually warm cache for a user (admin only)"""
@@ -797,6 +830,34 @@ async def cache_stats():
         "redis_connected": bool(redis_cache.redis_client)
     }
 
+@app.get("/api/llm/stats")
+async def llm_stats():
+    """Connection pool, scheduler and streaming metrics of the shared LLM client."""
+    return {**llm_client.stats(), "streaming": streaming_cache.stats(), "semantic_cache": semantic_cache.stats()}
+
+@app.get("/api/rag/status")
+async def rag_status():
+    """Readiness probe for the RAG model and index; 503 until loading has finished."""
+    status = {"ready": rag_system.ready, "load_mode": RAG_LOAD_MODE, **rag_system.load_status,
+              "embedding": rag_system.embedder.stats(), "embedding_cache": rag_system.embedding_cache.stats(),
+              "search": rag_system.search_executor.stats(), "rerank": rag_system.reranker.stats(),
+              "shards": rag_system.shards.stats(), "index": rag_system.index_stats()}
+    return JSONResponse(status_code=200 if rag_system.ready else 503, content=status)
+
+@app.get("/api/rag/ingest/stats")
+async def rag_ingest_stats():
+    """Ingestion queue depth and outcomes."""
+    return ingest_queue.stats()
+
+@app.get("/api/rag/ingest/documents/{document_id}")
+async def rag_ingest_document_status(document_id: str):
+    """Latest ingestion job for a document, including progress and retry state."""
+    job = ingest_queue.latest_for_document(document_id)
+    if not job:
+        from fastapi import HTTPException
+        raise HTTPException(status_code=404, detail="No ingestion job for this document")
+    return {**job, "analysis_status": job_status(job), "resolved_job_id": ingest_queue.resolve(job)['id']}
+
 @app.post("/api/cache/clear")
 async def clear_all_cache():
     """Emergency cache clear"""
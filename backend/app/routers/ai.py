@@ -19,10 +19,15 @@ from reportlab.lib.pagesizes import letter
 from reportlab.lib.styles import getSampleStyleSheet
 from reportlab.platypus import Paragraph
 
-from app.core.config import supabase, OLLAMA_SERVER_URL, CUSTOM_MODEL_NAME
+from app.core.config import supabase
 from app.core.security import get_current_user_id, get_project_member_auth, get_project_admin_auth
 from app.core.cache_decorator import cached
+from app.core.llm_client import llm_client
+from app.core.llm_scheduler import LLMOverloadedError
+from app.core.streaming_cache import streaming_cache
+from app.core.semantic_cache import semantic_cache
 from rag_pipeline import rag_system
+from app.core.rag_readiness import require_rag_ready, wait_for_rag
 from app.services.news import news_service
 from app.services.market import market_data, generate_sector_trend
 from app.services.prompt_templates import (
@@ -94,6 +99,11 @@ class AiLabRequest(BaseModel):
     note_ids: List[str]
     action: str  # 'summarize', 'find_themes', etc.
 
+class ProjectChatQuery(BaseModel):
+    question: str
+    existing_messages: List[Dict] = []
+    chat_id: Optional[str] = None
+
 class ChatSession(BaseModel):
     project_id: Optional[str] = None
     messages: List[Dict] = []
@@ -104,13 +114,16 @@ async def get_ai_json_response(prompt: str, retries: int = 3) -> Union[Dict, Lis
     """A robust function to get a JSON response from the LLM, with retries."""
     for attempt in range(retries):
         try:
-            async with httpx.AsyncClient(timeout=180.0) as client:
-                response = await client.post(OLLAMA_SERVER_URL, json={"model": CUSTOM_MODEL_NAME, "prompt": prompt, "stream": False})
-                response.raise_for_status()
+            # Retries need a fresh sample, not the cached unusable answer.
+            response = await llm_client.generate(prompt, timeout='long', cache=attempt == 0)
+            response.raise_for_status()
             ai_response_text = response.json().get('response', '{}')
             match = re.search(r'(\{.*\}|\[.*\])', ai_response_text, re.DOTALL)
             if match:
                 return json.loads(match.group(0))
+        except LLMOverloadedError:
+            # Retrying a shed request only adds load; let the caller fall back.
+            raise
         except Exception as e:
             print(f"AI JSON generation attempt {attempt + 1} failed: {e}")
     raise HTTPException(status_code=500, detail="Failed to get a valid JSON response from the AI model.")
@@ -134,16 +147,12 @@ async def score_and_stream(candidates: List[Dict], user_query: str):
     """Scores companies in parallel and streams the results."""
     yield json.dumps({"type": "status", "message": f"Analyzing {len(candidates)} candidates..."}) + "\n"
 
-    async def score_company(client, company):
+    async def score_company(company):
         try:
             company_dossier = f"Name: {company.get('name')}, Sector: {company.get('industry', {}).get('sector')}, Revenue (Cr): {company.get('financial_summary', {}).get('revenue_cr')}"
             prompt = f"Instruction: You are an M&A analyst. Based on the User's Goal, provide a 'Strategic Fit Score' (0-100) and a brief rationale. Respond ONLY with a JSON object like {{\"fitScore\": <score>, \"rationale\": \"<text>\"}}.\n\nUser's Strategic Goal: \"{user_query}\"\n\nCompany Data:\n{company_dossier}\n\nResponse (JSON only):"
             
-            response = await client.post(
-                "http://localhost:11434/api/generate",
-                json={"model": CUSTOM_MODEL_NAME, "prompt": prompt, "stream": False},
-                timeout=60.0
-            )
+            response = await llm_client.generate(prompt, timeout='short')
             response.raise_for_status()
             
             ai_response = json.loads(response.json().get('response', '{}'))
@@ -151,44 +160,46 @@ async def score_and_stream(candidates: List[Dict], user_query: str):
         except Exception as e:
             return {"type": "result", "data": { "company": company, "fitScore": 0, "rationale": f"Analysis failed: {e}" }}
 
-    async with httpx.AsyncClient() as client:
-        tasks = [score_company(client, company) for company in candidates]
-        for future in asyncio.as_completed(tasks):
-            result = await future
-            if result:
-                yield json.dumps(result) + "\n"
+    tasks = [score_company(company) for company in candidates]
+    for future in asyncio.as_completed(tasks):
+        result = await future
+        if result:
+            yield json.dumps(result) + "\n"
+
+async def build_ai_query_prompt(question: str):
+    """Retrieves library context for a general AI query; returns (prompt, context chunks)."""
+    print(f"--- RAG: Searching for context for question: '{question}' ---")
+    context_chunks = await rag_system.asearch(question)
+    
+    if not context_chunks:
+        context_text = "No relevant context was found in the document library for this query."
+    else:
+        context_text = "\n\n---\n\n".join([chunk['content'] for chunk in context_chunks])
 
-@router.post("/api/ai/query")
+    prompt = f"Instruction: {question}\n\nContext: {context_text}\n\nResponse:"
+    return prompt, context_chunks
+
+@router.post("/api/ai/query", dependencies=[Depends(require_rag_ready)])
 async def handle_ai_query(query: AIQuery):
     """General AI Query utilizing RAG and custom LLM."""
     try:
-        print(f"--- RAG: Searching for context for question: '{query.question}' ---")
-        context_chunks = rag_system.search(query.question)
+        prompt, context_chunks = await build_ai_query_prompt(query.question)
         
-        if not context_chunks:
-            context_text = "No relevant context was found in the document library for this query."
-        else:
-            context_text = "\n\n---\n\n".join([chunk['content'] for chunk in context_chunks])
-
-        prompt = f"Instruction: {query.question}\n\nContext: {context_text}\n\nResponse:"
-        
-        print("--- Sending prompt to SynergyAI Specialist model via Ollama... ---")
-        async with httpx.AsyncClient(timeout=120.0) as client:
-            response = await client.post(
-                OLLAMA_SERVER_URL,
-                json={
-                    "model": CUSTOM_MODEL_NAME,
-                    "prompt": prompt,
-                    "stream": False
-                }
-            )
+        async def generate() -> str:
+            print("--- Sending prompt to SynergyAI Specialist model via Ollama... ---")
+            response = await llm_client.generate(prompt, timeout='standard', priority='interactive')
             response.raise_for_status()
-            
-        ai_response = response.json()
-        final_answer = ai_response.get('response', 'Sorry, I could not generate a response.').strip()
+            return response.json().get('response', '').strip()
+
+        final_answer = await semantic_cache.answer("library", "ai_query", query.question,
+                                                   [chunk['content'] for chunk in context_chunks], generate)
+        final_answer = final_answer or 'Sorry, I could not generate a response.'
         
         return {"answer": final_answer, "sources": context_chunks}
 
+    except LLMOverloadedError as e:
+        print(f"⚠️ AI query shed by the LLM scheduler: {e}")
+        return {"answer": f"The AI service is handling too many requests right now. Please try again in {e.retry_after} seconds.", "sources": []}
     except httpx.RequestError as e:
         print(f"❌ HTTP Error: Could not connect to Ollama server. Is it running?")
         return {"answer": "AI service is currently unreachable. Please ensure Ollama is running.", "sources": []}
@@ -199,6 +210,16 @@ async def handle_ai_query(query: AIQuery):
         print(f"❌ An error occurred in the AI query pipeline: {e}")
         return {"answer": "An internal error occurred while processing your query.", "sources": []}
 
+@router.post("/api/ai/query/stream", dependencies=[Depends(require_rag_ready)])
+async def stream_ai_query(query: AIQuery):
+    """Streaming /api/ai/query: NDJSON sources first, then tokens as they arrive, then completion."""
+    started = time.perf_counter()
+    prompt, context_chunks = await build_ai_query_prompt(query.question)
+    return streaming_cache.response(streaming_cache.stream_with_cache(
+        None, semantic_cache.stream, "library", "ai_query", query.question, [chunk['content'] for chunk in context_chunks],
+        llm_client.stream, prompt, timeout='standard', priority='interactive',
+        prelude=[{"type": "sources", "data": context_chunks}], started=started))
+
 @router.post("/api/companies/strategic_search")
 async def strategic_search(query: StrategicQuery):
     """Performs strategic deal sourcing match search and streams results."""
@@ -223,7 +244,7 @@ async def strategic_search(query: StrategicQuery):
 
     return StreamingResponse(score_and_stream(candidates, query.query), media_type="application/x-ndjson")
 
-@router.get("/api/dashboard/narrative")
+@router.get("/api/dashboard/narrative", dependencies=[Depends(wait_for_rag)])
 @cached(request_type="ai_heavy")
 async def get_narrative(user_id: str = Depends(get_current_user_id)):
     """Generates pipeline briefing narrative using RAG."""
@@ -232,15 +253,14 @@ async def get_narrative(user_id: str = Depends(get_current_user_id)):
         projects = projects_res.data
         deal_count = len(projects)
         
-        rag_context_chunks = rag_system.search("Summarize the overall strategic initiatives, management outlook, and key identified risks from across all documents.", k=5)
+        rag_context_chunks = await rag_system.asearch("Summarize the overall strategic initiatives, management outlook, and key identified risks from across all documents.", k=5)
         rag_context = "\n\n---\n\n".join([chunk['content'] for chunk in rag_context_chunks])
 
         briefing = f"Total Active Deals: {deal_count}\n\nQualitative Insights from Documents:\n{rag_context}"
         prompt = f"Instruction: You are a senior M&A analyst. Based on the following context, write a detailed, insightful, multi-paragraph executive summary of the current deal pipeline. Use markdown bolding (**word**) to highlight all key metrics and important phrases.\n\nContext: {briefing}\n\nResponse:"
 
-        async with httpx.AsyncClient(timeout=120.0) as client:
-            response = await client.post(OLLAMA_SERVER_URL, json={"model": CUSTOM_MODEL_NAME, "prompt": prompt, "stream": False})
-            response.raise_for_status()
+        response = await llm_client.generate(prompt, timeout='standard')
+        response.raise_for_status()
         
         ai_response = response.json()
         narrative = ai_response.get('response', 'Could not generate summary.').strip()
@@ -289,7 +309,7 @@ async def export_summary_pdf(data: AI_Summary_Export):
         print(f"Error generating PDF: {e}")
         raise HTTPException(status_code=500, detail="Failed to generate PDF.")
 
-@router.get("/api/projects/{project_id}/risk_profile")
+@router.get("/api/projects/{project_id}/risk_profile", dependencies=[Depends(wait_for_rag)])
 @cached(request_type="ai_heavy")
 async def get_project_risk_profile(project_id: str, user_id: str = Depends(get_current_user_id)):
     """Generates a complete, AI-driven risk profile for the target company."""
@@ -303,7 +323,7 @@ async def get_project_risk_profile(project_id: str, user_id: str = Depends(get_c
         company_name = company_res.data['name'] if company_res.data else 'Unknown Company'
 
         print("--- RAG: Searching for all risk-related context in VDR... ---")
-        rag_context_chunks = rag_system.search(
+        rag_context_chunks = await rag_system.asearch(
             "Find all text related to risks, liabilities, litigation, dependencies, competition, and challenges.", 
             k=10
         )
@@ -317,12 +337,8 @@ async def get_project_risk_profile(project_id: str, user_id: str = Depends(get_c
         Response (JSON object only):
         """
                 
-        async with httpx.AsyncClient(timeout=180.0) as client:
-            response = await client.post(
-                OLLAMA_SERVER_URL,
-                json={"model": CUSTOM_MODEL_NAME, "prompt": prompt, "stream": False}
-            )
-            response.raise_for_status()
+        response = await llm_client.generate(prompt, timeout='long')
+        response.raise_for_status()
         
         ai_response_text = response.json().get('response', '{}')
         cleaned_json_text = re.search(r'\{.*\}', ai_response_text, re.DOTALL).group(0)
@@ -337,7 +353,7 @@ async def get_project_risk_profile(project_id: str, user_id: str = Depends(get_c
         print(f"Error generating risk profile: {e}")
         raise HTTPException(status_code=500, detail="Could not generate risk profile.")
 
-@router.get("/api/projects/{project_id}/synergy_score")
+@router.get("/api/projects/{project_id}/synergy_score", dependencies=[Depends(wait_for_rag)])
 @cached(request_type="ai_heavy")
 async def get_synergy_ai_score(project_id: str, user_id: str = Depends(get_current_user_id)):
     """Strategic fit and synergy scoring."""
@@ -349,7 +365,7 @@ async def get_synergy_ai_score(project_id: str, user_id: str = Depends(get_curre
 
         print(f"--- RAG: Searching for strategic context for {project['name']}... ---")
         rag_query = f"Analyze the strategic rationale, market position, and potential risks for an acquisition of {project['targetCompany']['name']} based on all available documents."
-        rag_context_chunks = rag_system.search(rag_query, k=10)
+        rag_context_chunks = await rag_system.asearch(rag_query, k=10)
         rag_context = "\n\n---\n\n".join([chunk['content'] for chunk in rag_context_chunks])
 
         prompt = f"""Instruction: You are the head of a top-tier M&A investment committee. Conduct a final Strategic Fit Audit for the potential acquisition of {project['targetCompany']['name']}. Based ONLY on the provided context, generate a JSON object with the following structure: {{"overallScore": <0-100>, "subScores": [{{"category": "<Category>", "score": <0-100>, "summary": "<One-sentence summary>"}}], "rationale": "<A detailed, multi-paragraph analysis>"}}.
@@ -365,12 +381,8 @@ Qualitative Insights from VDR:
 Response (JSON object only):
 """
         
-        async with httpx.AsyncClient(timeout=180.0) as client:
-            response = await client.post(
-                OLLAMA_SERVER_URL,
-                json={"model": CUSTOM_MODEL_NAME, "prompt": prompt, "stream": False}
-            )
-            response.raise_for_status()
+        response = await llm_client.generate(prompt, timeout='long')
+        response.raise_for_status()
         
         ai_response_text = response.json().get('response', '{}')
         
@@ -629,9 +641,8 @@ async def run_monte_carlo(project_id: str, sim_request: SimulationRunRequest, us
         results_summary = f"Mean Valuation: {mean_val:.2f} Cr, 90% Confidence Interval: [{p5:.2f} Cr - {p95:.2f} Cr], Median: {median_val:.2f} Cr"
         prompt = f"Instruction: You are a quantitative analyst. Based on the following Monte Carlo simulation results, write a concise, one-paragraph rationale explaining the key takeaways for an investment committee. Use markdown bolding.\n\nContext:\n{results_summary}\n\nResponse:"
         
-        async with httpx.AsyncClient(timeout=60.0) as client:
-            response = await client.post(OLLAMA_SERVER_URL, json={"model": CUSTOM_MODEL_NAME, "prompt": prompt, "stream": False})
-            ai_rationale = response.json().get('response', 'Analysis pending.').strip()
+        response = await llm_client.generate(prompt, timeout='short', cache=True)
+        ai_rationale = response.json().get('response', 'Analysis pending.').strip()
 
         return {
             "meanValuation": mean_val, "medianValuation": median_val, "stdDeviation": std_dev,
@@ -840,15 +851,14 @@ async def generate_section(section_name: str, prompt: str, fallback: str) -> str
     """Generate a single memo section text."""
     try:
         full_prompt = f"Instruction: You are a senior M&A analyst. {prompt}\n\nRespond with ONLY the content for this section, no markdown headers or formatting wrappers."
-        async with httpx.AsyncClient(timeout=120.0) as client:
-            response = await client.post(OLLAMA_SERVER_URL, json={"model": CUSTOM_MODEL_NAME, "prompt": full_prompt, "stream": False})
-            response.raise_for_status()
+        response = await llm_client.generate(full_prompt, timeout='standard')
+        response.raise_for_status()
         content = response.json().get('response', '').strip()
         return content if content and len(content) > 100 else fallback
     except Exception:
         return fallback
 
-@router.get("/api/projects/{project_id}/key_risks")
+@router.get("/api/projects/{project_id}/key_risks", dependencies=[Depends(wait_for_rag)])
 @cached(request_type="ai_heavy")
 async def get_project_key_risks(project_id: str, user_id: str = Depends(get_current_user_id)):
     """Deep analysis of legal and financial risks in VDR documents."""
@@ -861,7 +871,7 @@ async def get_project_key_risks(project_id: str, user_id: str = Depends(get_curr
         if not allowed_filenames:
             return []
 
-        rag_context_chunks = rag_system.search(f"Find all text related to risks, liabilities, litigation, dependencies, competition, challenges, and negative sentiment for {target_name}", k=15, allowed_sources=allowed_filenames)
+        rag_context_chunks = await rag_system.ahybrid_search(f"Find all text related to risks, liabilities, litigation, dependencies, competition, challenges, and negative sentiment for {target_name}", k=8, allowed_sources=allowed_filenames, tenant=f"project:{project_id}")
         rag_context = "\n\n---\n\n".join([chunk['content'] for chunk in rag_context_chunks])
 
         prompt = f"""Instruction: You are a senior M&A risk analyst. Based ONLY on the provided context, identify key risks. Response must be a single JSON array of objects like: [{{\"category\": \"Financial|Legal|Operational\", \"severity\": <0-100>, \"risk\": \"...\", \"mitigation\": \"...\", \"evidence\": [\"quote\"]}}].
@@ -898,7 +908,7 @@ async def get_project_tasks(project_id: str) -> list:
             {"id": "2", "title": "Schedule management meeting", "description": "Arrange alignment meeting with target execs", "status": "To Do", "priority": "Medium"}
         ]
 
-@router.post("/api/projects/{project_id}/generate_tasks")
+@router.post("/api/projects/{project_id}/generate_tasks", dependencies=[Depends(wait_for_rag)])
 async def generate_ai_tasks(project_id: str, user_id: str = Depends(get_current_user_id)):
     """Suggests checklist tasks for Kanban board using VDR insights."""
     try:
@@ -907,7 +917,7 @@ async def generate_ai_tasks(project_id: str, user_id: str = Depends(get_current_
         
         rag_context_chunks = []
         if allowed_filenames:
-            rag_context_chunks = rag_system.search(f"Find all text related to risks, mitigations, dependencies, and next steps for this project.", k=10, allowed_sources=allowed_filenames)
+            rag_context_chunks = await rag_system.ahybrid_search(f"Find all text related to risks, mitigations, dependencies, and next steps for this project.", k=6, allowed_sources=allowed_filenames, tenant=f"project:{project_id}")
         rag_context = "\n\n---\n\n".join([chunk['content'] for chunk in rag_context_chunks])
 
         prompt = f"""Instruction: You are a senior M&A project manager. Based ONLY on the provided context, generate a JSON array of 3-5 critical next steps: [{{\"title\": \"...\", \"description\": \"...\", \"priority\": \"High|Medium|Low\"}}].
@@ -1069,9 +1079,8 @@ async def generate_ai_recommendation(project_data: dict, financials: dict, risks
         context = f"Project: {project_data.get('name')}\nTarget: {project_data.get('companies', {}).get('name')}\nRevenue ₹{financials.get('revenue_cr')}Cr, EBITDA {financials.get('ebitda_margin')}%\nRisk Score {risks.get('risk_score')}/100, Synergy Score {synergies.get('synergy_score')}/100\nValuation Range ₹{financials.get('valuation_low')}-{financials.get('valuation_high')}Cr"
         prompt = f"Instruction: As a senior M&A analyst, provide a concise investment recommendation. Respond with ONLY JSON object: {{\"recommendation\": \"BUY|HOLD|SELL\", \"confidence\": \"High|Medium|Low\", \"rationale\": \"brief explanation\"}}\n\nContext:\n{context}\n\nResponse:"
         
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            response = await client.post(OLLAMA_SERVER_URL, json={"model": CUSTOM_MODEL_NAME, "prompt": prompt, "stream": False})
-            response.raise_for_status()
+        response = await llm_client.generate(prompt, timeout='quick')
+        response.raise_for_status()
         ai_response = response.json().get('response', '{}')
         return json.loads(re.search(r'\{.*\}', ai_response, re.DOTALL).group(0))
     except Exception:
@@ -1219,58 +1228,85 @@ async def get_project_ai_chats(project_id: str, user_id: str = Depends(get_curre
     except Exception:
         return []
 
-@router.post("/api/projects/{project_id}/ai_chat")
-async def handle_project_ai_chat(project_id: str, query: BaseModel, user_id: str = Depends(get_current_user_id)):
-    """Scoped project QA co-pilot chat."""
-    # Note: query will map ProjectChatQuery properties
-    # Let's map dynamically to support both queries
-    data_dict = query.model_dump()
-    question = data_dict.get('question')
-    existing_messages = data_dict.get('existing_messages', [])
-    chat_id = data_dict.get('chat_id')
+async def build_project_chat_prompt(project_id: str, user_id: str, question: str):
+    """Retrieves the project's VDR context for a chat question; returns (prompt, context chunks)."""
+    project_res = supabase.rpc('get_user_projects', {'p_user_id': user_id}).execute()
+    project = next((p for p in project_res.data if p['id'] == project_id), None)
+    if not project:
+        raise HTTPException(status_code=404, detail="Project not found")
 
+    docs_res = supabase.table('vdr_documents').select('file_name').eq('project_id', project_id).execute()
+    allowed_filenames = [doc['file_name'] for doc in docs_res.data]
+    
+    rag_context_chunks = await rag_system.ahybrid_search(question, k=5, allowed_sources=allowed_filenames, tenant=f"project:{project_id}") if allowed_filenames else []
+    context_text = "\n\n---\n\n".join([chunk['content'] for chunk in rag_context_chunks]) if rag_context_chunks else "No VDR context."
+
+    prompt = f"Instruction: You are an M&A analyst working on the acquisition of {project.get('targetCompany', {}).get('name', 'the target')}. Use context to answer. Context:\n{context_text}\nQ: {question}\nA:"
+    return prompt, rag_context_chunks
+
+async def save_project_chat(project_id: str, user_id: str, query: ProjectChatQuery, final_answer: str, sources: List[Dict]) -> Dict:
+    """Appends the Q&A to the chat (or starts a titled one) and returns the saved conversation."""
+    user_message = {"role": "user", "content": query.question}
+    assistant_message = {"role": "assistant", "content": final_answer, "sources": sources}
+    updated_messages = query.existing_messages + [user_message, assistant_message]
+
+    if query.chat_id and query.chat_id != 'new':
+        supabase.table('project_ai_chats').update({'messages': updated_messages, 'updated_at': 'now()'}).eq('id', query.chat_id).eq('user_id', user_id).execute()
+        updated_convo = supabase.table('project_ai_chats').select('*').eq('id', query.chat_id).single().execute()
+        if isinstance(updated_convo.data['messages'], str):
+            updated_convo.data['messages'] = json.loads(updated_convo.data['messages'])
+        return updated_convo.data
+
+    title_prompt = f"Summarize project-specific Q&A in 5 words or less: Q: {query.question} A: {final_answer}"
+    try:
+        title_res = await llm_client.generate(title_prompt, timeout='quick')
+        title = title_res.json().get('response', 'Discussion').strip().replace('"', '')
+    except LLMOverloadedError:
+        title = 'Discussion'
+
+    result = supabase.table('project_ai_chats').insert({'project_id': project_id, 'user_id': user_id, 'title': title, 'messages': updated_messages}).execute()
+    if isinstance(result.data[0]['messages'], str):
+        result.data[0]['messages'] = json.loads(result.data[0]['messages'])
+    return result.data[0]
+
+@router.post("/api/projects/{project_id}/ai_chat", dependencies=[Depends(require_rag_ready)])
+async def handle_project_ai_chat(project_id: str, query: ProjectChatQuery, user_id: str = Depends(get_current_user_id)):
+    """Scoped project QA co-pilot chat."""
     try:
-        project_res = supabase.rpc('get_user_projects', {'p_user_id': user_id}).execute()
-        project = next((p for p in project_res.data if p['id'] == project_id), None)
-        if not project:
-            raise HTTPException(status_code=404, detail="Project not found")
+        prompt, rag_context_chunks = await build_project_chat_prompt(project_id, user_id, query.question)
 
-        docs_res = supabase.table('vdr_documents').select('file_name').eq('project_id', project_id).execute()
-        allowed_filenames = [doc['file_name'] for doc in docs_res.data]
-        
-        rag_context_chunks = rag_system.search(question, k=5, allowed_sources=allowed_filenames) if allowed_filenames else []
-        context_text = "\n\n---\n\n".join([chunk['content'] for chunk in rag_context_chunks]) if rag_context_chunks else "No VDR context."
-
-        prompt = f"Instruction: You are an M&A analyst working on the acquisition of {project.get('targetCompany', {}).get('name', 'the target')}. Use context to answer. Context:\n{context_text}\nQ: {question}\nA:"
-        
-        async with httpx.AsyncClient(timeout=120.0) as client:
-            response = await client.post(OLLAMA_SERVER_URL, json={"model": CUSTOM_MODEL_NAME, "prompt": prompt, "stream": False})
+        async def generate() -> str:
+            response = await llm_client.generate(prompt, timeout='standard', priority='interactive')
             response.raise_for_status()
-        final_answer = response.json().get('response', '').strip()
-
-        user_message = {"role": "user", "content": question}
-        assistant_message = {"role": "assistant", "content": final_answer, "sources": rag_context_chunks}
-        updated_messages = existing_messages + [user_message, assistant_message]
-
-        if chat_id and chat_id != 'new':
-            supabase.table('project_ai_chats').update({'messages': updated_messages, 'updated_at': 'now()'}).eq('id', chat_id).eq('user_id', user_id).execute()
-            updated_convo = supabase.table('project_ai_chats').select('*').eq('id', chat_id).single().execute()
-            if isinstance(updated_convo.data['messages'], str):
-                updated_convo.data['messages'] = json.loads(updated_convo.data['messages'])
-            return updated_convo.data
-        else:
-            title_prompt = f"Summarize project-specific Q&A in 5 words or less: Q: {question} A: {final_answer}"
-            async with httpx.AsyncClient() as client:
-                title_res = await client.post(OLLAMA_SERVER_URL, json={"model": CUSTOM_MODEL_NAME, "prompt": title_prompt, "stream": False})
-            title = title_res.json().get('response', 'Discussion').strip().replace('"', '')
-
-            result = supabase.table('project_ai_chats').insert({'project_id': project_id, 'user_id': user_id, 'title': title, 'messages': updated_messages}).execute()
-            if isinstance(result.data[0]['messages'], str):
-                result.data[0]['messages'] = json.loads(result.data[0]['messages'])
-            return result.data[0]
+            return response.json().get('response', '').strip()
+
+        final_answer = await semantic_cache.answer(f"project:{project_id}", "project_chat", query.question,
+                                                   [chunk['content'] for chunk in rag_context_chunks], generate)
+        final_answer = final_answer or 'Error generating response.'
+
+        return await save_project_chat(project_id, user_id, query, final_answer, rag_context_chunks)
+    except LLMOverloadedError as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(e.retry_after)})
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@router.post("/api/projects/{project_id}/ai_chat/stream", dependencies=[Depends(require_rag_ready)])
+async def stream_project_ai_chat(project_id: str, query: ProjectChatQuery, user_id: str = Depends(get_current_user_id)):
+    """
+    Streaming project chat: NDJSON sources, then tokens as they arrive. The
+    conversation is saved once the answer is complete and sent in the final event.
+    """
+    started = time.perf_counter()
+    prompt, rag_context_chunks = await build_project_chat_prompt(project_id, user_id, query.question)
+
+    async def save(final_answer: str) -> Dict:
+        return await save_project_chat(project_id, user_id, query, final_answer.strip() or 'Error generating response.', rag_context_chunks)
+
+    return streaming_cache.response(streaming_cache.stream_with_cache(
+        None, semantic_cache.stream, f"project:{project_id}", "project_chat", query.question,
+        [chunk['content'] for chunk in rag_context_chunks], llm_client.stream, prompt, timeout='standard', priority='interactive',
+        prelude=[{"type": "sources", "data": rag_context_chunks}], on_complete=save, started=started))
+
 @router.delete("/api/projects/{project_id}/ai_chats/{chat_id}")
 async def delete_project_chat(project_id: str, chat_id: str, user_id: str = Depends(get_current_user_id)):
     try:
@@ -1312,8 +1348,7 @@ async def update_note(note_id: str, note_data: NoteUpdate, user_id: str = Depend
     try:
         # Simple summary generation
         summary_prompt = f"Write a one-sentence summary for this note content: {note_data.content}"
-        async with httpx.AsyncClient() as client:
-            sum_res = await client.post(OLLAMA_SERVER_URL, json={"model": CUSTOM_MODEL_NAME, "prompt": summary_prompt, "stream": False})
+        sum_res = await llm_client.generate(summary_prompt, timeout='quick')
         ai_summary = sum_res.json().get('response', 'Analysis pending.').strip()
 
         supabase.table('notes').update({'title': note_data.title, 'content': note_data.content, 'summary': ai_summary, 'updated_at': 'now()'}).eq('id', note_id).eq('user_id', user_id).execute()
@@ -1361,8 +1396,7 @@ async def notes_ai_lab(request: AiLabRequest, user_id: str = Depends(get_current
 
         if request.action == 'summarize':
             prompt = f"Instruction: Synthesize the following notes into a cohesive summary: {combined}"
-            async with httpx.AsyncClient(timeout=180.0) as client:
-                res = await client.post(OLLAMA_SERVER_URL, json={"model": CUSTOM_MODEL_NAME, "prompt": prompt, "stream": False})
+            res = await llm_client.generate(prompt, timeout='long')
             return {"action": "summarize", "output": res.json().get('response', '').strip()}
         elif request.action == 'find_themes':
             prompt = f"Instruction: List the top recurring themes from this content as a JSON array of strings: {combined}"
@@ -1404,7 +1438,7 @@ async def get_ai_recommendations(user_id: str = Depends(get_current_user_id)):
         if not events_res.data:
             return []
 
-        async def generate_thesis(client, event):
+        async def generate_thesis(event):
             company = event.get('companies')
             if not company: 
                 return None
@@ -1418,7 +1452,7 @@ async def get_ai_recommendations(user_id: str = Depends(get_current_user_id)):
             try:
                 briefing = f"Profile: {json.dumps(company)}\nEvent: {event.get('summary', 'Market shift')}"
                 prompt = f"Instruction: As a senior partner, write a JSON thesis for acquiring this target company: {briefing}. format: {{\"headline\": \"...\", \"rationale\": \"...\"}}"
-                response = await client.post(OLLAMA_SERVER_URL, json={"model": CUSTOM_MODEL_NAME, "prompt": prompt, "stream": False}, timeout=30.0)
+                response = await llm_client.generate(prompt, timeout='quick')
                 
                 if response.status_code == 200:
                     text_response = response.json().get('response', '{}')
@@ -1434,9 +1468,8 @@ async def get_ai_recommendations(user_id: str = Depends(get_current_user_id)):
                 "aiThesis": ai_thesis
             }
 
-        async with httpx.AsyncClient() as client:
-            tasks = [generate_thesis(client, event) for event in events_res.data]
-            results = await asyncio.gather(*tasks)
+        tasks = [generate_thesis(event) for event in events_res.data]
+        results = await asyncio.gather(*tasks)
         return [r for r in results if r is not None]
     except Exception:
         raise HTTPException(status_code=500, detail="Could not generate recommendations")
@@ -1454,14 +1487,12 @@ async def get_market_intelligence(user_id: str = Depends(get_current_user_id)):
 
         sector_trends = []
         if distinct_sectors:
-            async with httpx.AsyncClient() as client:
-                tasks = [generate_sector_trend(client, sector) for sector in distinct_sectors]
-                sector_trends = await asyncio.gather(*tasks)
+            tasks = [generate_sector_trend(sector) for sector in distinct_sectors]
+            sector_trends = await asyncio.gather(*tasks)
         else:
             fallback_sectors = ["Technology", "Financial Services", "Healthcare"]
-            async with httpx.AsyncClient() as client:
-                tasks = [generate_sector_trend(client, sector) for sector in fallback_sectors]
-                sector_trends = await asyncio.gather(*tasks)
+            tasks = [generate_sector_trend(sector) for sector in fallback_sectors]
+            sector_trends = await asyncio.gather(*tasks)
 
         return {"indicators": indicators, "sectorTrends": sector_trends, "topGainers": top_gainers, "topLosers": top_losers, "lastUpdated": datetime.now().isoformat(), "dataSource": "live"}
     except Exception:
@@ -1496,9 +1527,8 @@ async def get_project_intelligence(project_id: str, user_id: str = Depends(get_c
         
         ai_recommendations = []
         try:
-            async with httpx.AsyncClient(timeout=90.0) as client:
-                response = await client.post(OLLAMA_SERVER_URL, json={"model": CUSTOM_MODEL_NAME, "prompt": prompt, "stream": False})
-                ai_recommendations = json.loads(re.search(r'\[.*\]', response.json().get('response', '[]'), re.DOTALL).group(0))
+            response = await llm_client.generate(prompt, timeout='medium')
+            ai_recommendations = json.loads(re.search(r'\[.*\]', response.json().get('response', '[]'), re.DOTALL).group(0))
         except:
             ai_recommendations = [{"headline": "AI Analysis Pending", "rationale": "Processing market metrics.", "recommendation": "Review news manually."}]
         
@@ -1506,7 +1536,7 @@ async def get_project_intelligence(project_id: str, user_id: str = Depends(get_c
     except Exception:
         raise HTTPException(status_code=500, detail="Could not fetch project intelligence")
 
-@router.get("/api/projects/{project_id}/insights/industry")
+@router.get("/api/projects/{project_id}/insights/industry", dependencies=[Depends(wait_for_rag)])
 @cached(request_type="ai_heavy")
 async def get_industry_updates(project_id: str, user_id: str = Depends(get_current_user_id)):
     try:
@@ -1519,13 +1549,12 @@ async def get_industry_updates(project_id: str, user_id: str = Depends(get_curre
         sector = industry.get('sector', 'Unknown')
         sub_sector = industry.get('sub_sector', 'Unknown')
 
-        rag_context_chunks = rag_system.search(f"Current M&A trends, growth projections, and key challenges for the '{sector}' sector in India.", k=3)
+        rag_context_chunks = await rag_system.asearch(f"Current M&A trends, growth projections, and key challenges for the '{sector}' sector in India.", k=3)
         context_text = "\n\n---\n\n".join([c['content'] for c in rag_context_chunks])
         
         prompt = f"Instruction: Analyze sector trends. Context:\n{context_text}\nSector: {sector}\nResponse:"
-        async with httpx.AsyncClient(timeout=90.0) as client:
-            response = await client.post(OLLAMA_SERVER_URL, json={"model": CUSTOM_MODEL_NAME, "prompt": prompt, "stream": False})
-            market_trends = response.json().get('response', 'AI analysis unavailable.').strip()
+        response = await llm_client.generate(prompt, timeout='medium', cache=True)
+        market_trends = response.json().get('response', 'AI analysis unavailable.').strip()
 
         events_res = supabase.table('events').select('*').limit(20).execute()
         industry_news = [{"id": str(e['id']), "title": e['summary'], "source": e.get('source_url', 'Internal'), "timestamp": str(e['event_date'])} for e in events_res.data if sector.lower() in e['summary'].lower()]
@@ -1534,7 +1563,7 @@ async def get_industry_updates(project_id: str, user_id: str = Depends(get_curre
     except Exception:
         raise HTTPException(status_code=500, detail="Could not fetch industry updates")
 
-@router.get("/api/projects/{project_id}/ai_summary")
+@router.get("/api/projects/{project_id}/ai_summary", dependencies=[Depends(wait_for_rag)])
 @cached(request_type="ai_heavy")
 async def get_project_ai_summary(project_id: str, user_id: str = Depends(get_current_user_id)):
     try:
@@ -1550,15 +1579,14 @@ async def get_project_ai_summary(project_id: str, user_id: str = Depends(get_cur
         events_res = supabase.table('events').select('summary').eq('company_cin', target_cin).in_('severity', ['Critical', 'High']).gte('event_date', thirty_days_ago).order('event_date', desc=True).limit(3).execute()
         recent_events = [event['summary'] for event in events_res.data]
 
-        rag_context_chunks = rag_system.search(f"Find the most important strengths, weaknesses, opportunities, and threats for {target_name}", k=5)
+        rag_context_chunks = await rag_system.asearch(f"Find the most important strengths, weaknesses, opportunities, and threats for {target_name}", k=5)
         rag_context = "\n\n---\n\n".join([chunk['content'] for chunk in rag_context_chunks])
 
         briefing = f"Profile: {json.dumps(company.get('financial_summary'))}\nEvents: {json.dumps(recent_events)}\nContext: {rag_context}"
         prompt = f"Instruction: Write a JSON summary for acquisition. structure: {{\"executiveSummary\": \"...\", \"keyStrengths\": [\"...\"], \"keyRisks\": [\"...\"]}}. Context: {briefing}\nResponse:"
         
-        async with httpx.AsyncClient(timeout=180.0) as client:
-            response = await client.post(OLLAMA_SERVER_URL, json={"model": CUSTOM_MODEL_NAME, "prompt": prompt, "stream": False})
-            response.raise_for_status()
+        response = await llm_client.generate(prompt, timeout='long')
+        response.raise_for_status()
         
         ai_response_text = response.json().get('response', '{}')
         cleaned_json_text = re.search(r'\{.*\}', ai_response_text, re.DOTALL).group(0)
@@ -1596,9 +1624,8 @@ async def save_chat_history(session_data: ChatSession, user_id: str = Depends(ge
     try:
         conversation_text = "\n".join([f"{msg['role']}: {msg['content']}" for msg in messages])
         prompt = f"Instruction: Summarize the conversation in 5 words or less to use as a title: {conversation_text}"
-        async with httpx.AsyncClient() as client:
-            response = await client.post(OLLAMA_SERVER_URL, json={"model": CUSTOM_MODEL_NAME, "prompt": prompt, "stream": False}, timeout=30.0)
-            title = response.json().get('response', 'New Chat Session').strip().replace('"', '') if response.status_code == 200 else "New Chat Session"
+        response = await llm_client.generate(prompt, timeout='quick', cache=True)
+        title = response.json().get('response', 'New Chat Session').strip().replace('"', '') if response.status_code == 200 else "New Chat Session"
 
         result = supabase.table('chat_conversations').insert({'user_id': user_id, 'project_id': project_id, 'title': title, 'messages': messages}).execute()
         return result.data[0]
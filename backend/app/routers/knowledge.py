@@ -2,17 +2,24 @@ import os
 import uuid
 import shutil
 import json
-import httpx
+import time
 from datetime import datetime
 from pathlib import Path
 from typing import Optional, List, Dict
 from fastapi import APIRouter, HTTPException, Depends, UploadFile, File, Form, BackgroundTasks
 from fastapi.responses import FileResponse
 from pydantic import BaseModel
-from app.core.config import supabase, OLLAMA_SERVER_URL, CUSTOM_MODEL_NAME
+from app.core.config import supabase
 from app.core.security import get_current_user_id
 from app.core.cache_decorator import cached
+from app.core.llm_client import llm_client
+from app.core.llm_scheduler import LLMOverloadedError
+from app.core.streaming_cache import streaming_cache
+from app.core.semantic_cache import semantic_cache
 from rag_pipeline import rag_system
+from rag_keyword import highlight_excerpt
+from app.core.rag_readiness import require_rag_ready, wait_for_rag
+from app.services.ingestion import submit_ingestion, remove_document_vectors
 
 
 router = APIRouter(tags=["Virtual Data Room (VDR)"])
@@ -24,7 +31,7 @@ class DocumentCreate(BaseModel):
 
 class VdrSearchQuery(BaseModel):
     query: str
-    mode: str  # 'semantic' or 'fulltext'
+    mode: str  # 'semantic' (hybrid dense + keyword) or 'fulltext'
 
 class VDRQuery(BaseModel):
     question: str
@@ -127,7 +134,7 @@ async def upload_document(
             'uploaded_by_user_id': user_id,
             'file_path': str(file_path),
             'category': category,
-            'analysis_status': 'Success',
+            'analysis_status': 'Pending',
             'file_size': os.path.getsize(file_path),
             'mime_type': file.content_type
         }
@@ -135,7 +142,7 @@ async def upload_document(
         result = supabase.table('knowledge_library_documents').insert(insert_data).execute()
         
         # Trigger ingestion asynchronously
-        background_tasks.add_task(rag_system.ingest_document, str(file_path), original_filename)
+        submit_ingestion(background_tasks, 'knowledge_library_documents', result.data[0]['id'], str(file_path), original_filename)
         
         return result.data[0]
         
@@ -252,7 +259,7 @@ async def get_documents_by_category( category: str, user_id: str = Depends(get_c
         return []
 
 @router.delete("/api/knowledge/documents/{document_id}")
-async def delete_document(document_id: str, user_id: str = Depends(get_current_user_id)):
+async def delete_document(document_id: str, background_tasks: BackgroundTasks, user_id: str = Depends(get_current_user_id)):
     """Delete a VDR document metadata and file."""
     try:
         result = supabase.table('knowledge_library_documents').select('*').eq('id', document_id).execute()
@@ -268,6 +275,9 @@ async def delete_document(document_id: str, user_id: str = Depends(get_current_u
         if os.path.exists(document['file_path']):
             os.remove(document['file_path'])
         
+        # Drop the document's chunks from the RAG index unless another document shares its file name
+        background_tasks.add_task(remove_document_vectors, document['file_name'])
+        
         return {"message": "Document deleted successfully"}
         
     except HTTPException:
@@ -276,6 +286,31 @@ async def delete_document(document_id: str, user_id: str = Depends(get_current_u
         print(f"Error deleting document: {e}")
         raise HTTPException(status_code=500, detail="Could not delete document")
 
+@router.post("/api/knowledge/documents/{document_id}/reingest")
+async def reingest_document(document_id: str, background_tasks: BackgroundTasks, user_id: str = Depends(get_current_user_id)):
+    """Re-ingest a document, replacing its chunks in the RAG index."""
+    try:
+        result = supabase.table('knowledge_library_documents').select('*').eq('id', document_id).execute()
+        if not result.data:
+            raise HTTPException(status_code=404, detail="Document not found")
+        
+        document = result.data[0]
+        if document['uploaded_by_user_id'] != user_id:
+            raise HTTPException(status_code=403, detail="Not authorized to re-ingest this document")
+        if not os.path.exists(document['file_path']):
+            raise HTTPException(status_code=404, detail="File not found")
+        
+        supabase.table('knowledge_library_documents').update({'analysis_status': 'Pending'}).eq('id', document_id).execute()
+        submit_ingestion(background_tasks, 'knowledge_library_documents', document_id, document['file_path'], document['file_name'], replace=True)
+        
+        return {"message": "Document queued for re-ingestion"}
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Error re-ingesting document: {e}")
+        raise HTTPException(status_code=500, detail="Could not re-ingest document")
+
 @router.get("/api/knowledge/documents/{document_id}/preview")
 async def preview_document(document_id: str, user_id: str = Depends(get_current_user_id)):
     """Get document content text for preview."""
@@ -304,7 +339,7 @@ async def preview_document(document_id: str, user_id: str = Depends(get_current_
         print(f"Error previewing document: {e}")
         raise HTTPException(status_code=500, detail=f"Could not preview document: {str(e)}")
 
-@router.post("/api/knowledge/search")
+@router.post("/api/knowledge/search", dependencies=[Depends(require_rag_ready)])
 async def vdr_search( search_query: VdrSearchQuery, user_id: str = Depends(get_current_user_id)):
     """Performs a search scoped ONLY to the documents within a specific project's VDR."""
     try:
@@ -316,43 +351,27 @@ async def vdr_search( search_query: VdrSearchQuery, user_id: str = Depends(get_c
             return []
 
         if search_query.mode == 'semantic':
-            context_chunks = rag_system.search(search_query.query, k=10, allowed_sources=allowed_filenames)
+            context_chunks = await rag_system.ahybrid_search(search_query.query, k=10, allowed_sources=allowed_filenames, tenant=f"user:{user_id}")
             results = []
             import re
             for chunk in context_chunks:
                 highlighted_excerpt = re.sub(f"(?i)({re.escape(search_query.query)})", r"<mark>\1</mark>", chunk['content'])
                 doc_id = filename_to_id.get(chunk['source'])
-                results.append({ "id": doc_id, "docName": chunk['source'], "excerpt": f"...{highlighted_excerpt}..." })
+                results.append({ "id": doc_id, "docName": chunk['source'], "excerpt": f"...{highlighted_excerpt}...", "page": chunk.get('page') })
             
-            # Fail-safe: if semantic post-filtering crowded out our results but the word actually exists!
+            # Fail-safe: if semantic search found nothing, fall back to the keyword index.
             if not results:
-                query_lower = search_query.query.lower()
-                for chunk in rag_system.chunk_map:
-                    if chunk['source'] in allowed_filenames and query_lower in chunk['content'].lower():
-                        idx = chunk['content'].lower().find(query_lower)
-                        start = max(0, idx - 40)
-                        end = min(len(chunk['content']), idx + len(query_lower) + 40)
-                        highlighted_excerpt = re.sub(f"(?i)({re.escape(search_query.query)})", r"<mark>\1</mark>", chunk['content'][start:end])
-                        results.append({ "id": filename_to_id.get(chunk['source']), "docName": chunk['source'], "excerpt": f"...{highlighted_excerpt}..." })
-                        if len(results) >= 10: break
+                for chunk in await rag_system.akeyword_search(search_query.query, k=10, allowed_sources=allowed_filenames):
+                    highlighted_excerpt = highlight_excerpt(chunk['content'], search_query.query)
+                    results.append({ "id": filename_to_id.get(chunk['source']), "docName": chunk['source'], "excerpt": f"...{highlighted_excerpt}...", "page": chunk.get('page') })
                         
             return results
         else:
             results = []
-            query_lower = search_query.query.lower()
-            import re
-            for chunk in rag_system.chunk_map:
-                if chunk['source'] in allowed_filenames:
-                    if query_lower in chunk['content'].lower():
-                        idx = chunk['content'].lower().find(query_lower)
-                        start = max(0, idx - 40)
-                        end = min(len(chunk['content']), idx + len(query_lower) + 40)
-                        excerpt_raw = chunk['content'][start:end]
-                        highlighted_excerpt = re.sub(f"(?i)({re.escape(search_query.query)})", r"<mark>\1</mark>", excerpt_raw)
-                        doc_id = filename_to_id.get(chunk['source'])
-                        results.append({ "id": doc_id, "docName": chunk['source'], "excerpt": f"...{highlighted_excerpt}..." })
-                        if len(results) >= 10:
-                            break
+            for chunk in await rag_system.akeyword_search(search_query.query, k=10, allowed_sources=allowed_filenames):
+                highlighted_excerpt = highlight_excerpt(chunk['content'], search_query.query)
+                doc_id = filename_to_id.get(chunk['source'])
+                results.append({ "id": doc_id, "docName": chunk['source'], "excerpt": f"...{highlighted_excerpt}...", "page": chunk.get('page') })
             
             if not results:
                 fulltext_res = supabase.table('knowledge_library_documents').select('id, file_name').eq('uploaded_by_user_id', user_id).ilike('file_name', f"%{search_query.query}%").limit(10).execute()
@@ -378,48 +397,77 @@ async def get_vdr_chat_history( user_id: str = Depends(get_current_user_id)):
             print(f"Error fetching VDR chat: {e}")
         return {"id": None, "messages": []}
 
-@router.post("/api/knowledge/qa")
-async def vdr_qa_and_save( query: VDRQuery, user_id: str = Depends(get_current_user_id)):
-    """Perform Q&A scoped to this project's VDR, saving the interaction."""
-    try:
-        docs_res = supabase.table('knowledge_library_documents').select('id, file_name').execute()
-        filename_to_id_map = {doc['file_name']: doc['id'] for doc in docs_res.data}
-        allowed_filenames = list(filename_to_id_map.keys())
-        context_chunks = rag_system.search(query.question, k=5, allowed_sources=allowed_filenames)
-        
-        context_text = "No relevant context found."
-        sources = []
-        if context_chunks:
-            context_text = "\n\n---\n\n".join([f"From '{c['source']}':\n{c['content']}" for c in context_chunks])
-            sources = [{"docId": filename_to_id_map.get(c['source']), "docName": c['source'], "excerpt": c['content']} for c in context_chunks]
+async def build_vdr_qa_prompt(question: str):
+    """Retrieves knowledge library excerpts for a question; returns (prompt, cited sources)."""
+    docs_res = supabase.table('knowledge_library_documents').select('id, file_name').execute()
+    filename_to_id_map = {doc['file_name']: doc['id'] for doc in docs_res.data}
+    allowed_filenames = list(filename_to_id_map.keys())
+    context_chunks = await rag_system.ahybrid_search(question, k=4, allowed_sources=allowed_filenames, tenant="library")
+    
+    context_text = "No relevant context found."
+    sources = []
+    if context_chunks:
+        context_text = "\n\n---\n\n".join([f"From '{c['source']}':\n{c['content']}" for c in context_chunks])
+        sources = [{"docId": filename_to_id_map.get(c['source']), "docName": c['source'], "excerpt": c['content'], "page": c.get('page')} for c in context_chunks]
 
-        prompt = f"""Instruction: You are an AI paralegal assistant examining a Virtual Data Room for the target company. Use the provided VDR excerpts to answer the human's question professionally, with citations where possible. If you don't know the answer, say you don't know.
+    prompt = f"""Instruction: You are an AI paralegal assistant examining a Virtual Data Room for the target company. Use the provided VDR excerpts to answer the human's question professionally, with citations where possible. If you don't know the answer, say you don't know.
 
 Context:
 {context_text}
 
-Question: {query.question}
+Question: {question}
 
 Answer:"""
+    return prompt, sources
+
+def save_vdr_qa(user_id: str, query: VDRQuery, final_answer: str, sources: List[Dict]) -> Dict:
+    """Saves the Q&A to the user's library session and returns the assistant message."""
+    assistant_message = {"role": "assistant", "content": final_answer, "sources": sources}
+    updated_messages = query.existing_messages + [{"role": "user", "content": query.question}, assistant_message]
+    
+    supabase.table('vdr_qa_sessions').upsert({
         
-        async with httpx.AsyncClient(timeout=120.0) as client:
-            response = await client.post(OLLAMA_SERVER_URL, json={"model": CUSTOM_MODEL_NAME, "prompt": prompt, "stream": False})
-        
-        final_answer = response.json().get('response', 'Error generating response.').strip()
-        assistant_message = {"role": "assistant", "content": final_answer, "sources": sources}
-        updated_messages = query.existing_messages + [{"role": "user", "content": query.question}, assistant_message]
-        
-        supabase.table('vdr_qa_sessions').upsert({
-            
-            'user_id': user_id,
-            'messages': json.dumps(updated_messages)
-        }, on_conflict='user_id').execute()
+        'user_id': user_id,
+        'messages': json.dumps(updated_messages)
+    }, on_conflict='user_id').execute()
+    
+    return assistant_message
+
+@router.post("/api/knowledge/qa", dependencies=[Depends(require_rag_ready)])
+async def vdr_qa_and_save( query: VDRQuery, user_id: str = Depends(get_current_user_id)):
+    """Perform Q&A scoped to this project's VDR, saving the interaction."""
+    try:
+        prompt, sources = await build_vdr_qa_prompt(query.question)
         
-        return assistant_message
+        async def generate() -> str:
+            response = await llm_client.generate(prompt, timeout='standard', priority='interactive')
+            response.raise_for_status()
+            return response.json().get('response', '').strip()
+
+        final_answer = await semantic_cache.answer("library", "library_qa", query.question,
+                                                   [source['excerpt'] for source in sources], generate)
+        final_answer = final_answer or 'Error generating response.'
+        return save_vdr_qa(user_id, query, final_answer, sources)
+    except LLMOverloadedError as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(e.retry_after)})
     except Exception as e:
         print(f"VDR QA failed: {e}")
         raise HTTPException(status_code=500, detail="VDR Q&A process failed.")
 
+@router.post("/api/knowledge/qa/stream", dependencies=[Depends(require_rag_ready)])
+async def stream_vdr_qa_and_save(query: VDRQuery, user_id: str = Depends(get_current_user_id)):
+    """Streaming knowledge library Q&A: NDJSON sources, then tokens as they arrive; saved once the answer is complete."""
+    started = time.perf_counter()
+    prompt, sources = await build_vdr_qa_prompt(query.question)
+
+    async def save(final_answer: str) -> Dict:
+        return save_vdr_qa(user_id, query, final_answer.strip() or 'Error generating response.', sources)
+
+    return streaming_cache.response(streaming_cache.stream_with_cache(
+        None, semantic_cache.stream, "library", "library_qa", query.question, [source['excerpt'] for source in sources],
+        llm_client.stream, prompt, timeout='standard', priority='interactive',
+        prelude=[{"type": "sources", "data": sources}], on_complete=save, started=started))
+
 
 class AnnotationCreate(BaseModel):
     document_id: str
@@ -699,7 +747,7 @@ async def delete_annotation(annotation_id: str, user_id: str = Depends(get_curre
         raise HTTPException(status_code=500, detail=f"Could not delete annotation: {e}")
 
 
-@router.get("/api/documents/{document_id}/ai_annotations")
+@router.get("/api/documents/{document_id}/ai_annotations", dependencies=[Depends(wait_for_rag)])
 @cached(request_type="ai_heavy")
 async def get_ai_annotation_suggestions(document_id: str, user_id: str = Depends(get_current_user_id)):
     """Uses AI to suggest potential annotations for important clauses."""
@@ -709,7 +757,7 @@ async def get_ai_annotation_suggestions(document_id: str, user_id: str = Depends
             raise HTTPException(status_code=404, detail="Document not found")
         
         document_content = f"Document: {doc_res.data['file_name']}"
-        rag_context = rag_system.search("important clauses legal terms risks liabilities obligations", k=5)
+        rag_context = await rag_system.asearch("important clauses legal terms risks liabilities obligations", k=5)
         context_text = "\n\n".join([chunk['content'] for chunk in rag_context])
         
         prompt = f"""Instruction: Analyze this document and identify 3-5 key clauses that should be annotated for legal review. For each, provide: the exact text snippet, why it's important, and a suggested comment. Respond with JSON: {{"suggestions": [{{"text": "exact text", "importance": "high/medium", "suggestedComment": "comment"}}]}}
@@ -719,14 +767,9 @@ Related Clauses: {context_text}
 
 Response:"""
         
-        async with httpx.AsyncClient(timeout=60.0) as client:
-            response = await client.post(OLLAMA_SERVER_URL, json={
-                "model": CUSTOM_MODEL_NAME, 
-                "prompt": prompt, 
-                "stream": False
-            })
-            response.raise_for_status()
-            
+        response = await llm_client.generate(prompt, timeout='short')
+        response.raise_for_status()
+
         ai_response = response.json().get('response', '{}')
         suggestions = json.loads(ai_response)
         return suggestions.get('suggestions', [])
@@ -0,0 +1,156 @@
+import os
+import threading
+import time
+from typing import Optional, Dict
+from app.core.config import supabase
+from rag_pipeline import rag_system
+from rag_ingest_queue import IngestQueue, run_worker
+
+# 'queue' hands uploads to the durable ingestion queue; 'inline' ingests in the API process.
+INGEST_MODE = os.getenv('RAG_INGEST_MODE', 'queue').lower()
+# Queue workers running inside the API process. Ingestion normally runs in separate
+# `python rag_ingest_queue.py worker` processes so it does not compete with API
+# requests; set to 1 for a single-process dev setup without a worker.
+INPROCESS_WORKERS = int(os.getenv('RAG_INGEST_INPROCESS_WORKERS', '0'))
+# Minimum seconds between analysis_status progress writes for one document.
+PROGRESS_UPDATE_INTERVAL = 2.0
+# How often the API applies segments written by workers and syncs job status.
+MONITOR_INTERVAL = float(os.getenv('RAG_INGEST_MONITOR_SECONDS', '2'))
+# Document tables whose rows are ingested under their file_name as the RAG source.
+DOCUMENT_TABLES = ('vdr_documents', 'knowledge_library_documents')
+
+ingest_queue = IngestQueue()
+
+
+def _set_status(table: str, document_id: str, status: str):
+    try:
+        supabase.table(table).update({'analysis_status': status}).eq('id', document_id).execute()
+    except Exception as e:
+        print(f"⚠️ Could not update analysis_status for {document_id}: {e}")
+
+
+def _progress_status(state: Optional[Dict]) -> str:
+    if not state:
+        return 'Processing'
+    if state.get('units_total'):
+        return f"Processing ({state['units_done']}/{state['units_total']})"
+    return f"Processing ({state['chunks']} chunks)"
+
+
+def job_status(job: Dict) -> str:
+    """The analysis_status shown for a queue job (duplicates mirror the job they point to)."""
+    job = ingest_queue.resolve(job)
+    if job['status'] == 'queued':
+        return 'Pending' if job['attempts'] == 0 else f"Retrying (attempt {job['attempts'] + 1})"
+    if job['status'] == 'running':
+        return _progress_status(job['progress'])
+    if job['status'] == 'done':
+        return 'Success' if job['chunks'] else 'No Text Found'
+    if job['status'] == 'removed':
+        return 'Removed'
+    return 'Failed'
+
+
+def ingest_with_progress(table: str, document_id: str, file_path: str, file_name: str, replace: bool = False):
+    """
+    Background task for uploads: streams the document into the RAG index and
+    mirrors its progress in the document row's analysis_status
+    ('Processing (12/240)' -> 'Success' / 'No Text Found' / 'Failed').
+    """
+    last_update = 0.0
+
+    def report(state):
+        nonlocal last_update
+        now = time.time()
+        if now - last_update < PROGRESS_UPDATE_INTERVAL:
+            return
+        last_update = now
+        _set_status(table, document_id, _progress_status(state))
+
+    _set_status(table, document_id, 'Processing')
+    chunks = rag_system.ingest_document(file_path, file_name, progress=report, replace=replace)
+    if chunks is None:
+        _set_status(table, document_id, 'Failed')
+    else:
+        _set_status(table, document_id, 'Success' if chunks else 'No Text Found')
+
+
+def submit_ingestion(background_tasks, table: str, document_id: str, file_path: str, file_name: str,
+                     replace: bool = False) -> Optional[Dict]:
+    """
+    Routes an upload to the ingestion queue (or inline background task). Returns the queue job, if any.
+    replace=True re-ingests the file, replacing the chunks already indexed under its name.
+    """
+    if INGEST_MODE != 'queue':
+        background_tasks.add_task(ingest_with_progress, table, document_id, file_path, file_name, replace)
+        return None
+    job = ingest_queue.enqueue(table, document_id, file_path, file_name, replace=replace)
+    if job['status'] == 'duplicate':
+        print(f"[OK] {file_name} is identical to ingest job {job['duplicate_of']}; skipping re-embedding.")
+    return job
+
+
+def remove_document_vectors(file_name: str):
+    """
+    Background task for document deletion: drops the file's chunks from the RAG
+    index once no remaining VDR or knowledge document is stored under that name.
+    """
+    try:
+        for table in DOCUMENT_TABLES:
+            if supabase.table(table).select('id').eq('file_name', file_name).limit(1).execute().data:
+                print(f"[OK] Keeping indexed chunks of {file_name}: another document still uses them.")
+                return
+    except Exception as e:
+        print(f"⚠️ Could not check remaining documents for {file_name}; keeping its chunks: {e}")
+        return
+    ingest_queue.forget_source(file_name)
+    rag_system.remove_source(file_name)
+
+
+class IngestionMonitor:
+    """
+    Runs in the API process: applies delta segments written by ingestion
+    workers to the live index and copies job state into analysis_status.
+    """
+    def __init__(self):
+        self._stop = threading.Event()
+        self._threads = []
+        self._synced_until = time.time() - 3600
+
+    def start(self):
+        if self._threads:
+            return
+        self._threads.append(threading.Thread(target=self._loop, name='ingest-monitor', daemon=True))
+        if INGEST_MODE == 'queue':
+            for i in range(INPROCESS_WORKERS):
+                self._threads.append(threading.Thread(target=self._worker, args=(i,), name=f'ingest-worker-{i}', daemon=True))
+        for thread in self._threads:
+            thread.start()
+        print(f"✅ Ingestion monitor started ({INGEST_MODE} mode, {INPROCESS_WORKERS} in-process worker(s))")
+
+    def stop(self):
+        self._stop.set()
+
+    def _worker(self, index: int):
+        if rag_system.wait_ready(timeout=None):
+            run_worker(rag_system, ingest_queue, f"api-{os.getpid()}-{index}", self._stop)
+
+    def _loop(self):
+        while not self._stop.wait(MONITOR_INTERVAL):
+            try:
+                rag_system.refresh()
+                self._sync_statuses()
+            except Exception as e:
+                print(f"⚠️ Ingestion monitor error: {e}")
+
+    def _sync_statuses(self):
+        changed = ingest_queue.changed_since(self._synced_until)
+        for job in changed:
+            _set_status(job['doc_table'], job['document_id'], job_status(job))
+            for duplicate in ingest_queue.dependents(job['id']):
+                _set_status(duplicate['doc_table'], duplicate['document_id'], job_status(duplicate))
+        if changed:
+            self._synced_until = changed[-1]['updated_at']
+
+
+ingestion_monitor = IngestionMonitor()
@@ -1,10 +1,10 @@
 import os
-import httpx
 import asyncio
 import numpy as np
 import yfinance as yf
 from typing import Optional, List, Dict
-from app.core.config import supabase, OLLAMA_SERVER_URL, CUSTOM_MODEL_NAME
+from app.core.config import supabase
+from app.core.llm_client import llm_client
 from rag_pipeline import rag_system
 
 class LiveMarketData:
@@ -176,16 +176,16 @@ class LiveMarketData:
 
 market_data = LiveMarketData()
 
-async def generate_sector_trend(client: httpx.AsyncClient, sector: str) -> Dict:
+async def generate_sector_trend(sector: str) -> Dict:
     """Uses RAG and the LLM to generate a trend summary for a single sector."""
     try:
         # Find relevant context for this sector from our document library
-        rag_context = rag_system.search(f"What are the recent trends, challenges, and opportunities in the {sector} sector in India?", k=3)
+        rag_context = await rag_system.asearch(f"What are the recent trends, challenges, and opportunities in the {sector} sector in India?", k=3)
         context_text = "\n\n---\n\n".join([chunk['content'] for chunk in rag_context])
         
         prompt = f"Instruction: You are a senior market analyst. Based on the provided context, write a concise, one-sentence summary of the current trend for the {sector} sector.\n\nContext:\n{context_text}\n\nResponse:"
         
-        response = await client.post(OLLAMA_SERVER_URL, json={"model": CUSTOM_MODEL_NAME, "prompt": prompt, "stream": False}, timeout=60.0)
+        response = await llm_client.generate(prompt, timeout='short', cache=True)
         response.raise_for_status()
         
         trend = response.json().get('response', f'Analysis for {sector} is ongoing.').strip()
@@ -0,0 +1,249 @@
+"""
+Approximate-nearest-neighbour tiers for the RAG index.
+
+The exact flat index stays the source of truth (filtered searches, compaction
+and per-source sub-indexes read from it). On top of it an optional ANN index
+serves unfiltered top-k searches once the corpus is large enough:
+
+    flat   exact brute force             (small corpora)
+    hnsw   IndexHNSWFlat graph           (mid-sized corpora, high recall)
+    ivfpq  IVF coarse quantizer + PQ     (very large corpora, compact codes)
+
+The exact index and the HNSW graph can store vectors as float32 or, with
+RAG_VECTOR_STORAGE, as float16 / int8 scalar-quantized codes (2x / 4x smaller);
+`report --storages` measures what that costs in recall.
+
+Usage:
+    python rag_ann.py rebuild [--tier auto|flat|hnsw|ivfpq]
+    python rag_ann.py report [--queries 200] [--k 10] [--tiers hnsw,ivfpq] [--storages float16,int8]
+"""
+import argparse
+import os
+import time
+from typing import Optional, Dict
+
+import faiss
+import numpy as np
+
+# --- CONFIGURATION ---
+# 'auto' picks a tier from the corpus size; any tier name forces it.
+ANN_TIER = os.getenv('RAG_ANN_TIER', 'auto').lower()
+ANN_HNSW_MIN_ROWS = int(os.getenv('RAG_ANN_HNSW_MIN_ROWS', '50000'))
+ANN_IVFPQ_MIN_ROWS = int(os.getenv('RAG_ANN_IVFPQ_MIN_ROWS', '1000000'))
+HNSW_M = int(os.getenv('RAG_ANN_HNSW_M', '32'))
+HNSW_EF_CONSTRUCTION = int(os.getenv('RAG_ANN_HNSW_EF_CONSTRUCTION', '80'))
+HNSW_EF_SEARCH = int(os.getenv('RAG_ANN_HNSW_EF_SEARCH', '64'))
+IVF_NPROBE = int(os.getenv('RAG_ANN_NPROBE', '16'))
+PQ_NBITS = 8
+# An IVF-PQ index is retrained once the corpus has grown this much past its training set.
+IVF_RETRAIN_GROWTH = 4.0
+TIERS = ('flat', 'hnsw', 'ivfpq')
+# Vector storage of the exact index and HNSW graph. Existing indexes are converted at the next compaction.
+VECTOR_STORAGE = os.getenv('RAG_VECTOR_STORAGE', 'float32').lower()
+STORAGES = {
+    'float32': None,
+    'float16': faiss.ScalarQuantizer.QT_fp16,
+    'int8': faiss.ScalarQuantizer.QT_8bit,
+}
+# Vectors sampled to learn the int8 value ranges.
+SQ_TRAIN_SAMPLE = 100000
+
+
+def _training_sample(vectors: np.ndarray, size: int) -> np.ndarray:
+    if len(vectors) <= size:
+        return vectors
+    return vectors[np.random.RandomState(0).choice(len(vectors), size, replace=False)]
+
+
+def storage_of(index: faiss.Index) -> str:
+    """'float32', 'float16' or 'int8' for an exact index."""
+    if isinstance(index, faiss.IndexScalarQuantizer):
+        for name, qtype in STORAGES.items():
+            if qtype is not None and index.sq.qtype == qtype:
+                return name
+        return 'sq'
+    return 'float32'
+
+
+def new_exact_index(vectors: np.ndarray, metric: int, storage: str = VECTOR_STORAGE) -> faiss.Index:
+    """Exact (brute-force) index over vectors in the requested storage."""
+    d = vectors.shape[1]
+    qtype = STORAGES.get(storage)
+    if qtype is None or (qtype == faiss.ScalarQuantizer.QT_8bit and len(vectors) == 0):
+        # int8 ranges need data to learn from; start in float32 and convert once vectors exist.
+        index = faiss.IndexFlat(d, metric)
+    else:
+        index = faiss.IndexScalarQuantizer(d, qtype, metric)
+        if not index.is_trained:
+            index.train(_training_sample(vectors, SQ_TRAIN_SAMPLE))
+    if len(vectors):
+        index.add(vectors)
+    return index
+
+
+def choose_tier(rows: int, forced: str = ANN_TIER) -> str:
+    if forced in TIERS:
+        return forced
+    if rows >= ANN_IVFPQ_MIN_ROWS:
+        return 'ivfpq'
+    if rows >= ANN_HNSW_MIN_ROWS:
+        return 'hnsw'
+    return 'flat'
+
+
+def _pq_subquantizers(d: int) -> int:
+    """Largest sub-quantizer count <= d / 8 that divides d (e.g. 48 for 384-dim bge-small)."""
+    for m in range(max(1, d // 8), 0, -1):
+        if d % m == 0:
+            return m
+    return 1
+
+
+def build_index(vectors: np.ndarray, metric: int, tier: str) -> Optional[faiss.Index]:
+    """Builds the ANN index for a tier over vectors whose row ids match the flat index. 'flat' needs none."""
+    n, d = vectors.shape
+    if tier == 'flat' or n == 0:
+        return None
+    if tier == 'hnsw':
+        qtype = STORAGES.get(VECTOR_STORAGE)
+        if qtype is None:
+            index = faiss.IndexHNSWFlat(d, HNSW_M, metric)
+        else:
+            index = faiss.IndexHNSWSQ(d, qtype, HNSW_M, metric)
+            index.train(_training_sample(vectors, SQ_TRAIN_SAMPLE))
+        index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+    elif tier == 'ivfpq':
+        nlist = int(min(max(16, 4 * np.sqrt(n)), n // 39 or 1))
+        quantizer = faiss.IndexFlat(d, metric)
+        index = faiss.IndexIVFPQ(quantizer, d, nlist, _pq_subquantizers(d), PQ_NBITS, metric)
+        # k-means needs ~39 points per centroid; more adds little but training time.
+        index.train(_training_sample(vectors, nlist * 256))
+    else:
+        raise ValueError(f"Unknown ANN tier '{tier}'")
+    index.add(vectors)
+    configure(index)
+    return index
+
+
+def configure(index: faiss.Index):
+    """Applies the search-time knobs, which are not stored in serialized indexes."""
+    if isinstance(index, faiss.IndexHNSW):
+        index.hnsw.efSearch = HNSW_EF_SEARCH
+    else:
+        try:
+            faiss.extract_index_ivf(index).nprobe = IVF_NPROBE
+        except RuntimeError:
+            pass
+
+
+def tier_of(index: Optional[faiss.Index]) -> str:
+    if index is None:
+        return 'flat'
+    return 'hnsw' if isinstance(index, faiss.IndexHNSW) else 'ivfpq'
+
+
+def needs_rebuild(ann_index: Optional[faiss.Index], trained_rows: int, rows: int, forced: str = ANN_TIER) -> bool:
+    """True when the corpus size (or a forced tier) calls for a different tier or an IVF index has outgrown its training."""
+    tier = choose_tier(rows, forced)
+    if tier != tier_of(ann_index):
+        return True
+    return tier == 'ivfpq' and rows > trained_rows * IVF_RETRAIN_GROWTH
+
+
+def all_vectors(index: faiss.Index) -> np.ndarray:
+    return index.reconstruct_n(0, index.ntotal)
+
+
+def recall_report(flat_index: faiss.Index, tiers, queries: int = 200, k: int = 10, storages=()) -> Dict[str, Dict]:
+    """
+    Measures recall@k, per-query latency and serialized size of each ANN tier
+    and each compact exact-index storage against exact float32 search.
+    Queries are perturbed copies of random corpus vectors, so no model is needed.
+    """
+    vectors = all_vectors(flat_index)
+    rng = np.random.RandomState(42)
+    picks = rng.choice(len(vectors), min(queries, len(vectors)), replace=False)
+    query_vectors = vectors[picks] + rng.normal(0, 0.01, (len(picks), vectors.shape[1])).astype('float32')
+
+    def timed(index):
+        started = time.perf_counter()
+        latencies = []
+        results = []
+        for q in query_vectors:
+            t = time.perf_counter()
+            _, ids = index.search(q.reshape(1, -1), k)
+            latencies.append((time.perf_counter() - t) * 1000)
+            results.append(ids[0])
+        return np.array(results), latencies, time.perf_counter() - started
+
+    exact_index = new_exact_index(vectors, flat_index.metric_type, 'float32')
+    exact, exact_latencies, _ = timed(exact_index)
+    report = {'flat': {'recall': 1.0, 'p50_ms': float(np.percentile(exact_latencies, 50)),
+                       'p95_ms': float(np.percentile(exact_latencies, 95)), 'build_s': 0.0,
+                       'mb': faiss.serialize_index(exact_index).nbytes / 2 ** 20}}
+    candidates = [(tier, lambda tier=tier: build_index(vectors, flat_index.metric_type, tier))
+                  for tier in tiers if tier != 'flat']
+    candidates += [(f"flat-{storage}", lambda storage=storage: new_exact_index(vectors, flat_index.metric_type, storage))
+                   for storage in storages if storage != 'float32']
+    for name, build in candidates:
+        started = time.perf_counter()
+        index = build()
+        build_seconds = time.perf_counter() - started
+        configure(index)
+        found, latencies, _ = timed(index)
+        recall = np.mean([len(set(f) & set(e)) / k for f, e in zip(found, exact)])
+        report[name] = {'recall': float(recall), 'p50_ms': float(np.percentile(latencies, 50)),
+                        'p95_ms': float(np.percentile(latencies, 95)), 'build_s': build_seconds,
+                        'mb': faiss.serialize_index(index).nbytes / 2 ** 20}
+    return report
+
+
+def _load_base_index(store):
+    manifest = store.read_manifest()
+    if not manifest:
+        raise SystemExit("[ERROR] No compacted base generation found; ingest or compact first.")
+    index, _ = store.load_base(manifest)
+    return manifest, index
+
+
+def main():
+    from rag_segments import SegmentStore
+
+    parser = argparse.ArgumentParser(description="Build and evaluate ANN tiers for the RAG index.")
+    sub = parser.add_subparsers(dest='command', required=True)
+    rebuild = sub.add_parser('rebuild', help="Train/build the ANN index for the current base generation")
+    rebuild.add_argument('--tier', default=ANN_TIER, choices=('auto',) + TIERS,
+                         help="A named tier is kept by later compactions; 'auto' returns to RAG_ANN_TIER")
+    report = sub.add_parser('report', help="Recall-vs-latency of each tier against the exact index")
+    report.add_argument('--queries', type=int, default=200)
+    report.add_argument('--k', type=int, default=10)
+    report.add_argument('--tiers', default='hnsw,ivfpq')
+    report.add_argument('--storages', default='float16,int8', help="Compact exact-index storages to compare")
+    args = parser.parse_args()
+
+    store = SegmentStore()
+    manifest, flat_index = _load_base_index(store)
+
+    if args.command == 'rebuild':
+        tier = choose_tier(flat_index.ntotal, args.tier)
+        started = time.perf_counter()
+        ann_index = build_index(all_vectors(flat_index), flat_index.metric_type, tier)
+        ann = None if ann_index is None else (tier, faiss.serialize_index(ann_index).tobytes(), flat_index.ntotal)
+        forced = args.tier if args.tier in TIERS else None
+        if store.write_ann(manifest['generation'], ann, forced_tier=forced):
+            print(f"[OK] Built '{tier}' index over {flat_index.ntotal} vectors in {time.perf_counter() - started:.1f}s "
+                  f"for generation {manifest['generation']}. Serving workers pick it up at their next index refresh"
+                  + (f"; compactions keep the '{forced}' tier until `rebuild --tier auto`." if forced else "."))
+        else:
+            print("[WARN] A newer base generation was published while building; run rebuild again.")
+    else:
+        storages = [storage for storage in args.storages.split(',') if storage]
+        results = recall_report(flat_index, args.tiers.split(','), args.queries, args.k, storages)
+        print(f"{'index':<14}{'recall@' + str(args.k):>12}{'p50 ms':>10}{'p95 ms':>10}{'build s':>10}{'MB':>10}")
+        for name, row in results.items():
+            print(f"{name:<14}{row['recall']:>12.3f}{row['p50_ms']:>10.3f}{row['p95_ms']:>10.3f}"
+                  f"{row['build_s']:>10.1f}{row['mb']:>10.1f}")
+
+
+if __name__ == '__main__':
+    main()
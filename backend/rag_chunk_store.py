@@ -0,0 +1,254 @@
+import hashlib
+import json
+import mmap
+import os
+import shutil
+import uuid
+from typing import Optional, List, Dict, Iterable, Iterator
+
+import numpy as np
+
+OFFSETS_FILE = 'offsets.npy'
+TEXT_FILE = 'text.bin'
+SOURCE_IDS_FILE = 'source_ids.npy'
+SOURCES_FILE = 'sources.json'
+HASHES_FILE = 'hashes.npy'
+FILES_FILE = 'files.json'
+POSITIONS_FILE = 'positions.npy'
+HASH_BYTES = 16
+# Per-chunk location columns: first page, last page, character offset in the document (-1 = unknown).
+POSITION_KEYS = ('page', 'page_end', 'offset')
+
+
+def chunk_hash(content: str) -> str:
+    """Content address of a chunk: identical text gets the same id in every document."""
+    return hashlib.blake2b(content.encode('utf-8'), digest_size=HASH_BYTES).hexdigest()
+
+
+class ChunkStore:
+    """
+    Columnar chunk storage replacing the pickled list of {'source', 'content'} dicts.
+
+    On disk a store is a directory holding an int64 offsets array, a single UTF-8
+    text blob and an int32 source-id column whose values index an interned list
+    of source names, plus a 16-byte content hash and the page / offset of each
+    chunk, and the hashes of the files each source was ingested from. The
+    files are memory-mapped read-only, so every uvicorn
+    worker shares the same pages and chunks are only decoded when accessed.
+    Rows appended after the store was opened live in a small in-memory tail
+    until the next compaction writes them out.
+    """
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+        self._offsets = np.zeros(1, dtype='int64')
+        self._source_ids = np.zeros(0, dtype='int32')
+        self._hashes = None
+        self._positions = None
+        self._text = b''
+        self._text_file = None
+        self.sources: List[str] = []
+        self._source_lookup: Dict[str, int] = {}
+        self._tail: List[Dict] = []
+        # source name -> content hashes of the files ingested under that name
+        self.files: Dict[str, List[str]] = {}
+        if path is not None:
+            self._open(path)
+
+    def _open(self, path: str):
+        self._offsets = np.load(os.path.join(path, OFFSETS_FILE), mmap_mode='r')
+        self._source_ids = np.load(os.path.join(path, SOURCE_IDS_FILE), mmap_mode='r')
+        with open(os.path.join(path, SOURCES_FILE), 'r', encoding='utf-8') as f:
+            self.sources = json.load(f)
+        self._source_lookup = {name: i for i, name in enumerate(self.sources)}
+        # Generations written before chunk hashing have no hash column; hashes are then computed from the text.
+        if os.path.exists(os.path.join(path, HASHES_FILE)):
+            self._hashes = np.load(os.path.join(path, HASHES_FILE), mmap_mode='r')
+        if os.path.exists(os.path.join(path, POSITIONS_FILE)):
+            self._positions = np.load(os.path.join(path, POSITIONS_FILE), mmap_mode='r')
+        if os.path.exists(os.path.join(path, FILES_FILE)):
+            with open(os.path.join(path, FILES_FILE), 'r', encoding='utf-8') as f:
+                self.files = json.load(f)
+        self._text_file = open(os.path.join(path, TEXT_FILE), 'rb')
+        if os.fstat(self._text_file.fileno()).st_size > 0:
+            self._text = mmap.mmap(self._text_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    @classmethod
+    def from_list(cls, chunks: List[Dict]) -> 'ChunkStore':
+        """Wraps a legacy in-memory chunk list; it is written out columnar on the next compaction."""
+        store = cls()
+        store.extend(chunks)
+        return store
+
+    @property
+    def base_size(self) -> int:
+        return len(self._source_ids)
+
+    def __len__(self) -> int:
+        return self.base_size + len(self._tail)
+
+    def __getitem__(self, row: int) -> Dict:
+        row = int(row)
+        if row < 0:
+            row += len(self)
+        if row >= self.base_size:
+            return self._tail[row - self.base_size]
+        chunk = {'source': self.source(row), 'content': self.content(row), 'hash': self.hash(row)}
+        if self._positions is not None:
+            for key, value in zip(POSITION_KEYS, self._positions[row]):
+                chunk[key] = int(value) if value >= 0 else None
+        return chunk
+
+    def __iter__(self):
+        for row in range(len(self)):
+            yield self[row]
+
+    def source(self, row: int) -> str:
+        """Source name of a row without decoding its text."""
+        if row >= self.base_size:
+            return self._tail[row - self.base_size]['source']
+        return self.sources[self._source_ids[row]]
+
+    def content(self, row: int) -> str:
+        if row >= self.base_size:
+            return self._tail[row - self.base_size]['content']
+        start, end = self._offsets[row], self._offsets[row + 1]
+        return bytes(self._text[start:end]).decode('utf-8')
+
+    def hash(self, row: int) -> str:
+        if row >= self.base_size:
+            return self._tail[row - self.base_size]['hash']
+        if self._hashes is not None:
+            return bytes(self._hashes[row]).hex()
+        start, end = self._offsets[row], self._offsets[row + 1]
+        return hashlib.blake2b(self._text[start:end], digest_size=HASH_BYTES).hexdigest()
+
+    def hashes(self) -> Iterator[str]:
+        for row in range(len(self)):
+            yield self.hash(row)
+
+    def append(self, chunk: Dict):
+        if 'hash' not in chunk:
+            chunk = {**chunk, 'hash': chunk_hash(chunk['content'])}
+        self._tail.append(chunk)
+
+    def extend(self, chunks: Iterable[Dict]):
+        for chunk in chunks:
+            self.append(chunk)
+
+    def add_file(self, source: str, file_hash: str):
+        hashes = self.files.setdefault(source, [])
+        if file_hash not in hashes:
+            hashes.append(file_hash)
+
+    def remove_files(self, source: str):
+        self.files.pop(source, None)
+
+    def source_rows(self) -> Dict[str, List[int]]:
+        """Groups row ids by source name using the id column, without touching any text."""
+        groups: Dict[str, List[int]] = {}
+        if self.base_size:
+            source_ids = np.asarray(self._source_ids)
+            order = np.argsort(source_ids, kind='stable')
+            boundaries = np.flatnonzero(np.diff(source_ids[order])) + 1
+            for rows in np.split(order, boundaries):
+                groups[self.sources[source_ids[rows[0]]]] = rows.tolist()
+        for offset, chunk in enumerate(self._tail):
+            groups.setdefault(chunk['source'], []).append(self.base_size + offset)
+        return groups
+
+    def snapshot(self) -> 'ChunkStore':
+        """A point-in-time view sharing the immutable base and copying only the tail."""
+        view = ChunkStore()
+        view.path = self.path
+        view._offsets, view._source_ids, view._text = self._offsets, self._source_ids, self._text
+        view._hashes = self._hashes
+        view._positions = self._positions
+        view.files = {source: list(hashes) for source, hashes in self.files.items()}
+        view.sources, view._source_lookup = list(self.sources), dict(self._source_lookup)
+        view._tail = list(self._tail)
+        return view
+
+    def write(self, path: str, rows: Optional[np.ndarray] = None):
+        """
+        Writes this store (base + tail) as a new columnar directory. Base text is
+        copied as raw bytes; the directory is built under a temp name and renamed
+        into place so it appears atomically. If rows is given, only those rows
+        are written, in that order (compaction drops deleted chunks this way).
+        """
+        tmp_path = f"{path}.tmp-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        os.makedirs(tmp_path)
+        sources = list(self.sources)
+        lookup = dict(self._source_lookup)
+
+        def source_id(source: str) -> int:
+            if source not in lookup:
+                lookup[source] = len(sources)
+                sources.append(source)
+            return lookup[source]
+
+        with open(os.path.join(tmp_path, TEXT_FILE), 'wb') as text_file:
+            if rows is None:
+                offsets = [np.asarray(self._offsets, dtype='int64')]
+                source_ids = [np.asarray(self._source_ids, dtype='int32')]
+                base_bytes = int(self._offsets[-1])
+                if base_bytes:
+                    text_file.write(self._text[:base_bytes])
+                position = base_bytes
+                selected = range(self.base_size, len(self))
+            else:
+                offsets, source_ids, position, selected = [np.zeros(1, dtype='int64')], [], 0, rows
+            row_offsets, row_ids = [], []
+            for row in selected:
+                row = int(row)
+                if row < self.base_size:
+                    start, end = self._offsets[row], self._offsets[row + 1]
+                    encoded = self._text[start:end]
+                else:
+                    encoded = self._tail[row - self.base_size]['content'].encode('utf-8')
+                text_file.write(encoded)
+                position += len(encoded)
+                row_offsets.append(position)
+                row_ids.append(source_id(self.source(row)))
+            offsets.append(np.array(row_offsets, dtype='int64'))
+            source_ids.append(np.array(row_ids, dtype='int32'))
+            text_file.flush()
+            os.fsync(text_file.fileno())
+
+        np.save(os.path.join(tmp_path, OFFSETS_FILE), np.concatenate(offsets))
+        np.save(os.path.join(tmp_path, SOURCE_IDS_FILE), np.concatenate(source_ids))
+        if rows is None:
+            hashes = np.empty((len(self), HASH_BYTES), dtype='uint8')
+            if self._hashes is not None:
+                hashes[:self.base_size] = self._hashes
+            for row in range(self.base_size if self._hashes is not None else 0, len(self)):
+                hashes[row] = np.frombuffer(bytes.fromhex(self.hash(row)), dtype='uint8')
+        else:
+            hashes = np.empty((len(rows), HASH_BYTES), dtype='uint8')
+            for position, row in enumerate(rows):
+                hashes[position] = np.frombuffer(bytes.fromhex(self.hash(int(row))), dtype='uint8')
+        np.save(os.path.join(tmp_path, HASHES_FILE), hashes)
+        selected = range(len(self)) if rows is None else rows
+        positions = np.full((len(selected), len(POSITION_KEYS)), -1, dtype='int64')
+        for position, row in enumerate(selected):
+            row = int(row)
+            if row >= self.base_size:
+                chunk = self._tail[row - self.base_size]
+                positions[position] = [-1 if chunk.get(key) is None else chunk[key] for key in POSITION_KEYS]
+            elif self._positions is not None:
+                positions[position] = self._positions[row]
+        np.save(os.path.join(tmp_path, POSITIONS_FILE), positions)
+        with open(os.path.join(tmp_path, SOURCES_FILE), 'w', encoding='utf-8') as f:
+            json.dump(sources, f)
+        with open(os.path.join(tmp_path, FILES_FILE), 'w', encoding='utf-8') as f:
+            json.dump(self.files, f)
+        os.replace(tmp_path, path)
+
+    def close(self):
+        if isinstance(self._text, mmap.mmap):
+            self._text.close()
+        if self._text_file is not None:
+            self._text_file.close()
+
+
+def remove_store(path: str):
+    shutil.rmtree(path, ignore_errors=True)
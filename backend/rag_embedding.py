@@ -0,0 +1,336 @@
+import asyncio
+import hashlib
+import os
+import queue
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from typing import Callable, List, Dict, Optional
+
+import numpy as np
+
+# --- CONFIGURATION ---
+# How long the worker waits for more queries after the first one arrives.
+EMBED_BATCH_WINDOW_MS = float(os.getenv('RAG_EMBED_BATCH_WINDOW_MS', '5'))
+EMBED_MAX_BATCH = int(os.getenv('RAG_EMBED_MAX_BATCH', '64'))
+# Number of recent requests kept for the latency percentiles.
+EMBED_LATENCY_SAMPLES = 1000
+# Query embedding cache: in-process LRU plus an optional 'disk' (sqlite) or 'redis' tier.
+EMBED_CACHE_SIZE = int(os.getenv('RAG_EMBED_CACHE_SIZE', '10000'))
+EMBED_CACHE_BACKEND = os.getenv('RAG_EMBED_CACHE_BACKEND', 'disk').lower()
+EMBED_CACHE_PATH = os.getenv('RAG_EMBED_CACHE_PATH', 'synergyai_embedding_cache.sqlite')
+EMBED_CACHE_TTL_SECONDS = int(os.getenv('RAG_EMBED_CACHE_TTL_SECONDS', str(7 * 24 * 3600)))
+# How cached vectors are stored in both tiers: 'float32', 'float16' (2x smaller) or 'int8' (~4x, per-vector scale).
+EMBED_CACHE_STORAGE = os.getenv('RAG_EMBED_CACHE_STORAGE', os.getenv('RAG_VECTOR_STORAGE', 'float32')).lower()
+
+
+class _EmbedRequest:
+    __slots__ = ('texts', 'future', 'enqueued_at')
+
+    def __init__(self, texts: List[str]):
+        self.texts = texts
+        self.future = Future()
+        self.enqueued_at = time.perf_counter()
+
+
+def percentile(samples, pct: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct))]
+
+
+def pack_vector(vector: np.ndarray, storage: str) -> bytes:
+    """Serializes one embedding as float32, float16 or int8 codes preceded by a float32 scale."""
+    vector = np.asarray(vector, dtype='float32')
+    if storage == 'float16':
+        return vector.astype('float16').tobytes()
+    if storage == 'int8':
+        scale = float(np.abs(vector).max()) / 127 or 1.0
+        return np.float32(scale).tobytes() + np.round(vector / scale).astype('int8').tobytes()
+    return vector.tobytes()
+
+
+def unpack_vector(raw: bytes, storage: str) -> np.ndarray:
+    if storage == 'float16':
+        return np.frombuffer(raw, dtype='float16').astype('float32')
+    if storage == 'int8':
+        return np.frombuffer(raw, dtype='int8', offset=4).astype('float32') * np.frombuffer(raw, dtype='float32', count=1)[0]
+    return np.frombuffer(raw, dtype='float32').copy()
+
+
+def normalize_query(text: str) -> str:
+    """Collapses whitespace so trivially different spellings of a query share one cache entry."""
+    return " ".join(text.split())
+
+
+class EmbeddingCache:
+    """
+    Bounded LRU of query embeddings keyed by model name + normalized text.
+    Misses in memory fall through to an optional persistent tier (a local sqlite
+    file or Redis), so recurring queries survive restarts and are shared by
+    every worker; only texts missing from both tiers reach the model. Both
+    tiers hold vectors in the configured storage, decoded on lookup.
+    """
+    def __init__(self, model_name: str, max_entries: int = EMBED_CACHE_SIZE, backend: str = EMBED_CACHE_BACKEND,
+                 path: str = EMBED_CACHE_PATH, ttl_seconds: Optional[int] = EMBED_CACHE_TTL_SECONDS,
+                 storage: str = EMBED_CACHE_STORAGE):
+        self.model_name = model_name
+        self.storage = storage
+        self.max_entries = max_entries
+        self.backend = backend
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[str, bytes]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        self._redis = None
+        self.hits = 0
+        self.persistent_hits = 0
+        self.misses = 0
+        self._connect()
+
+    def _connect(self):
+        try:
+            if self.backend == 'disk':
+                self._db = sqlite3.connect(self.path, timeout=5, check_same_thread=False)
+                self._db.execute("PRAGMA journal_mode=WAL")
+                self._db.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB, created_at REAL)")
+                self._db.commit()
+            elif self.backend == 'redis':
+                import redis
+                self._redis = redis.from_url(os.getenv('REDIS_URL', 'redis://localhost:6379/0'))
+        except Exception as e:
+            print(f"[WARN] Embedding cache backend '{self.backend}' unavailable, using memory only: {e}")
+            self._db = None
+            self._redis = None
+
+    def key(self, text: str) -> str:
+        digest = hashlib.sha256(f"{self.model_name}\0{normalize_query(text)}".encode('utf-8')).hexdigest()
+        # Entries written in another storage are simply misses rather than misread bytes.
+        return f"rag:emb:{digest}" if self.storage == 'float32' else f"rag:emb:{self.storage}:{digest}"
+
+    def get(self, text: str) -> Optional[np.ndarray]:
+        """In-memory lookup only; cheap enough to call on the event loop."""
+        key = self.key(text)
+        with self._lock:
+            raw = self._entries.get(key)
+            if raw is None:
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        return unpack_vector(raw, self.storage)
+
+    def get_persistent(self, text: str) -> Optional[np.ndarray]:
+        """Looks a text up in the persistent tier and promotes a hit into memory."""
+        key = self.key(text)
+        raw = None
+        try:
+            if self._db is not None:
+                with self._lock:
+                    row = self._db.execute(
+                        "SELECT vector FROM embeddings WHERE key = ? AND created_at > ?",
+                        (key, time.time() - self.ttl_seconds if self.ttl_seconds else 0)
+                    ).fetchone()
+                raw = row[0] if row else None
+            elif self._redis is not None:
+                raw = self._redis.get(key)
+        except Exception as e:
+            print(f"[WARN] Embedding cache read failed: {e}")
+        if raw is None:
+            with self._lock:
+                self.misses += 1
+            return None
+        raw = bytes(raw)
+        self._remember(key, raw)
+        with self._lock:
+            self.persistent_hits += 1
+        return unpack_vector(raw, self.storage)
+
+    def _remember(self, key: str, raw: bytes):
+        with self._lock:
+            self._entries[key] = raw
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def put_many(self, texts: List[str], vectors: np.ndarray):
+        rows = []
+        for text, vector in zip(texts, vectors):
+            key = self.key(text)
+            raw = pack_vector(vector, self.storage)
+            self._remember(key, raw)
+            rows.append((key, raw, time.time()))
+        try:
+            if self._db is not None:
+                with self._lock:
+                    self._db.executemany("INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?)", rows)
+                    self._db.commit()
+            elif self._redis is not None:
+                pipe = self._redis.pipeline()
+                for key, raw, _ in rows:
+                    pipe.set(key, raw, ex=self.ttl_seconds)
+                pipe.execute()
+        except Exception as e:
+            print(f"[WARN] Embedding cache write failed: {e}")
+
+    def stats(self) -> Dict:
+        with self._lock:
+            lookups = self.hits + self.persistent_hits + self.misses
+            return {
+                "backend": self.backend if (self._db is not None or self._redis is not None) else 'memory',
+                "storage": self.storage,
+                "entries": len(self._entries),
+                "memory_bytes": sum(len(raw) for raw in self._entries.values()),
+                "memory_hits": self.hits,
+                "persistent_hits": self.persistent_hits,
+                "misses": self.misses,
+                "hit_rate": f"{(self.hits + self.persistent_hits) / max(1, lookups) * 100:.1f}%"
+            }
+
+
+class EmbeddingBatcher:
+    """
+    Micro-batches query embeddings. Concurrent callers enqueue their texts and get
+    a future; a single worker thread collects everything that arrives within a
+    short window and encodes it in one model call, so N concurrent searches cost
+    one batched forward pass instead of N serialized single-row encodes.
+    """
+    def __init__(self, encode_fn: Callable[[List[str]], np.ndarray], cache: Optional[EmbeddingCache] = None,
+                 max_batch: int = EMBED_MAX_BATCH, window_ms: float = EMBED_BATCH_WINDOW_MS):
+        self._encode_fn = encode_fn
+        self.cache = cache
+        self.max_batch = max_batch
+        self.window = window_ms / 1000.0
+        self._queue: "queue.Queue[_EmbedRequest]" = queue.Queue()
+        self._start_lock = threading.Lock()
+        self._thread = None
+        self._stats_lock = threading.Lock()
+        self._batches = 0
+        self._requests = 0
+        self._texts = 0
+        self._max_batch_seen = 0
+        self._errors = 0
+        self._batch_sizes = deque(maxlen=EMBED_LATENCY_SAMPLES)
+        self._wait_ms = deque(maxlen=EMBED_LATENCY_SAMPLES)
+        self._total_ms = deque(maxlen=EMBED_LATENCY_SAMPLES)
+        self._encode_ms = deque(maxlen=EMBED_LATENCY_SAMPLES)
+
+    def _ensure_worker(self):
+        if self._thread is not None:
+            return
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='rag-embedder', daemon=True)
+                self._thread.start()
+
+    def submit(self, texts: List[str]) -> Future:
+        """Queues texts for embedding; the future resolves to a float32 array with one row per text."""
+        if self.cache is not None:
+            cached = [self.cache.get(text) for text in texts]
+            if all(vector is not None for vector in cached):
+                future = Future()
+                future.set_result(np.vstack(cached))
+                return future
+        self._ensure_worker()
+        request = _EmbedRequest(list(texts))
+        self._queue.put(request)
+        return request.future
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        return self.submit(texts).result()
+
+    async def encode_async(self, texts: List[str]) -> np.ndarray:
+        return await asyncio.wrap_future(self.submit(texts))
+
+    def _collect(self) -> List[_EmbedRequest]:
+        """Blocks for the first request, then gathers more until the window closes or the batch is full."""
+        batch = [self._queue.get()]
+        size = len(batch[0].texts)
+        deadline = time.perf_counter() + self.window
+        while size < self.max_batch:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                request = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            batch.append(request)
+            size += len(request.texts)
+        return [request for request in batch if request.future.set_running_or_notify_cancel()]
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            if not batch:
+                continue
+            texts = [text for request in batch for text in request.texts]
+            started = time.perf_counter()
+            try:
+                vectors = self._encode_with_cache(texts)
+            except Exception as e:
+                print(f"[ERROR] Batched embedding failed for {len(texts)} texts: {e}")
+                with self._stats_lock:
+                    self._errors += 1
+                for request in batch:
+                    request.future.set_exception(e)
+                continue
+            finished = time.perf_counter()
+
+            position = 0
+            for request in batch:
+                request.future.set_result(vectors[position:position + len(request.texts)])
+                position += len(request.texts)
+            self._record(batch, len(texts), started, finished)
+
+    def _encode_with_cache(self, texts: List[str]) -> np.ndarray:
+        """Encodes only the texts that neither cache tier already holds."""
+        if self.cache is None:
+            return np.asarray(self._encode_fn(texts), dtype='float32')
+        found = {}
+        for text in set(texts):
+            vector = self.cache.get(text)
+            if vector is None:
+                vector = self.cache.get_persistent(text)
+            if vector is not None:
+                found[text] = vector
+        missing = [text for text in dict.fromkeys(texts) if text not in found]
+        if missing:
+            encoded = np.asarray(self._encode_fn(missing), dtype='float32')
+            self.cache.put_many(missing, encoded)
+            found.update(zip(missing, encoded))
+        return np.vstack([found[text] for text in texts])
+
+    def _record(self, batch: List[_EmbedRequest], text_count: int, started: float, finished: float):
+        with self._stats_lock:
+            self._batches += 1
+            self._requests += len(batch)
+            self._texts += text_count
+            self._max_batch_seen = max(self._max_batch_seen, len(batch))
+            self._batch_sizes.append(len(batch))
+            self._encode_ms.append((finished - started) * 1000)
+            for request in batch:
+                self._wait_ms.append((started - request.enqueued_at) * 1000)
+                self._total_ms.append((finished - request.enqueued_at) * 1000)
+
+    def stats(self) -> Dict:
+        with self._stats_lock:
+            return {
+                "batches": self._batches,
+                "requests": self._requests,
+                "texts": self._texts,
+                "errors": self._errors,
+                "queued": self._queue.qsize(),
+                "avg_batch_size": round(self._requests / self._batches, 2) if self._batches else 0.0,
+                "max_batch_size": self._max_batch_seen,
+                "recent_avg_batch_size": round(sum(self._batch_sizes) / len(self._batch_sizes), 2) if self._batch_sizes else 0.0,
+                "queue_wait_ms_p50": round(percentile(self._wait_ms, 0.5), 2),
+                "queue_wait_ms_p95": round(percentile(self._wait_ms, 0.95), 2),
+                "encode_ms_p50": round(percentile(self._encode_ms, 0.5), 2),
+                "encode_ms_p95": round(percentile(self._encode_ms, 0.95), 2),
+                "latency_ms_p50": round(percentile(self._total_ms, 0.5), 2),
+                "latency_ms_p95": round(percentile(self._total_ms, 0.95), 2),
+            }
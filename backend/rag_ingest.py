@@ -0,0 +1,273 @@
+import hashlib
+import multiprocessing
+import os
+import re
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, Dict, Iterator, Iterable, List, Optional, Tuple
+
+# --- CONFIGURATION ---
+# 'structured' packs paragraphs/headings/tables into token-sized chunks; 'words' is the original fixed word window.
+CHUNKER = os.getenv('RAG_CHUNKER', 'structured').lower()
+CHUNK_SIZE_WORDS = 400
+CHUNK_OVERLAP_WORDS = 50
+# Structured chunks are capped below the embedding model's sequence length, so no text is truncated.
+CHUNK_MAX_TOKENS = int(os.getenv('RAG_CHUNK_MAX_TOKENS', '384'))
+CHUNK_OVERLAP_TOKENS = int(os.getenv('RAG_CHUNK_OVERLAP_TOKENS', '48'))
+HEADING_MAX_WORDS = 12
+# Chunks encoded per model call while ingesting.
+INGEST_EMBED_BATCH = int(os.getenv('RAG_INGEST_EMBED_BATCH', '64'))
+# Chunks collected before they are written out as one delta segment.
+INGEST_SEGMENT_CHUNKS = int(os.getenv('RAG_INGEST_SEGMENT_CHUNKS', '1024'))
+# PDF text extraction runs in worker processes, a range of pages per task.
+INGEST_WORKERS = int(os.getenv('RAG_INGEST_WORKERS', str(max(1, min(4, (os.cpu_count() or 2) - 1)))))
+PAGES_PER_TASK = int(os.getenv('RAG_INGEST_PAGES_PER_TASK', '16'))
+TEXT_BLOCK_BYTES = 1024 * 1024
+
+_extract_pool = None
+
+
+def file_sha256(file_path: str) -> str:
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _get_extract_pool() -> ProcessPoolExecutor:
+    """Lazily starts the extraction pool. 'spawn' keeps torch/FAISS threads out of the children."""
+    global _extract_pool
+    if _extract_pool is None:
+        _extract_pool = ProcessPoolExecutor(max_workers=INGEST_WORKERS,
+                                            mp_context=multiprocessing.get_context('spawn'))
+    return _extract_pool
+
+
+# A unit is one page (PDFs) or one stretch of a document without page numbers:
+# (page number or None, [(kind, text), ...]) with kind 'heading', 'text' or 'table'.
+Block = Tuple[str, str]
+Unit = Tuple[Optional[int], List[Block]]
+
+
+def _extract_pdf_pages(file_path: str, start: int, end: int) -> List[List[Block]]:
+    """Runs in a worker process: returns the text blocks of pages [start, end) in reading order."""
+    import fitz
+    with fitz.open(file_path) as doc:
+        # Block tuples are (x0, y0, x1, y1, text, block_no, block_type); type 1 is an image.
+        return [[('text', block[4]) for block in doc[page].get_text('blocks', sort=True) if block[6] == 0]
+                for page in range(start, end)]
+
+
+def pdf_page_count(file_path: str) -> int:
+    import fitz
+    with fitz.open(file_path) as doc:
+        return doc.page_count
+
+
+def iter_pdf_pages(file_path: str, page_count: int) -> Iterator[List[Block]]:
+    """
+    Yields the blocks of each page in order. Large PDFs are split into page ranges extracted
+    in parallel, with at most two ranges per worker in flight so memory stays bounded.
+    """
+    if page_count <= PAGES_PER_TASK or INGEST_WORKERS <= 1:
+        yield from _extract_pdf_pages(file_path, 0, page_count)
+        return
+    global _extract_pool
+    ranges = deque((start, min(start + PAGES_PER_TASK, page_count)) for start in range(0, page_count, PAGES_PER_TASK))
+    in_flight = deque()
+    try:
+        pool = _get_extract_pool()
+        while ranges or in_flight:
+            while ranges and len(in_flight) < INGEST_WORKERS * 2:
+                start, end = ranges.popleft()
+                in_flight.append(((start, end), pool.submit(_extract_pdf_pages, file_path, start, end)))
+            _, future = in_flight[0]
+            pages = future.result()
+            in_flight.popleft()
+            yield from pages
+    except BrokenProcessPool as e:
+        # A crashed worker takes the pool down; finish this document in-process.
+        print(f"[WARN] PDF extraction pool failed ({e}); extracting remaining pages in-process.")
+        _extract_pool = None
+        for (start, end), _ in in_flight:
+            yield from _extract_pdf_pages(file_path, start, end)
+        for start, end in ranges:
+            yield from _extract_pdf_pages(file_path, start, end)
+
+
+def _docx_units(file_path: str) -> Tuple[int, Iterator[Unit]]:
+    """Paragraphs and tables in body order; 'Heading'/'Title' styles mark headings."""
+    import docx
+    from docx.table import Table
+    from docx.text.paragraph import Paragraph
+    document = docx.Document(file_path)
+    elements = list(document.element.body.iterchildren())
+
+    def units():
+        for element in elements:
+            tag = element.tag.rsplit('}', 1)[-1]
+            if tag == 'p':
+                paragraph = Paragraph(element, document)
+                style = paragraph.style.name if paragraph.style is not None else ''
+                kind = 'heading' if style.startswith(('Heading', 'Title')) else 'text'
+                yield None, [(kind, paragraph.text)]
+            elif tag == 'tbl':
+                rows = [" | ".join(cell.text.strip() for cell in row.cells) for row in Table(element, document).rows]
+                yield None, [('table', "\n".join(rows))]
+    return len(elements), units()
+
+
+def iter_document_units(file_path: str) -> Tuple[Optional[int], Iterator[Unit]]:
+    """
+    Returns (unit_count, iterator of units) for a document: pages for PDFs,
+    body elements for .docx and ~1 MB blocks (split into paragraphs) for plain
+    text. The count is None when it is not known up front.
+    """
+    ext = os.path.splitext(file_path)[1].lower()
+    if ext == '.pdf':
+        page_count = pdf_page_count(file_path)
+        return page_count, ((number + 1, blocks) for number, blocks in enumerate(iter_pdf_pages(file_path, page_count)))
+    if ext == '.docx':
+        return _docx_units(file_path)
+
+    def read_blocks():
+        with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
+            while True:
+                block = f.read(TEXT_BLOCK_BYTES)
+                if not block:
+                    break
+                # Never split a word across blocks.
+                if not block[-1].isspace():
+                    block += f.readline()
+                yield None, [('text', paragraph) for paragraph in re.split(r"\n\s*\n", block)]
+    return None, read_blocks()
+
+
+def unit_texts(units: Iterable[Unit]) -> Iterator[str]:
+    """Plain text of each unit, for the word chunker."""
+    for _, blocks in units:
+        yield "\n".join(text for _, text in blocks)
+
+
+def iter_word_chunks(units: Iterable[str], chunk_size: int = CHUNK_SIZE_WORDS,
+                     overlap: int = CHUNK_OVERLAP_WORDS) -> Iterator[str]:
+    """
+    Incremental version of the fixed-size word chunker: same windows as splitting
+    the whole document at once, but only about one chunk of words is held in memory.
+    """
+    step = chunk_size - overlap
+    words: List[str] = []
+    for unit in units:
+        words.extend(unit.split())
+        while len(words) >= chunk_size:
+            yield " ".join(words[:chunk_size])
+            del words[:step]
+    while words:
+        yield " ".join(words[:chunk_size])
+        del words[:step]
+
+
+def _is_heading(text: str) -> bool:
+    """Short, unpunctuated lines in title/upper case or with section numbering read as headings."""
+    words = text.split()
+    if not words or len(words) > HEADING_MAX_WORDS or text[-1] in '.,;:':
+        return False
+    return text.isupper() or text.istitle() or bool(re.match(r"^(\d+(\.\d+)*\.?|[IVXLC]+\.|Article|Section|Schedule|Clause)\s", text))
+
+
+def _split_long(text: str, kind: str) -> List[str]:
+    """Breaks an oversized block at row (tables) or sentence boundaries."""
+    if kind == 'table':
+        return [row for row in text.split("\n") if row.strip()]
+    return [sentence for sentence in re.split(r"(?<=[.!?;])\s+", text) if sentence]
+
+
+def iter_structured_chunks(units: Iterable[Unit], count_tokens: Callable[[List[str]], List[int]],
+                           max_tokens: int = CHUNK_MAX_TOKENS,
+                           overlap_tokens: int = CHUNK_OVERLAP_TOKENS) -> Iterator[Dict]:
+    """
+    Packs paragraphs, headings and tables into chunks of at most max_tokens
+    model tokens. A heading always starts a new chunk, a new page does once the
+    current chunk is half full, and blocks are only split (at sentences, table
+    rows, then words) when a single block is too long. Chunks cut for size
+    repeat up to overlap_tokens of trailing sentences/blocks from the previous chunk.
+
+    Yields {'content', 'page', 'page_end', 'offset'}: the first and last page
+    (None without page numbers) and the character offset of the chunk in the
+    document text (blocks joined by blank lines).
+    """
+    current: List[Tuple[str, int, Optional[int], int]] = []   # (text, tokens, page, offset)
+    current_tokens = 0
+    position = 0
+
+    def flush(overlap: bool) -> Optional[Dict]:
+        nonlocal current, current_tokens
+        if not current:
+            return None
+        chunk = {'content': "\n\n".join(piece[0] for piece in current), 'page': current[0][2],
+                 'page_end': current[-1][2], 'offset': current[0][3]}
+        carry, carried = [], 0
+        if overlap:
+            # Never carry the whole chunk, or the next one would repeat it.
+            for piece in reversed(current[1:]):
+                if carried + piece[1] > overlap_tokens:
+                    break
+                carry.insert(0, piece)
+                carried += piece[1]
+        current, current_tokens = carry, carried
+        return chunk
+
+    for page, blocks in units:
+        cleaned = []
+        for kind, text in blocks:
+            text = "\n".join(" ".join(line.split()) for line in text.split("\n")) if kind == 'table' else " ".join(text.split())
+            if text.strip():
+                cleaned.append((kind, text.strip()))
+        if not cleaned:
+            continue
+        if current and page is not None and current[-1][2] != page and current_tokens >= max_tokens // 2:
+            chunk = flush(overlap=False)
+            if chunk:
+                yield chunk
+
+        counts = count_tokens([text for _, text in cleaned])
+        for (kind, text), tokens in zip(cleaned, counts):
+            offset = position
+            position += len(text) + 2
+            if kind == 'heading' or (kind == 'text' and _is_heading(text)):
+                chunk = flush(overlap=False)
+                if chunk:
+                    yield chunk
+
+            pieces = [(text, tokens, offset)]
+            if tokens > max_tokens:
+                parts = _split_long(text, kind)
+                pieces, cursor = [], 0
+                for part, part_tokens in zip(parts, count_tokens(parts)):
+                    part_offset = offset + max(0, text.find(part, cursor))
+                    cursor = part_offset - offset + len(part)
+                    if part_tokens <= max_tokens:
+                        pieces.append((part, part_tokens, part_offset))
+                        continue
+                    # A single huge sentence: fall back to word windows sized by its token density.
+                    words = part.split()
+                    step = max(1, int(len(words) * max_tokens / part_tokens))
+                    for i in range(0, len(words), step):
+                        window = " ".join(words[i:i + step])
+                        pieces.append((window, count_tokens([window])[0], part_offset))
+
+            for piece_text, piece_tokens, piece_offset in pieces:
+                if current and current_tokens + piece_tokens > max_tokens:
+                    chunk = flush(overlap=True)
+                    if chunk:
+                        yield chunk
+                    if current_tokens + piece_tokens > max_tokens:
+                        current, current_tokens = [], 0
+                current.append((piece_text, piece_tokens, page, piece_offset))
+                current_tokens += piece_tokens
+
+    chunk = flush(overlap=False)
+    if chunk:
+        yield chunk
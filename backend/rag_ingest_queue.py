@@ -0,0 +1,341 @@
+"""
+Durable ingestion queue for RAG uploads.
+
+Upload endpoints enqueue a job (SQLite, shared by every process on the host);
+worker processes claim jobs, embed the document and write delta segments that
+the API processes pick up. Failed jobs are retried with exponential backoff,
+jobs of a crashed worker are reclaimed after their lease expires, and an
+identical file re-uploaded under the same name is not embedded twice.
+Re-ingestion jobs replace the chunks a source already has in the index.
+
+Usage:
+    python rag_ingest_queue.py worker [--processes 2]
+    python rag_ingest_queue.py stats
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Optional, Dict, List
+
+from rag_ingest import file_sha256
+
+# --- CONFIGURATION ---
+INGEST_QUEUE_PATH = os.getenv('RAG_INGEST_QUEUE_PATH', 'synergyai_ingest_queue.sqlite')
+INGEST_MAX_ATTEMPTS = int(os.getenv('RAG_INGEST_MAX_ATTEMPTS', '3'))
+INGEST_RETRY_BASE_SECONDS = float(os.getenv('RAG_INGEST_RETRY_BASE_SECONDS', '10'))
+INGEST_RETRY_MAX_SECONDS = 600.0
+# A running job whose worker has not reported progress for this long is handed to another worker.
+INGEST_LEASE_SECONDS = float(os.getenv('RAG_INGEST_LEASE_SECONDS', '600'))
+INGEST_POLL_SECONDS = 1.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS ingest_jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    doc_table TEXT NOT NULL,
+    document_id TEXT NOT NULL,
+    file_path TEXT NOT NULL,
+    source_name TEXT NOT NULL,
+    file_hash TEXT NOT NULL,
+    status TEXT NOT NULL,
+    duplicate_of INTEGER,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL,
+    locked_by TEXT,
+    locked_at REAL,
+    progress TEXT,
+    chunks INTEGER,
+    replace_existing INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ingest_jobs_claim ON ingest_jobs (status, next_attempt_at);
+CREATE INDEX IF NOT EXISTS ingest_jobs_hash ON ingest_jobs (file_hash, source_name);
+CREATE INDEX IF NOT EXISTS ingest_jobs_updated ON ingest_jobs (updated_at);
+"""
+
+
+class IngestQueue:
+    """SQLite-backed job queue; safe to use from many threads and processes at once."""
+    def __init__(self, path: str = INGEST_QUEUE_PATH):
+        self.path = path
+        with self._connect() as db:
+            db.executescript(SCHEMA)
+            columns = {row['name'] for row in db.execute("PRAGMA table_info(ingest_jobs)")}
+            if 'replace_existing' not in columns:
+                db.execute("ALTER TABLE ingest_jobs ADD COLUMN replace_existing INTEGER NOT NULL DEFAULT 0")
+
+    @contextmanager
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        db.row_factory = sqlite3.Row
+        try:
+            db.execute("PRAGMA journal_mode=WAL")
+            yield db
+        finally:
+            db.close()
+
+    @staticmethod
+    def _row(row) -> Optional[Dict]:
+        if row is None:
+            return None
+        job = dict(row)
+        job['progress'] = json.loads(job['progress']) if job['progress'] else None
+        return job
+
+    def enqueue(self, doc_table: str, document_id: str, file_path: str, source_name: str,
+                replace: bool = False) -> Dict:
+        """
+        Adds a job for an uploaded file. If the same bytes were already queued or
+        ingested under the same name, the new job is recorded as a duplicate of
+        that one instead of being embedded again. replace=True (re-ingestion)
+        always runs and swaps out the source's existing chunks.
+        """
+        file_hash = file_sha256(file_path)
+        now = time.time()
+        with self._connect() as db:
+            db.execute("BEGIN IMMEDIATE")
+            original = None if replace else db.execute(
+                "SELECT id FROM ingest_jobs WHERE file_hash = ? AND source_name = ? "
+                "AND status IN ('queued', 'running', 'done') ORDER BY id LIMIT 1",
+                (file_hash, source_name)
+            ).fetchone()
+            status = 'duplicate' if original else 'queued'
+            cursor = db.execute(
+                "INSERT INTO ingest_jobs (doc_table, document_id, file_path, source_name, file_hash, status, "
+                "duplicate_of, replace_existing, next_attempt_at, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (doc_table, document_id, file_path, source_name, file_hash, status,
+                 original['id'] if original else None, int(replace), now, now, now)
+            )
+            db.execute("COMMIT")
+        return self.get(cursor.lastrowid)
+
+    def claim(self, worker_id: str) -> Optional[Dict]:
+        """Atomically takes the oldest due job, including jobs whose worker's lease has expired."""
+        now = time.time()
+        with self._connect() as db:
+            db.execute("BEGIN IMMEDIATE")
+            row = db.execute(
+                "SELECT id FROM ingest_jobs WHERE (status = 'queued' AND next_attempt_at <= ?) "
+                "OR (status = 'running' AND locked_at < ?) ORDER BY next_attempt_at, id LIMIT 1",
+                (now, now - INGEST_LEASE_SECONDS)
+            ).fetchone()
+            if row is None:
+                db.execute("COMMIT")
+                return None
+            db.execute(
+                "UPDATE ingest_jobs SET status = 'running', attempts = attempts + 1, locked_by = ?, "
+                "locked_at = ?, updated_at = ? WHERE id = ?",
+                (worker_id, now, now, row['id'])
+            )
+            db.execute("COMMIT")
+        return self.get(row['id'])
+
+    def report_progress(self, job_id: int, worker_id: str, progress: Dict):
+        """Stores progress and renews the job's lease, if the worker still holds it."""
+        now = time.time()
+        with self._connect() as db:
+            db.execute(
+                "UPDATE ingest_jobs SET progress = ?, locked_at = ?, updated_at = ? "
+                "WHERE id = ? AND status = 'running' AND locked_by = ?",
+                (json.dumps(progress), now, now, job_id, worker_id)
+            )
+
+    def complete(self, job_id: int, worker_id: str, chunks: int) -> bool:
+        """
+        Marks the job done. Returns False if the worker's lease expired and the
+        job was reclaimed by another worker; the job is then left to that worker.
+        """
+        now = time.time()
+        with self._connect() as db:
+            cursor = db.execute(
+                "UPDATE ingest_jobs SET status = 'done', chunks = ?, error = NULL, locked_by = NULL, "
+                "updated_at = ? WHERE id = ? AND status = 'running' AND locked_by = ?",
+                (chunks, now, job_id, worker_id)
+            )
+            return cursor.rowcount > 0
+
+    def fail(self, job_id: int, worker_id: str, error: str) -> bool:
+        """
+        Schedules a retry with exponential backoff, or marks the job failed after
+        the last attempt. Returns False if the worker no longer holds the job.
+        """
+        now = time.time()
+        with self._connect() as db:
+            db.execute("BEGIN IMMEDIATE")
+            job = db.execute(
+                "SELECT attempts FROM ingest_jobs WHERE id = ? AND status = 'running' AND locked_by = ?",
+                (job_id, worker_id)
+            ).fetchone()
+            if job is None:
+                db.execute("COMMIT")
+                return False
+            if job['attempts'] >= INGEST_MAX_ATTEMPTS:
+                db.execute(
+                    "UPDATE ingest_jobs SET status = 'failed', error = ?, locked_by = NULL, updated_at = ? "
+                    "WHERE id = ? AND locked_by = ?",
+                    (error, now, job_id, worker_id)
+                )
+            else:
+                delay = min(INGEST_RETRY_MAX_SECONDS, INGEST_RETRY_BASE_SECONDS * 2 ** (job['attempts'] - 1))
+                db.execute(
+                    "UPDATE ingest_jobs SET status = 'queued', error = ?, locked_by = NULL, next_attempt_at = ?, "
+                    "updated_at = ? WHERE id = ? AND locked_by = ?",
+                    (error, now + delay, now, job_id, worker_id)
+                )
+            db.execute("COMMIT")
+            return True
+
+    def forget_source(self, source_name: str) -> int:
+        """
+        Marks a removed source's jobs as 'removed', so a later upload of the same
+        file is ingested again instead of being deduplicated against them.
+        A running job is marked too: its worker's complete()/fail() then return
+        False and the worker removes the chunks it wrote. Returns the number of
+        jobs updated.
+        """
+        with self._connect() as db:
+            cursor = db.execute(
+                "UPDATE ingest_jobs SET status = 'removed', locked_by = NULL, updated_at = ? "
+                "WHERE source_name = ? AND status IN ('queued', 'running', 'done', 'duplicate')",
+                (time.time(), source_name)
+            )
+            return cursor.rowcount
+
+    def started_after(self, job: Dict) -> bool:
+        """True if a later job for the same source has already started or finished ingesting."""
+        with self._connect() as db:
+            return db.execute(
+                "SELECT 1 FROM ingest_jobs WHERE source_name = ? AND id > ? AND status IN ('running', 'done') LIMIT 1",
+                (job['source_name'], job['id'])
+            ).fetchone() is not None
+
+    def get(self, job_id: int) -> Optional[Dict]:
+        with self._connect() as db:
+            return self._row(db.execute("SELECT * FROM ingest_jobs WHERE id = ?", (job_id,)).fetchone())
+
+    def resolve(self, job: Dict) -> Dict:
+        """For a duplicate job, the job that actually did (or will do) the work; otherwise the job itself."""
+        if job['status'] == 'duplicate' and job['duplicate_of']:
+            return self.get(job['duplicate_of']) or job
+        return job
+
+    def latest_for_document(self, document_id: str) -> Optional[Dict]:
+        with self._connect() as db:
+            return self._row(db.execute(
+                "SELECT * FROM ingest_jobs WHERE document_id = ? ORDER BY id DESC LIMIT 1", (document_id,)
+            ).fetchone())
+
+    def changed_since(self, timestamp: float) -> List[Dict]:
+        with self._connect() as db:
+            rows = db.execute(
+                "SELECT * FROM ingest_jobs WHERE updated_at > ? ORDER BY updated_at", (timestamp,)
+            ).fetchall()
+        return [self._row(row) for row in rows]
+
+    def dependents(self, job_id: int) -> List[Dict]:
+        """Duplicate jobs waiting on the given job."""
+        with self._connect() as db:
+            rows = db.execute("SELECT * FROM ingest_jobs WHERE duplicate_of = ?", (job_id,)).fetchall()
+        return [self._row(row) for row in rows]
+
+    def stats(self) -> Dict:
+        with self._connect() as db:
+            counts = dict(db.execute("SELECT status, COUNT(*) FROM ingest_jobs GROUP BY status").fetchall())
+            oldest = db.execute(
+                "SELECT MIN(created_at) FROM ingest_jobs WHERE status = 'queued'"
+            ).fetchone()[0]
+        return {
+            "queued": counts.get('queued', 0),
+            "running": counts.get('running', 0),
+            "done": counts.get('done', 0),
+            "failed": counts.get('failed', 0),
+            "duplicates": counts.get('duplicate', 0),
+            "removed": counts.get('removed', 0),
+            "oldest_queued_seconds": round(time.time() - oldest, 1) if oldest else 0.0
+        }
+
+
+def run_worker(rag, queue: IngestQueue, worker_id: str, stop: Optional[threading.Event] = None):
+    """Claims and processes jobs until stop is set. rag is a loaded RAGSystem."""
+    stop = stop or threading.Event()
+    while not stop.is_set():
+        try:
+            job = queue.claim(worker_id)
+        except Exception as e:
+            print(f"[WARN] Ingest worker {worker_id} could not claim a job: {e}")
+            job = None
+        if job is None:
+            stop.wait(INGEST_POLL_SECONDS)
+            continue
+
+        print(f"--- [{worker_id}] Ingest job {job['id']} (attempt {job['attempts']}): {job['source_name']} ---")
+        if not os.path.exists(job['file_path']):
+            queue.fail(job['id'], worker_id, "Uploaded file not found")
+            continue
+        chunks = rag.ingest_document(job['file_path'], job['source_name'],
+                                     progress=lambda state: queue.report_progress(job['id'], worker_id, state),
+                                     replace=bool(job['replace_existing']))
+        if chunks is None:
+            recorded = queue.fail(job['id'], worker_id, "Ingestion failed; see worker log")
+        else:
+            recorded = queue.complete(job['id'], worker_id, chunks)
+        if recorded:
+            continue
+        current = queue.get(job['id'])
+        if current is None or current['status'] != 'removed':
+            print(f"[WARN] [{worker_id}] Lease on ingest job {job['id']} expired; another worker owns it now.")
+        elif queue.started_after(job):
+            # Removing now would also drop the chunks of the newer upload.
+            print(f"[WARN] [{worker_id}] {job['source_name']} was deleted during job {job['id']} and uploaded again; "
+                  f"leaving its chunks to the newer job.")
+        else:
+            # The document was deleted while this job ran; drop the chunks it wrote after the removal.
+            print(f"--- [{worker_id}] {job['source_name']} was deleted during job {job['id']}; removing its chunks ---")
+            rag.remove_source(job['source_name'])
+
+
+def _worker_process(index: int):
+    from rag_pipeline import RAGSystem
+
+    rag = RAGSystem(role='ingest')
+    rag.load()
+    if not rag.ready:
+        raise SystemExit(f"[ERROR] Ingest worker {index} could not load the embedding model.")
+    run_worker(rag, IngestQueue(), f"worker-{os.getpid()}-{uuid.uuid4().hex[:6]}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="RAG ingestion queue")
+    sub = parser.add_subparsers(dest='command', required=True)
+    worker = sub.add_parser('worker', help="Run ingestion worker processes")
+    worker.add_argument('--processes', type=int, default=1)
+    sub.add_parser('stats', help="Print queue counts")
+    args = parser.parse_args()
+
+    if args.command == 'stats':
+        print(json.dumps(IngestQueue().stats(), indent=2))
+        return
+
+    context = multiprocessing.get_context('spawn')
+    processes = [context.Process(target=_worker_process, args=(i,), daemon=False) for i in range(args.processes)]
+    for process in processes:
+        process.start()
+    print(f"🚀 Started {len(processes)} ingestion worker process(es)")
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        for process in processes:
+            process.terminate()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,296 @@
+"""
+BM25 keyword index over RAG chunks.
+
+Postings (token -> chunk rows and term frequencies) are kept in the same
+base + tail layout as the chunk store: a compacted base generation is a
+directory of memory-mapped arrays written next to the FAISS index, and chunks
+applied since then are added incrementally to small in-memory tails. Row ids
+are the FAISS / chunk map row ids, so results resolve through the chunk map.
+"""
+import json
+import math
+import os
+import re
+import uuid
+from array import array
+from collections import Counter
+from typing import Optional, List, Dict, Iterable, Tuple
+
+import numpy as np
+
+VOCAB_FILE = 'vocab.json'
+OFFSETS_FILE = 'offsets.npy'
+ROWS_FILE = 'rows.npy'
+TFS_FILE = 'tfs.npy'
+DOC_LENS_FILE = 'doc_lens.npy'
+ROW_SOURCES_FILE = 'row_sources.npy'
+SOURCES_FILE = 'sources.json'
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+MAX_TF = 65535
+TOKEN_RE = re.compile(r"\w+")
+
+
+def tokenize(text: str) -> List[str]:
+    return TOKEN_RE.findall(text.lower())
+
+
+class KeywordIndex:
+    """
+    Inverted index with BM25 scoring and per-source filtering. Not thread-safe
+    on its own: RAGSystem mutates it under its write lock and searches it under
+    the read lock, exactly like the FAISS index.
+    """
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+        self._vocab: Dict[str, int] = {}
+        self._offsets = np.zeros(1, dtype='int64')
+        self._rows = np.zeros(0, dtype='uint32')
+        self._tfs = np.zeros(0, dtype='uint16')
+        self._doc_lens = np.zeros(0, dtype='uint32')
+        self._row_sources = np.zeros(0, dtype='int32')
+        self.sources: List[str] = []
+        self._source_lookup: Dict[str, int] = {}
+        # token -> (rows, term frequencies) of rows added since the base was written
+        self._tail: Dict[str, Tuple[array, array]] = {}
+        self._tail_doc_lens = array('I')
+        self._tail_row_sources = array('i')
+        self._total_len = 0
+        if path is not None:
+            self._open(path)
+
+    def _open(self, path: str):
+        with open(os.path.join(path, VOCAB_FILE), 'r', encoding='utf-8') as f:
+            self._vocab = {token: i for i, token in enumerate(json.load(f))}
+        with open(os.path.join(path, SOURCES_FILE), 'r', encoding='utf-8') as f:
+            self.sources = json.load(f)
+        self._source_lookup = {name: i for i, name in enumerate(self.sources)}
+        self._offsets = np.load(os.path.join(path, OFFSETS_FILE), mmap_mode='r')
+        self._rows = np.load(os.path.join(path, ROWS_FILE), mmap_mode='r')
+        self._tfs = np.load(os.path.join(path, TFS_FILE), mmap_mode='r')
+        self._doc_lens = np.load(os.path.join(path, DOC_LENS_FILE), mmap_mode='r')
+        self._row_sources = np.load(os.path.join(path, ROW_SOURCES_FILE), mmap_mode='r')
+        self._total_len = int(np.asarray(self._doc_lens, dtype='int64').sum())
+
+    @classmethod
+    def build(cls, chunks: Iterable[Dict]) -> 'KeywordIndex':
+        """Indexes every chunk of a chunk map from scratch (rows numbered from 0)."""
+        index = cls()
+        for row, chunk in enumerate(chunks):
+            index.add(row, chunk['source'], Counter(tokenize(chunk['content'])))
+        return index
+
+    @property
+    def base_size(self) -> int:
+        return len(self._doc_lens)
+
+    def __len__(self) -> int:
+        return self.base_size + len(self._tail_doc_lens)
+
+    @staticmethod
+    def prepare(chunks: List[Dict]) -> List[Counter]:
+        """Tokenizes chunks ahead of add(), so callers can do it outside their write lock."""
+        return [Counter(tokenize(chunk['content'])) for chunk in chunks]
+
+    def _source_id(self, source: str) -> int:
+        if source not in self._source_lookup:
+            self._source_lookup[source] = len(self.sources)
+            self.sources.append(source)
+        return self._source_lookup[source]
+
+    def add(self, row: int, source: str, term_counts: Counter):
+        """Appends one chunk. Rows must be added in order, matching the chunk map."""
+        if row != len(self):
+            raise ValueError(f"Keyword index expected row {len(self)}, got {row}")
+        tail = self._tail
+        for token, count in term_counts.items():
+            postings = tail.get(token)
+            if postings is None:
+                postings = tail[token] = (array('I'), array('H'))
+            postings[0].append(row)
+            postings[1].append(count if count < MAX_TF else MAX_TF)
+        length = sum(term_counts.values())
+        self._tail_doc_lens.append(length)
+        self._tail_row_sources.append(self._source_id(source))
+        self._total_len += length
+
+    def extend_from(self, other: 'KeywordIndex', start_row: int):
+        """Copies other's rows >= start_row (all in its tail) onto the end of this index."""
+        if start_row >= len(other):
+            return
+        first = start_row - other.base_size
+        per_row: Dict[int, Counter] = {}
+        for token, (rows, tfs) in other._tail.items():
+            for row, tf in zip(rows, tfs):
+                if row >= start_row:
+                    per_row.setdefault(row, Counter())[token] = tf
+        for offset in range(len(other) - start_row):
+            row = start_row + offset
+            source = other.sources[other._tail_row_sources[first + offset]]
+            self.add(len(self), source, per_row.get(row, Counter()))
+
+    def snapshot(self) -> 'KeywordIndex':
+        """A point-in-time view sharing the immutable base and copying only the tail."""
+        view = KeywordIndex()
+        view.path = self.path
+        view._vocab, view._offsets, view._rows, view._tfs = self._vocab, self._offsets, self._rows, self._tfs
+        view._doc_lens, view._row_sources = self._doc_lens, self._row_sources
+        view.sources, view._source_lookup = list(self.sources), dict(self._source_lookup)
+        view._tail = {token: (array('I', rows), array('H', tfs)) for token, (rows, tfs) in self._tail.items()}
+        view._tail_doc_lens = array('I', self._tail_doc_lens)
+        view._tail_row_sources = array('i', self._tail_row_sources)
+        view._total_len = self._total_len
+        return view
+
+    def _postings(self, token: str) -> Tuple[np.ndarray, np.ndarray]:
+        parts_rows, parts_tfs = [], []
+        i = self._vocab.get(token)
+        if i is not None:
+            start, end = self._offsets[i], self._offsets[i + 1]
+            parts_rows.append(np.asarray(self._rows[start:end], dtype='int64'))
+            parts_tfs.append(np.asarray(self._tfs[start:end], dtype='float32'))
+        if token in self._tail:
+            rows, tfs = self._tail[token]
+            parts_rows.append(np.frombuffer(rows, dtype='uint32').astype('int64'))
+            parts_tfs.append(np.frombuffer(tfs, dtype='uint16').astype('float32'))
+        if not parts_rows:
+            return np.zeros(0, dtype='int64'), np.zeros(0, dtype='float32')
+        return np.concatenate(parts_rows), np.concatenate(parts_tfs)
+
+    def _column(self, base: np.ndarray, tail: array, dtype: str) -> np.ndarray:
+        tail_values = np.frombuffer(tail, dtype=dtype) if len(tail) else np.zeros(0, dtype=dtype)
+        return np.concatenate([np.asarray(base, dtype=dtype), tail_values])
+
+    def _lookup(self, base: np.ndarray, tail: array, dtype: str, rows: np.ndarray) -> np.ndarray:
+        """Values of a per-row column for the given rows only, without materializing the whole column."""
+        values = np.empty(rows.size, dtype=dtype)
+        in_base = rows < len(base)
+        if in_base.any():
+            values[in_base] = base[rows[in_base]]
+        if not in_base.all():
+            values[~in_base] = np.frombuffer(tail, dtype=dtype)[rows[~in_base] - len(base)]
+        return values
+
+    def search(self, query: str, k: int, sources: Optional[List[str]] = None,
+               deleted: Optional[Iterable[int]] = None) -> List[Tuple[int, float]]:
+        """
+        Top-k (row, BM25 score) for a query. sources restricts hits to those
+        documents; deleted rows (removed documents) are ignored, and are best
+        passed as an int64 array the caller reuses across queries. Term statistics
+        are corpus-wide, so scores are comparable across differently scoped searches.
+        """
+        terms = list(dict.fromkeys(tokenize(query)))
+        if not terms or not len(self):
+            return []
+        allowed = None
+        if sources is not None:
+            allowed = np.array([self._source_lookup[s] for s in set(sources) if s in self._source_lookup], dtype='int32')
+            if allowed.size == 0:
+                return []
+        if deleted is not None and not isinstance(deleted, np.ndarray):
+            deleted = np.fromiter(deleted, dtype='int64')
+        if deleted is not None and deleted.size == 0:
+            deleted = None
+        live = len(self) - (deleted.size if deleted is not None else 0)
+        avg_len = max(1.0, self._total_len / len(self))
+
+        hit_rows, hit_scores = [], []
+        for term in terms:
+            rows, tfs = self._postings(term)
+            if deleted is not None and rows.size:
+                keep = ~np.isin(rows, deleted)
+                rows, tfs = rows[keep], tfs[keep]
+            if rows.size == 0:
+                continue
+            idf = math.log(1 + (live - rows.size + 0.5) / (rows.size + 0.5))
+            if allowed is not None:
+                keep = np.isin(self._lookup(self._row_sources, self._tail_row_sources, 'int32', rows), allowed)
+                rows, tfs = rows[keep], tfs[keep]
+                if rows.size == 0:
+                    continue
+            doc_lens = self._lookup(self._doc_lens, self._tail_doc_lens, 'uint32', rows)
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * doc_lens / avg_len)
+            hit_rows.append(rows)
+            hit_scores.append(idf * tfs * (BM25_K1 + 1) / (tfs + norm))
+        if not hit_rows:
+            return []
+
+        rows, inverse = np.unique(np.concatenate(hit_rows), return_inverse=True)
+        totals = np.bincount(inverse, weights=np.concatenate(hit_scores))
+        if totals.size > k:
+            top = np.argpartition(-totals, k)[:k]
+        else:
+            top = np.arange(totals.size)
+        top = top[np.argsort(-totals[top], kind='stable')]
+        return [(int(rows[i]), float(totals[i])) for i in top]
+
+    def write(self, path: str, rows: Optional[np.ndarray] = None):
+        """
+        Writes base + tail as a new directory (temp name, then renamed into place).
+        If rows is given, only those rows are kept and renumbered 0..len(rows)-1,
+        matching ChunkStore.write(path, rows).
+        """
+        tmp_path = f"{path}.tmp-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        os.makedirs(tmp_path)
+        mapping = None
+        if rows is not None:
+            mapping = np.full(len(self), -1, dtype='int64')
+            mapping[rows] = np.arange(len(rows), dtype='int64')
+
+        vocab = list(self._vocab) + [token for token in self._tail if token not in self._vocab]
+        offsets = np.zeros(len(vocab) + 1, dtype='int64')
+        all_rows, all_tfs, kept_vocab = [], [], []
+        position = 0
+        for token in vocab:
+            token_rows, token_tfs = self._postings(token)
+            if mapping is not None:
+                token_rows = mapping[token_rows]
+                keep = token_rows >= 0
+                token_rows, token_tfs = token_rows[keep], token_tfs[keep]
+            if token_rows.size == 0:
+                continue
+            kept_vocab.append(token)
+            all_rows.append(token_rows.astype('uint32'))
+            all_tfs.append(token_tfs.astype('uint16'))
+            position += token_rows.size
+            offsets[len(kept_vocab)] = position
+        offsets = offsets[:len(kept_vocab) + 1]
+
+        doc_lens = self._column(self._doc_lens, self._tail_doc_lens, 'uint32')
+        row_sources = self._column(self._row_sources, self._tail_row_sources, 'int32')
+        if rows is not None:
+            doc_lens, row_sources = doc_lens[rows], row_sources[rows]
+        np.save(os.path.join(tmp_path, OFFSETS_FILE), offsets)
+        np.save(os.path.join(tmp_path, ROWS_FILE), np.concatenate(all_rows) if all_rows else np.zeros(0, dtype='uint32'))
+        np.save(os.path.join(tmp_path, TFS_FILE), np.concatenate(all_tfs) if all_tfs else np.zeros(0, dtype='uint16'))
+        np.save(os.path.join(tmp_path, DOC_LENS_FILE), doc_lens)
+        np.save(os.path.join(tmp_path, ROW_SOURCES_FILE), row_sources)
+        with open(os.path.join(tmp_path, VOCAB_FILE), 'w', encoding='utf-8') as f:
+            json.dump(kept_vocab, f)
+        with open(os.path.join(tmp_path, SOURCES_FILE), 'w', encoding='utf-8') as f:
+            json.dump(self.sources, f)
+        os.replace(tmp_path, path)
+
+
+def highlight_excerpt(content: str, query: str, context_chars: int = 40) -> str:
+    """
+    A short window of content around the query (or, if the exact phrase does
+    not occur, around its first matching term) with the matches in <mark> tags.
+    """
+    lower = content.lower()
+    terms = list(dict.fromkeys(tokenize(query)))
+    needle = query.lower()
+    position = lower.find(needle) if needle else -1
+    pattern = re.escape(query)
+    if position == -1:
+        needle, pattern = '', "|".join(re.escape(term) for term in terms) or re.escape(query)
+        for term in terms:
+            position = lower.find(term)
+            if position != -1:
+                needle = term
+                break
+    position = max(position, 0)
+    start = max(0, position - context_chars)
+    end = min(len(content), position + len(needle) + context_chars)
+    return re.sub(f"(?i)({pattern})", r"<mark>\1</mark>", content[start:end])
@@ -0,0 +1,196 @@
+"""
+Embedding model backends.
+
+    torch      SentenceTransformer on PyTorch (CUDA when available)
+    onnx       ONNX Runtime export of the same model, CPU
+    onnx-int8  ONNX export with dynamic int8 quantization, CPU (smallest, fastest)
+
+ONNX exports are written once to RAG_ONNX_DIR and reused by every process.
+A backend that cannot be loaded falls back to torch.
+
+Usage:
+    python rag_model.py export [--backend onnx-int8]
+    python rag_model.py parity [--backend onnx-int8] [--texts file.txt] [--min-cosine 0.98]
+"""
+import argparse
+import os
+import re
+import shutil
+import sys
+import time
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+# --- CONFIGURATION ---
+EMBED_BACKEND = os.getenv('RAG_EMBED_BACKEND', 'torch').lower()
+BACKENDS = ('torch', 'onnx', 'onnx-int8')
+ONNX_DIR = os.getenv('RAG_ONNX_DIR', 'synergyai_onnx')
+# Kernel set of the quantized export: 'avx2' runs on any modern x86, 'avx512_vnni' is faster where supported, 'arm64'.
+ONNX_QUANTIZATION = os.getenv('RAG_ONNX_QUANTIZATION', 'avx2')
+PARITY_SAMPLE = 500
+PARITY_TOP_K = 10
+
+
+def _onnx_file(backend: str) -> str:
+    return 'onnx/model.onnx' if backend == 'onnx' else f"onnx/model_qint8_{ONNX_QUANTIZATION}.onnx"
+
+
+def export_path(model_name: str) -> str:
+    return os.path.join(ONNX_DIR, re.sub(r"[^A-Za-z0-9_.-]+", "--", model_name))
+
+
+def export_onnx(model_name: str, backend: str) -> str:
+    """
+    Exports (and for onnx-int8 quantizes) the model unless a previous export
+    exists. The export is built in a private directory and renamed into place,
+    so concurrent workers never load a half-written model.
+    """
+    path = export_path(model_name)
+    if os.path.exists(os.path.join(path, _onnx_file(backend))):
+        return path
+    from sentence_transformers import SentenceTransformer, export_dynamic_quantized_onnx_model
+    print(f"--- Exporting {model_name} to ONNX ({backend}) in {path}... ---")
+    source = path if os.path.exists(os.path.join(path, _onnx_file('onnx'))) else model_name
+    model = SentenceTransformer(source, backend='onnx', device='cpu')
+    staging = f"{path}.tmp-{os.getpid()}"
+    shutil.rmtree(staging, ignore_errors=True)
+    if os.path.exists(path):
+        shutil.copytree(path, staging)
+    else:
+        model.save_pretrained(staging)
+    if backend == 'onnx-int8':
+        export_dynamic_quantized_onnx_model(model, ONNX_QUANTIZATION, staging)
+    os.makedirs(ONNX_DIR, exist_ok=True)
+    if os.path.exists(path):
+        shutil.rmtree(path, ignore_errors=True)
+    try:
+        os.rename(staging, path)
+    except OSError:
+        # Another process published its export first.
+        shutil.rmtree(staging, ignore_errors=True)
+    return path
+
+
+def load_embedding_model(model_name: str, backend: str = EMBED_BACKEND) -> Tuple[object, str]:
+    """Returns (SentenceTransformer, backend actually loaded)."""
+    from sentence_transformers import SentenceTransformer
+    if backend in ('onnx', 'onnx-int8'):
+        try:
+            path = export_onnx(model_name, backend)
+            print(f"--- Loading SentenceTransformer with ONNX Runtime ({backend}) on cpu... ---")
+            model = SentenceTransformer(path, backend='onnx', device='cpu',
+                                        model_kwargs={'file_name': _onnx_file(backend),
+                                                      'provider': 'CPUExecutionProvider'})
+            return model, backend
+        except Exception as e:
+            print(f"[WARN] Embedding backend '{backend}' unavailable, falling back to torch: {e}")
+    elif backend != 'torch':
+        print(f"[WARN] Unknown embedding backend '{backend}', using torch.")
+    import torch
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    print(f"--- Loading SentenceTransformer on {device}... ---")
+    return SentenceTransformer(model_name, device=device), 'torch'
+
+
+def parity_report(reference, candidate, texts: List[str], k: int = PARITY_TOP_K) -> Dict:
+    """
+    Compares a candidate backend with the reference on the same texts: cosine
+    similarity of each pair of embeddings, overlap of the top-k neighbours of
+    every text within the sample, and encode throughput of both.
+    """
+    def timed(model):
+        started = time.perf_counter()
+        vectors = np.asarray(model.encode(texts, batch_size=32, normalize_embeddings=True), dtype='float32')
+        return vectors, len(texts) / (time.perf_counter() - started)
+
+    expected, reference_rate = timed(reference)
+    actual, candidate_rate = timed(candidate)
+    cosines = np.sum(expected * actual, axis=1)
+    k = min(k, len(texts) - 1)
+    overlap = 1.0
+    if k > 0:
+        def neighbours(vectors):
+            scores = vectors @ vectors.T
+            np.fill_diagonal(scores, -np.inf)
+            return np.argsort(-scores, axis=1)[:, :k]
+        overlap = float(np.mean([len(set(a) & set(b)) / k for a, b in zip(neighbours(expected), neighbours(actual))]))
+    return {'texts': len(texts), 'cosine_min': float(cosines.min()), 'cosine_mean': float(cosines.mean()),
+            f'top{k}_overlap': overlap, 'reference_texts_per_s': reference_rate,
+            'candidate_texts_per_s': candidate_rate}
+
+
+def _sample_texts(path: str, sample: int) -> List[str]:
+    """Lines of a text file, or chunks of the current base generation."""
+    if path:
+        with open(path, 'r', encoding='utf-8', errors='ignore') as f:
+            return [line.strip() for line in f if line.strip()][:sample]
+    from rag_chunk_store import ChunkStore
+    from rag_segments import SegmentStore
+    store = SegmentStore()
+    manifest = store.read_manifest()
+    if not manifest:
+        raise SystemExit("[ERROR] No compacted base generation to sample; pass --texts.")
+    chunks = ChunkStore(store.chunks_path(manifest))
+    rows = np.random.RandomState(0).choice(len(chunks), min(sample, len(chunks)), replace=False)
+    return [chunks.content(int(row)) for row in rows]
+
+
+def _rss_mb() -> float:
+    """Peak RSS of this process in MB; NaN where it cannot be read (Windows)."""
+    try:
+        import resource
+    except ImportError:
+        return float('nan')
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in KiB on Linux.
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def main():
+    from rag_pipeline import EMBEDDING_MODEL_NAME
+
+    parser = argparse.ArgumentParser(description="Export and validate alternative embedding backends.")
+    sub = parser.add_subparsers(dest='command', required=True)
+    export = sub.add_parser('export', help="Write the ONNX export used by the onnx backends")
+    export.add_argument('--backend', default='onnx-int8', choices=BACKENDS[1:])
+    parity = sub.add_parser('parity', help="Compare a backend's embeddings and speed with torch")
+    parity.add_argument('--backend', default='onnx-int8', choices=BACKENDS[1:])
+    parity.add_argument('--texts', default='', help="File with one text per line (default: chunks of the current index)")
+    parity.add_argument('--sample', type=int, default=PARITY_SAMPLE)
+    parity.add_argument('--min-cosine', type=float, default=0.98, help="Exit non-zero if any pair falls below this")
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        print(f"[OK] Exported {EMBEDDING_MODEL_NAME} ({args.backend}) to {export_onnx(EMBEDDING_MODEL_NAME, args.backend)}.")
+        return
+
+    texts = _sample_texts(args.texts, args.sample)
+    import sentence_transformers  # noqa: F401 -- keep import cost out of the per-backend figures
+    rss = _rss_mb()
+    started = time.perf_counter()
+    candidate, loaded = load_embedding_model(EMBEDDING_MODEL_NAME, args.backend)
+    candidate_load = time.perf_counter() - started
+    candidate_rss = _rss_mb() - rss
+    if loaded != args.backend:
+        raise SystemExit(f"[ERROR] Backend '{args.backend}' could not be loaded.")
+    rss = _rss_mb()
+    started = time.perf_counter()
+    reference, _ = load_embedding_model(EMBEDDING_MODEL_NAME, 'torch')
+    reference_load = time.perf_counter() - started
+    reference_rss = _rss_mb() - rss
+
+    report = parity_report(reference, candidate, texts)
+    for key, value in report.items():
+        print(f"{key:<24}{value:>12.4f}" if isinstance(value, float) else f"{key:<24}{value:>12}")
+    print(f"{'load_s':<24}{'torch':>12}{reference_load:>10.1f}   {args.backend}{candidate_load:>10.1f}")
+    # Peak RSS only grows, so the second model's figure understates it when the first was larger.
+    print(f"{'peak_rss_growth_mb':<24}{'torch':>12}{reference_rss:>10.0f}   {args.backend}{candidate_rss:>10.0f}")
+    if report['cosine_min'] < args.min_cosine:
+        print(f"[ERROR] Parity check failed: minimum cosine {report['cosine_min']:.4f} < {args.min_cosine}.")
+        sys.exit(1)
+    print(f"[OK] {args.backend} matches torch (minimum cosine {report['cosine_min']:.4f}).")
+
+
+if __name__ == '__main__':
+    main()
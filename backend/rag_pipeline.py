@@ -22,35 +22,291 @@ except:
 # ===================================
 import faiss
 import pickle
-from sentence_transformers import SentenceTransformer
 import numpy as np
-from typing import Optional, List, Dict
+from typing import Optional, List, Dict, Set, Callable
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import heapq
 import os
 import threading
-import fitz
+import time
+from rag_segments import SegmentStore, ReadWriteLock, read_exact_index
+from rag_chunk_store import ChunkStore, chunk_hash
+from rag_embedding import EmbeddingBatcher, EmbeddingCache, percentile
+import rag_ann
+from rag_keyword import KeywordIndex
+from rag_model import load_embedding_model
+from rag_shards import ShardManager
+from rag_rerank import Reranker, RERANK_ENABLED, RERANK_CANDIDATES
+from rag_ingest import (iter_document_units, iter_word_chunks, iter_structured_chunks, unit_texts, file_sha256,
+                        CHUNKER, CHUNK_MAX_TOKENS, INGEST_EMBED_BATCH, INGEST_SEGMENT_CHUNKS)
 
 # --- CONFIGURATION ---
 FAISS_INDEX_PATH = "synergyai_index.faiss"
 TEXT_MAP_PATH = "synergyai_text_map.pkl"
 EMBEDDING_MODEL_NAME = 'BAAI/bge-small-en-v1.5'
+# Number of delta segments that triggers a background compaction into a new base.
+COMPACT_AFTER_SEGMENTS = int(os.getenv('RAG_COMPACT_AFTER_SEGMENTS', '16'))
+# Memory budget for the per-source sub-indexes used by filtered searches.
+SOURCE_INDEX_CACHE_MB = int(os.getenv('RAG_SOURCE_INDEX_CACHE_MB', '256'))
+# 'background' warms up in a thread started by the app, 'lazy' on first use, 'eager' at import.
+RAG_LOAD_MODE = os.getenv('RAG_LOAD_MODE', 'background').lower()
+# How long RAG endpoints wait for the model and index before giving up.
+RAG_READY_TIMEOUT_SECONDS = float(os.getenv('RAG_READY_TIMEOUT_SECONDS', '30'))
+# Serving processes poll the segment store this often and apply segments/generations other processes wrote (0 disables).
+RAG_WATCH_INTERVAL_SECONDS = float(os.getenv('RAG_WATCH_INTERVAL_SECONDS', '1'))
+# Async searches run on their own small pool; beyond RAG_SEARCH_MAX_PENDING they are shed.
+RAG_SEARCH_WORKERS = int(os.getenv('RAG_SEARCH_WORKERS', str(min(4, os.cpu_count() or 1))))
+RAG_SEARCH_MAX_PENDING = int(os.getenv('RAG_SEARCH_MAX_PENDING', '64'))
+# Document chunk embeddings keyed by content, so identical text is never embedded twice.
+CHUNK_VECTOR_CACHE_PATH = os.getenv('RAG_CHUNK_VECTOR_CACHE_PATH', 'synergyai_chunk_vectors.sqlite')
+CHUNK_VECTOR_CACHE_SIZE = int(os.getenv('RAG_CHUNK_VECTOR_CACHE_SIZE', '4096'))
+# Compaction also runs once this fraction of index rows belongs to deleted documents.
+COMPACT_DELETED_FRACTION = float(os.getenv('RAG_COMPACT_DELETED_FRACTION', '0.2'))
+# Searches fetch this many times k so results can be de-duplicated by chunk hash.
+DEDUP_OVERFETCH = 2
+# Hybrid search: candidates taken from each of the dense and BM25 rankings, and the RRF constant.
+HYBRID_CANDIDATES = int(os.getenv('RAG_HYBRID_CANDIDATES', '50'))
+RRF_K = int(os.getenv('RAG_RRF_K', '60'))
+
+
+def reciprocal_rank_fusion(rankings: List[List[int]], k: int = RRF_K) -> List[int]:
+    """Merges ranked lists of row ids by summing 1 / (k + rank); rows ranked well by several lists win."""
+    scores: Dict[int, float] = {}
+    for ranking in rankings:
+        for rank, row in enumerate(ranking):
+            scores[row] = scores.get(row, 0.0) + 1.0 / (k + rank + 1)
+    return sorted(scores, key=scores.get, reverse=True)
+
+
+class SourceIndexCache:
+    """
+    LRU cache of small exact FAISS indexes, one per source document, so that a
+    search scoped to a few documents only scores those documents' chunks.
+    """
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, source: str, build):
+        with self._lock:
+            entry = self._entries.get(source)
+            if entry is not None:
+                self._entries.move_to_end(source)
+                return entry
+        entry = build()
+        if entry is None:
+            return None
+        with self._lock:
+            previous = self._entries.pop(source, None)
+            if previous is not None:
+                self.current_bytes -= previous[2]
+            self._entries[source] = entry
+            self.current_bytes += entry[2]
+            # Always keep the entry we just built, even if it alone exceeds the budget.
+            while self.current_bytes > self.max_bytes and len(self._entries) > 1:
+                _, evicted = self._entries.popitem(last=False)
+                self.current_bytes -= evicted[2]
+        return entry
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def invalidate(self, source: str):
+        with self._lock:
+            entry = self._entries.pop(source, None)
+            if entry is not None:
+                self.current_bytes -= entry[2]
+
+
+class SearchExecutor:
+    """
+    Bounded thread pool for the CPU-bound part of async searches. The pool size
+    caps how many FAISS searches run at once, and admission is refused once
+    RAG_SEARCH_MAX_PENDING searches are in flight, so a burst of heavy queries
+    degrades to empty context instead of piling up behind each other.
+    """
+    def __init__(self, workers: int = RAG_SEARCH_WORKERS, max_pending: int = RAG_SEARCH_MAX_PENDING):
+        self.workers = workers
+        self.max_pending = max_pending
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='rag-search')
+        self._lock = threading.Lock()
+        self.pending = 0
+        self.running = 0
+        self.peak_pending = 0
+        self.admitted = 0
+        self.rejected = 0
+        self._wait_ms = deque(maxlen=1000)
+        self._run_ms = deque(maxlen=1000)
+
+    def try_acquire(self) -> bool:
+        with self._lock:
+            if self.pending >= self.max_pending:
+                self.rejected += 1
+                return False
+            self.pending += 1
+            self.admitted += 1
+            self.peak_pending = max(self.peak_pending, self.pending)
+            return True
+
+    def release(self):
+        with self._lock:
+            self.pending -= 1
+
+    async def run(self, fn, *args):
+        enqueued = time.perf_counter()
+
+        def task():
+            started = time.perf_counter()
+            with self._lock:
+                self.running += 1
+                self._wait_ms.append((started - enqueued) * 1000)
+            try:
+                return fn(*args)
+            finally:
+                with self._lock:
+                    self.running -= 1
+                    self._run_ms.append((time.perf_counter() - started) * 1000)
+
+        return await asyncio.get_running_loop().run_in_executor(self._pool, task)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "max_pending": self.max_pending,
+                "in_flight": self.pending,
+                "running": self.running,
+                "queued": max(0, self.pending - self.running),
+                "peak_in_flight": self.peak_pending,
+                "admitted": self.admitted,
+                "rejected": self.rejected,
+                "queue_wait_ms_p95": round(percentile(self._wait_ms, 0.95), 2),
+                "search_ms_p50": round(percentile(self._run_ms, 0.5), 2),
+                "search_ms_p95": round(percentile(self._run_ms, 0.95), 2),
+            }
+
 
 class RAGSystem:
     """
     This class encapsulates the entire RAG pipeline: loading the index,
     the embedding model, and performing semantic search. It's our "Librarian."
     """
-    def __init__(self):
+    def __init__(self, role: str = 'serve'):
+        # 'serve' holds the index and answers searches; 'ingest' (queue workers) only
+        # loads the model and writes delta segments for the serving processes to apply.
+        self.role = role
+        # self.lock serializes writers; self._rw keeps searches off a half-applied update.
         self.lock = threading.Lock()
+        self._rw = ReadWriteLock()
+        self._compacting = False
+        self.store = SegmentStore()
+        self.applied_seq = 0
+        self._source_indexes = SourceIndexCache(SOURCE_INDEX_CACHE_MB * 1024 * 1024)
+        # Searches that name their tenant (project / user library) use one shard over its documents.
+        self.shards = ShardManager()
+        self.embedding_cache = EmbeddingCache(EMBEDDING_MODEL_NAME)
+        self.embedder = EmbeddingBatcher(self._encode_queries, cache=self.embedding_cache)
+        self.chunk_vectors = EmbeddingCache(EMBEDDING_MODEL_NAME, max_entries=CHUNK_VECTOR_CACHE_SIZE, backend='disk',
+                                            path=CHUNK_VECTOR_CACHE_PATH, ttl_seconds=None)
+        self.search_executor = SearchExecutor()
+        self.reranker = Reranker()
+        self.model = None
+        self.index = None
+        # Optional HNSW / IVF-PQ accelerator for unfiltered searches; self.index stays exact.
+        self.ann_index = None
+        self.ann_trained_rows = 0
+        # The manifest's ANN file this process serves; a rebuild attached to the same generation changes it.
+        self.ann_file = None
+        self.chunk_map = ChunkStore()
+        # BM25 postings over the same rows as the FAISS index
+        self.keywords = KeywordIndex()
+        self._source_rows = {}
+        # chunk hash -> first row holding it, and source -> hashes of its chunks
+        self._chunk_rows: Dict[str, int] = {}
+        self._source_hashes: Dict[str, set] = {}
+        # Rows of removed documents; they stay in the index until the next compaction drops them.
+        self._deleted: Set[int] = set()
+        # Bumped whenever rows are renumbered (a new base is loaded), so row ids read
+        # under one read lock are not reused under another against different data.
+        self._row_epoch = 0
+        # (row epoch, deleted count, sorted int64 array) of self._deleted for keyword searches.
+        self._deleted_rows = (0, 0, np.zeros(0, dtype='int64'))
+        self._ready = threading.Event()
+        self._load_lock = threading.Lock()
+        self._load_thread = None
+        self._watcher = None
+        self.load_status = {'state': 'pending', 'stage': None, 'progress': 0.0, 'error': None,
+                            'started_at': None, 'load_seconds': None}
+        if RAG_LOAD_MODE == 'eager' and role == 'serve':
+            self.load()
+
+    @property
+    def ready(self) -> bool:
+        return self._ready.is_set() and self._usable()
+
+    def _usable(self) -> bool:
+        if self.role == 'ingest':
+            return self.model is not None
+        return self.index is not None
+
+    def _set_stage(self, stage: str, progress: float):
+        self.load_status.update({'stage': stage, 'progress': progress})
+
+    def start_background_load(self):
+        """Starts loading the model and index in a daemon thread; safe to call more than once."""
+        with self._load_lock:
+            if self._load_thread is not None or self.load_status['state'] != 'pending':
+                return
+            self._load_thread = threading.Thread(target=self.load, name='rag-loader', daemon=True)
+            self._load_thread.start()
+
+    def wait_ready(self, timeout: Optional[float] = RAG_READY_TIMEOUT_SECONDS) -> bool:
+        """Blocks until loading has finished (successfully or not). Triggers the load in lazy mode."""
+        if not self._ready.is_set():
+            self.start_background_load()
+        return self._ready.wait(timeout) and self._usable()
+
+    async def await_ready(self, timeout: Optional[float] = RAG_READY_TIMEOUT_SECONDS) -> bool:
+        """Async variant of wait_ready that does not block the event loop."""
+        if self._ready.is_set():
+            return self._usable()
+        return await asyncio.to_thread(self.wait_ready, timeout)
+
+    def load(self):
+        """Loads the embedding model, the base index and any pending segments."""
+        if self._ready.is_set():
+            return
+        started = time.time()
+        self.load_status.update({'state': 'loading', 'started_at': started})
         print("--- Initializing RAG System: Loading models and index... ---")
         try:
-            import torch
-            device = 'cuda' if torch.cuda.is_available() else 'cpu'
-            print(f"--- Loading SentenceTransformer on {device}... ---")
-            self.model = SentenceTransformer(EMBEDDING_MODEL_NAME, device=device)
-            self.index = faiss.read_index(FAISS_INDEX_PATH)
-            with open(TEXT_MAP_PATH, 'rb') as f:
-                self.chunk_map = pickle.load(f)
+            self._set_stage('model', 0.1)
+            # Heavy imports are deferred (inside rag_model) so importing this module stays cheap.
+            self.model, self.load_status['embedding_backend'] = load_embedding_model(EMBEDDING_MODEL_NAME)
+            if self.role == 'serve':
+                self._set_stage('index', 0.5)
+                (self.index, self.chunk_map, self.keywords, self.ann_index,
+                 self.ann_trained_rows, self.ann_file, self.applied_seq) = self._read_base()
+                self._source_rows, self._chunk_rows, self._source_hashes = self._build_lookups(self.chunk_map)
+                self._set_stage('segments', 0.8)
+                self._apply_pending_segments()
+                if RERANK_ENABLED:
+                    self._set_stage('reranker', 0.9)
+                    self.reranker.load()
+                if (self.chunk_map.path is None or self.keywords.path is None or self._storage_changed()) and len(self.chunk_map):
+                    # Legacy pickled chunk map, missing keyword index or a new RAG_VECTOR_STORAGE:
+                    # write the base out once in the current format.
+                    self._maybe_compact(force=True)
+            self._set_stage('ready', 1.0)
+            self.load_status['state'] = 'ready'
             print("[OK] RAG System initialized successfully.")
+            self._start_watcher()
         except Exception as e:
             try:
                 print(f"[ERROR] Could not initialize RAG System: {e}")
@@ -59,110 +315,715 @@ class RAGSystem:
             print("   Please ensure 'synergyai_index.faiss' and 'synergyai_text_map.pkl' exist.")
             self.model = None
             self.index = None
+            self.chunk_map = ChunkStore()
+            self.keywords = KeywordIndex()
+            self._source_rows, self._chunk_rows, self._source_hashes = {}, {}, {}
+            self.load_status.update({'state': 'failed', 'error': str(e)})
+        finally:
+            self.load_status['load_seconds'] = round(time.time() - started, 2)
+            self._ready.set()
+
+    def _read_base(self):
+        """Reads the current base generation: (index, chunk_map, keywords, ann_index, ann_trained_rows, ann_file, base_seq)."""
+        manifest = self.store.read_manifest()
+        if manifest:
+            index, chunk_map = self.store.load_base(manifest)
+            keywords = self.store.load_keywords(manifest, len(chunk_map))
+            ann_index, trained_rows = self.store.load_ann(manifest, index.ntotal)
+            if ann_index is not None:
+                rag_ann.configure(ann_index)
+            ann_file = (manifest.get('ann') or {}).get('file')
+            base_seq = manifest['base_seq']
+        else:
+            # No compacted generation yet: bootstrap from the legacy single-file index.
+            index = read_exact_index(FAISS_INDEX_PATH)
+            with open(TEXT_MAP_PATH, 'rb') as f:
+                chunk_map = ChunkStore.from_list(pickle.load(f))
+            keywords, ann_index, trained_rows, ann_file, base_seq = None, None, 0, None, 0
+        if keywords is None:
+            print(f"--- Building keyword index over {len(chunk_map)} chunks... ---")
+            keywords = KeywordIndex.build(chunk_map)
+        return index, chunk_map, keywords, ann_index, trained_rows, ann_file, base_seq
 
-    def search(self, query_text: str, k: int = 5, allowed_sources: Optional[List[str]] = None) -> List[Dict]:
+    def _reload_base(self):
+        """Swaps in a base generation compacted by another process. Caller holds self.lock."""
+        index, chunk_map, keywords, ann_index, trained_rows, ann_file, base_seq = self._read_base()
+        lookups = self._build_lookups(chunk_map)
+        with self._rw.write():
+            self.index, self.chunk_map, self.keywords, self.ann_index = index, chunk_map, keywords, ann_index
+            self.ann_trained_rows, self.ann_file = trained_rows, ann_file
+            self._source_rows, self._chunk_rows, self._source_hashes = lookups
+            self._deleted = set()
+            self._row_epoch += 1
+            self.applied_seq = base_seq
+        self._source_indexes.clear()
+        self.shards.clear()
+        print(f"[OK] Loaded RAG base generation covering segments up to seq {base_seq}.")
+
+    def refresh(self):
+        """Applies segments written by other processes (e.g. ingestion workers) and compacts when due."""
+        if self.role != 'serve' or not self.ready:
+            return
+        self._apply_pending_segments()
+        self._maybe_compact()
+
+    def _start_watcher(self):
+        if self.role != 'serve' or RAG_WATCH_INTERVAL_SECONDS <= 0 or self._watcher is not None:
+            return
+        self._watcher = threading.Thread(target=self._watch, name='rag-index-watcher', daemon=True)
+        self._watcher.start()
+
+    def _watch(self):
+        """
+        Hot reload: every worker serving the index stats the manifest and segment
+        log and refreshes when either changed, so documents ingested or removed
+        by any process become searchable everywhere within about one interval.
+        """
+        seen = self.store.version()
+        while True:
+            time.sleep(RAG_WATCH_INTERVAL_SECONDS)
+            try:
+                version = self.store.version()
+                if version != seen:
+                    self.refresh()
+                    seen = version
+            except Exception as e:
+                print(f"[WARN] RAG index watcher could not refresh: {e}")
+
+    def index_stats(self) -> Dict:
+        manifest = self.store.read_manifest() or {}
+        with self._rw.read():
+            return {
+                "generation": manifest.get('generation'),
+                "applied_seq": self.applied_seq,
+                "rows": self.index.ntotal if self.index is not None else 0,
+                "tail_rows": self.index.tail.ntotal if self.index is not None else 0,
+                "memory_mapped": bool(self.index is not None and self.index.mapped),
+                "deleted_rows": len(self._deleted),
+            }
+
+    @staticmethod
+    def _build_lookups(chunk_map: ChunkStore):
+        """
+        Maps every source name to the row ids of its chunks in the FAISS index, and
+        every chunk hash to its first row and the sources that contain it.
+        """
+        source_rows: Dict[str, List[int]] = chunk_map.source_rows()
+        chunk_rows: Dict[str, int] = {}
+        source_hashes: Dict[str, set] = {}
+        for source, rows in source_rows.items():
+            hashes = source_hashes[source] = set()
+            for row in rows:
+                digest = chunk_map.hash(row)
+                hashes.add(digest)
+                if digest not in chunk_rows or row < chunk_rows[digest]:
+                    chunk_rows[digest] = row
+        return source_rows, chunk_rows, source_hashes
+
+    def _build_source_index(self, source: str):
+        """Copies one source's vectors out of the global index into an exact flat index."""
+        rows = np.array(self._source_rows.get(source, []), dtype='int64')
+        if rows.size == 0:
+            return None
+        sub_index = faiss.IndexFlat(self.index.d, self.index.metric_type)
+        sub_index.add(self.index.reconstruct_batch(rows))
+        return sub_index, rows, rows.size * self.index.d * 4
+
+    def _build_shard(self, sources) -> Optional[tuple]:
+        """(index, rows) over the live chunks of a tenant's sources, in the configured vector storage."""
+        rows = np.array(sorted(row for source in sources for row in self._source_rows.get(source, [])), dtype='int64')
+        if rows.size == 0:
+            return None
+        return rag_ann.new_exact_index(self.index.reconstruct_batch(rows), self.index.metric_type), rows
+
+    def _search_sources(self, query_embedding: np.ndarray, sources: List[str], k: int) -> List[int]:
+        """
+        Exact top-k over the chunks of the given sources only. Each source is
+        searched in its own sub-index and the per-source hits are merged, so the
+        cost depends on the size of the selected documents, not the corpus.
+        """
+        higher_is_better = self.index.metric_type == faiss.METRIC_INNER_PRODUCT
+        candidates = []
+        for source in set(sources):
+            entry = self._source_indexes.get(source, lambda: self._build_source_index(source))
+            if entry is None:
+                continue
+            sub_index, rows, _ = entry
+            distances, positions = sub_index.search(query_embedding, min(k, sub_index.ntotal))
+            for distance, position in zip(distances[0], positions[0]):
+                if position != -1:
+                    score = -distance if higher_is_better else distance
+                    candidates.append((score, int(rows[position])))
+        return [row for _, row in heapq.nsmallest(k, candidates)]
+
+    def _encode_queries(self, texts: List[str]) -> np.ndarray:
+        return self.model.encode(texts, batch_size=max(1, len(texts)))
+
+    def _can_search(self) -> bool:
+        if not self._ready.is_set():
+            # Never block a request thread on warm-up; callers await readiness first.
+            self.start_background_load()
+            return False
+        return bool(self.index and self.model)
+
+    def _dense_rows(self, query_embedding: np.ndarray, n: int, allowed_sources: Optional[List[str]],
+                    tenant: Optional[str] = None) -> List[int]:
+        """Nearest rows to the query embedding, best first. Caller holds the read lock."""
+        # Scoped searches (e.g. a project's VDR) only score the allowed
+        # documents' chunks instead of post-filtering global neighbours.
+        if allowed_sources is not None:
+            if tenant is not None:
+                shard = self.shards.get(tenant, frozenset(allowed_sources), self._build_shard)
+                return shard.search(query_embedding, n) if shard is not None else []
+            return self._search_sources(query_embedding, allowed_sources, n)
+        index = self.ann_index if self.ann_index is not None else self.index
+        # Fetch enough extra candidates to make up for rows of deleted documents.
+        live_fraction = max(0.1, 1 - len(self._deleted) / max(1, index.ntotal))
+        distances, indices = index.search(query_embedding, int(n / live_fraction))
+        return [i for i in indices[0] if i != -1 and i not in self._deleted]
+
+    def _deleted_array(self) -> np.ndarray:
+        """
+        self._deleted as a sorted array, rebuilt only when it changed. Within a row
+        epoch the set only grows, so the epoch and its size identify its contents.
+        Caller holds the read lock.
+        """
+        epoch, count, rows = self._deleted_rows
+        if epoch != self._row_epoch or count != len(self._deleted):
+            rows = np.sort(np.fromiter(self._deleted, dtype='int64', count=len(self._deleted)))
+            self._deleted_rows = (self._row_epoch, len(self._deleted), rows)
+        return rows
+
+    def _lexical_rows(self, query_text: str, n: int, allowed_sources: Optional[List[str]]):
+        """(row epoch, BM25-ranked rows) for the query."""
+        with self._rw.read():
+            return self._row_epoch, [row for row, _ in self.keywords.search(query_text, n, allowed_sources, self._deleted_array())]
+
+    def _chunks_for_rows(self, rows: List[int], k: int) -> List[Dict]:
+        """Resolves ranked rows to chunks. The same text stored under several sources only fills one slot."""
+        results, seen = [], set()
+        for row in rows:
+            digest = self.chunk_map.hash(row)
+            if digest not in seen:
+                seen.add(digest)
+                results.append(self.chunk_map[row])
+                if len(results) == k:
+                    break
+        return results
+
+    def _search_embedding(self, query_embedding: np.ndarray, k: int, allowed_sources: Optional[List[str]],
+                          tenant: Optional[str] = None) -> List[Dict]:
+        with self._rw.read():
+            return self._chunks_for_rows(self._dense_rows(query_embedding, k * DEDUP_OVERFETCH, allowed_sources, tenant), k)
+
+    def _fuse_hybrid(self, query_text: str, query_embedding: Optional[np.ndarray], lexical, k: int,
+                     allowed_sources: Optional[List[str]], tenant: Optional[str] = None) -> List[Dict]:
+        depth = max(HYBRID_CANDIDATES, k * DEDUP_OVERFETCH)
+        with self._rw.read():
+            epoch, lexical_rows = lexical
+            if epoch != self._row_epoch:
+                lexical_rows = [row for row, _ in self.keywords.search(query_text, depth, allowed_sources, self._deleted_array())]
+            dense_rows = self._dense_rows(query_embedding, depth, allowed_sources, tenant) if query_embedding is not None else []
+            return self._chunks_for_rows(reciprocal_rank_fusion([dense_rows, lexical_rows]), k)
+
+    def search(self, query_text: str, k: int = 5, allowed_sources: Optional[List[str]] = None,
+               tenant: Optional[str] = None, rerank: Optional[bool] = None) -> List[Dict]:
         """
         Performs a semantic search, now with an optional filter to scope
-        the search to a specific list of source documents.
+        the search to a specific list of source documents. Passing the
+        tenant that owns those documents (e.g. 'project:<id>', 'user:<id>')
+        searches its cached shard instead of each document separately.
+        rerank works as in hybrid_search.
         """
-        if not self.index or not self.model:
+        if not self._can_search():
             return []
-            
+
+        rerank = RERANK_ENABLED if rerank is None else rerank
         try:
-            query_embedding = self.model.encode([query_text])
-            query_embedding = np.array(query_embedding).astype('float32')
-
-            # When filtering by allowed sources (e.g. per-user projects), we need to 
-            # retrieve a very large number of candidate chunks before post-filtering,
-            # otherwise the user's chunks will be crowded out by global chunks.
-            search_k = 2000 if allowed_sources else k
-            distances, indices = self.index.search(query_embedding, search_k)
-
-            filtered_results = []
-            for i in indices[0]:
-                chunk = self.chunk_map[i]
-                if allowed_sources is None or chunk['source'] in allowed_sources:
-                    filtered_results.append(chunk)
-                if len(filtered_results) >= k:
-                    break
-            
-            return filtered_results
+            query_embedding = self.embedder.encode([query_text])
+            fetch = max(k, RERANK_CANDIDATES) if rerank else k
+            chunks = self._search_embedding(query_embedding, fetch, allowed_sources, tenant)
+            return self.reranker.rerank(query_text, chunks, k) if rerank else chunks
         except Exception as e:
             print(f"Error during RAG search: {e}")
             return []
 
-    def ingest_document(self, file_path: str, source_name: str):
+    async def asearch(self, query_text: str, k: int = 5, allowed_sources: Optional[List[str]] = None,
+                      tenant: Optional[str] = None, rerank: Optional[bool] = None) -> List[Dict]:
+        """
+        Async search for route handlers: the query embedding is awaited from the
+        shared micro-batcher and the FAISS search (and optional rerank) runs on
+        the bounded search pool, so the event loop is never blocked. When the
+        pool is saturated the search is shed and returns no context, like any
+        other search failure.
+        """
+        if not self._can_search():
+            return []
+        if not self.search_executor.try_acquire():
+            print(f"[WARN] RAG search rejected: {self.search_executor.max_pending} searches already in flight.")
+            return []
+
+        rerank = RERANK_ENABLED if rerank is None else rerank
+        try:
+            query_embedding = await self.embedder.encode_async([query_text])
+            fetch = max(k, RERANK_CANDIDATES) if rerank else k
+            chunks = await self.search_executor.run(self._search_embedding, query_embedding, fetch, allowed_sources, tenant)
+            if rerank:
+                chunks = await self.search_executor.run(self.reranker.rerank, query_text, chunks, k)
+            return chunks
+        except Exception as e:
+            print(f"Error during RAG search: {e}")
+            return []
+        finally:
+            self.search_executor.release()
+
+    def keyword_search(self, query_text: str, k: int = 10, allowed_sources: Optional[List[str]] = None) -> List[Dict]:
+        """
+        BM25 search over the inverted keyword index, optionally scoped to a list
+        of source documents. Chunks are returned best first with a 'score' key.
+        """
+        if not self._can_search():
+            return []
+        try:
+            with self._rw.read():
+                hits = self.keywords.search(query_text, k, allowed_sources, self._deleted_array())
+                return [{**self.chunk_map[row], 'score': score} for row, score in hits]
+        except Exception as e:
+            print(f"Error during keyword search: {e}")
+            return []
+
+    async def akeyword_search(self, query_text: str, k: int = 10, allowed_sources: Optional[List[str]] = None) -> List[Dict]:
+        """keyword_search on the bounded search pool, shed like asearch when the pool is saturated."""
+        if not self._can_search():
+            return []
+        if not self.search_executor.try_acquire():
+            print(f"[WARN] Keyword search rejected: {self.search_executor.max_pending} searches already in flight.")
+            return []
+        try:
+            return await self.search_executor.run(self.keyword_search, query_text, k, allowed_sources)
+        finally:
+            self.search_executor.release()
+
+    def hybrid_search(self, query_text: str, k: int = 5, allowed_sources: Optional[List[str]] = None,
+                      rerank: Optional[bool] = None, tenant: Optional[str] = None) -> List[Dict]:
+        """
+        Dense + BM25 retrieval fused with reciprocal rank fusion: chunks that
+        match the query's exact terms (names, figures, clause numbers) and its
+        meaning rank first, so a smaller k carries the relevant context.
+        With rerank (default RAG_RERANK_ENABLED) more candidates are fetched and
+        a cross-encoder keeps at most k of them, fewer if the rest score as irrelevant.
+        """
+        if not self._can_search():
+            return []
+        rerank = RERANK_ENABLED if rerank is None else rerank
+        try:
+            fetch = max(k, RERANK_CANDIDATES) if rerank else k
+            depth = max(HYBRID_CANDIDATES, fetch * DEDUP_OVERFETCH)
+            lexical = self._lexical_rows(query_text, depth, allowed_sources)
+            query_embedding = self.embedder.encode([query_text])
+            chunks = self._fuse_hybrid(query_text, query_embedding, lexical, fetch, allowed_sources, tenant)
+            return self.reranker.rerank(query_text, chunks, k) if rerank else chunks
+        except Exception as e:
+            print(f"Error during hybrid RAG search: {e}")
+            return []
+
+    async def ahybrid_search(self, query_text: str, k: int = 5, allowed_sources: Optional[List[str]] = None,
+                             rerank: Optional[bool] = None, tenant: Optional[str] = None) -> List[Dict]:
+        """
+        Async hybrid search. The BM25 ranking runs on the search pool while the
+        query embedding is computed; the dense search, fusion and optional
+        rerank follow. If embedding fails, the keyword ranking alone is used.
+        """
+        if not self._can_search():
+            return []
+        if not self.search_executor.try_acquire():
+            print(f"[WARN] RAG search rejected: {self.search_executor.max_pending} searches already in flight.")
+            return []
+
+        rerank = RERANK_ENABLED if rerank is None else rerank
+        try:
+            fetch = max(k, RERANK_CANDIDATES) if rerank else k
+            depth = max(HYBRID_CANDIDATES, fetch * DEDUP_OVERFETCH)
+            lexical = asyncio.ensure_future(self.search_executor.run(self._lexical_rows, query_text, depth, allowed_sources))
+            try:
+                query_embedding = await self.embedder.encode_async([query_text])
+            except Exception as e:
+                print(f"[WARN] Query embedding failed, using keyword ranking only: {e}")
+                query_embedding = None
+            chunks = await self.search_executor.run(self._fuse_hybrid, query_text, query_embedding, await lexical,
+                                                    fetch, allowed_sources, tenant)
+            if rerank:
+                chunks = await self.search_executor.run(self.reranker.rerank, query_text, chunks, k)
+            return chunks
+        except Exception as e:
+            print(f"Error during hybrid RAG search: {e}")
+            return []
+        finally:
+            self.search_executor.release()
+
+    def iter_chunks(self, sources: List[str]):
+        """
+        Yields the chunks of the given sources only, decoding each one on demand,
+        so keyword scans never materialize the rest of the corpus.
+        """
+        with self._rw.read():
+            chunk_map = self.chunk_map
+            rows = sorted(row for source in set(sources) for row in self._source_rows.get(source, []))
+        for row in rows:
+            yield chunk_map[row]
+
+    def ingest_document(self, file_path: str, source_name: str,
+                        progress: Optional[Callable[[Dict], None]] = None, replace: bool = False) -> Optional[int]:
         """
         Extracts text from a document, chunks it, and adds it to the FAISS index and chunk map.
-        Supports .pdf and .txt files.
+        Supports .pdf, .docx and .txt files. Pages are streamed through the chunker and
+        embedded in bounded batches, so memory does not grow with the document size.
+        With replace=True the source's existing chunks are removed first (re-ingestion);
+        unchanged chunks still reuse their stored vectors.
+        Returns the number of chunks ingested, or None if ingestion failed.
         """
-        if not self.index or not self.model:
+        if not self.wait_ready(timeout=None):
             print("[ERROR] RAG System not fully initialized. Cannot ingest.")
-            return
+            return None
 
         print(f"--- Ingesting document: {source_name} ---")
         try:
-            text = ""
-            ext = os.path.splitext(file_path)[1].lower()
-            if ext == '.pdf':
-                doc = fitz.open(file_path)
-                for page in doc:
-                    text += page.get_text() + "\n"
-                doc.close()
-            elif ext == '.docx':
-                import docx
-                doc = docx.Document(file_path)
-                text = "\n".join([para.text for para in doc.paragraphs])
+            file_hash = file_sha256(file_path)
+            if not replace and file_hash in self.chunk_map.files.get(source_name, ()):
+                existing = len(self._source_rows.get(source_name, []))
+                print(f"[OK] {source_name} is unchanged since it was last ingested; skipping ({existing} chunks).")
+                return existing
+
+            units_total, units = iter_document_units(file_path)
+            state = {'units_done': 0, 'units_total': units_total, 'chunks': 0, 'embedded': 0, 'reused': 0, 'skipped': 0}
+
+            def counted(units):
+                for unit in units:
+                    yield unit
+                    state['units_done'] += 1
+
+            # The segment being built: chunk records, their vectors, and which still need encoding.
+            records, vectors, to_encode = [], [], []
+            seen = set()
+            known = set() if replace else set(self._source_hashes.get(source_name, ()))
+            # Sources whose old chunks the next written segment deletes.
+            remove = [source_name] if replace else None
+
+            def encode_pending():
+                if not to_encode:
+                    return
+                texts = [records[i]['content'] for i in to_encode]
+                encoded = self._encode_documents(texts)
+                self.chunk_vectors.put_many(texts, encoded)
+                for i, vector in zip(to_encode, encoded):
+                    vectors[i] = vector
+                state['embedded'] += len(to_encode)
+                to_encode.clear()
+                if progress:
+                    progress(dict(state))
+
+            if CHUNKER == 'words':
+                pieces = ({'content': text} for text in iter_word_chunks(unit_texts(counted(units))))
             else:
-                with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-                    text = f.read()
+                pieces = iter_structured_chunks(counted(units), self._count_tokens, self._chunk_tokens())
+            for piece in pieces:
+                chunk_text = piece['content']
+                digest = chunk_hash(chunk_text)
+                if digest in seen or digest in known:
+                    state['skipped'] += 1
+                    continue
+                seen.add(digest)
+                records.append({**piece, 'source': source_name, 'hash': digest})
+                vector = self._stored_vector(digest, chunk_text)
+                vectors.append(vector)
+                if vector is None:
+                    to_encode.append(len(records) - 1)
+                else:
+                    state['reused'] += 1
+                state['chunks'] += 1
+                if len(to_encode) >= INGEST_EMBED_BATCH:
+                    encode_pending()
+                if len(records) >= INGEST_SEGMENT_CHUNKS:
+                    encode_pending()
+                    self._append_segment(records, vectors, remove=remove)
+                    records, vectors, remove = [], [], None
 
-            if not text.strip():
+            if not state['chunks'] and not state['skipped']:
                 print(f"[WARN] No text extracted from {source_name}")
-                return
+                if remove:
+                    self._append_segment([], [], remove=remove)
+                return 0
+            encode_pending()
+            # The last segment records the file hash, marking the document as complete.
+            self._append_segment(records, vectors, file={'source': source_name, 'hash': file_hash}, remove=remove)
+            if progress:
+                progress(dict(state))
+            if self.role == 'serve':
+                self._maybe_compact()
 
-            # Simple chunking by words
-            words = text.split()
-            chunk_size = 400
-            overlap = 50
-            chunks = []
-            
-            i = 0
-            while i < len(words):
-                chunk_words = words[i:i + chunk_size]
-                chunk_text = " ".join(chunk_words)
-                if chunk_text.strip():
-                    chunks.append(chunk_text)
-                i += chunk_size - overlap
-
-            if not chunks:
-                return
+            print(f"[OK] Successfully ingested {source_name} ({state['chunks']} new chunks, "
+                  f"{state['embedded']} embedded, {state['reused']} reused, {state['skipped']} duplicates skipped)")
+            return state['chunks'] + state['skipped']
 
-            print(f"Extracted {len(chunks)} chunks from {source_name}. Generating embeddings...")
-            
-            with self.lock:
-                embeddings = self.model.encode(chunks)
-                embeddings = np.array(embeddings).astype('float32')
-                
-                # Add to index
-                self.index.add(embeddings)
-                
-                # Add to chunk map
-                for chunk_text in chunks:
-                    self.chunk_map.append({
-                        'source': source_name,
-                        'content': chunk_text
-                    })
-                
-                print("Updating FAISS index on disk...")
-                faiss.write_index(self.index, FAISS_INDEX_PATH)
-                with open(TEXT_MAP_PATH, 'wb') as f:
-                    pickle.dump(self.chunk_map, f)
-            
-            print(f"[OK] Successfully ingested {source_name}")
-            
         except Exception as e:
             print(f"[ERROR] Failed to ingest document {source_name}: {e}")
+            return None
+
+    def _count_tokens(self, texts: List[str]) -> List[int]:
+        """Model tokens per text (without special tokens); a word-based estimate if no tokenizer is available."""
+        tokenizer = getattr(self.model, 'tokenizer', None)
+        if tokenizer is None:
+            return [int(len(text.split()) * 1.3) + 1 for text in texts]
+        return [len(ids) for ids in tokenizer(texts, add_special_tokens=False, verbose=False)['input_ids']]
+
+    def _chunk_tokens(self) -> int:
+        """Chunk budget: CHUNK_MAX_TOKENS, capped so [CLS] ... [SEP] and separators fit the model's window."""
+        max_length = getattr(self.model, 'max_seq_length', None) or CHUNK_MAX_TOKENS
+        return max(32, min(CHUNK_MAX_TOKENS, max_length - 16))
+
+    def _encode_documents(self, texts: List[str]) -> np.ndarray:
+        return np.array(self.model.encode(texts, batch_size=len(texts))).astype('float32')
+
+    def _stored_vector(self, digest: str, text: str) -> Optional[np.ndarray]:
+        """An existing embedding for this chunk text: from the live index, else from the chunk vector cache."""
+        row = self._chunk_rows.get(digest)
+        if row is not None:
+            try:
+                with self._rw.read():
+                    return self.index.reconstruct(row)
+            except Exception:
+                pass
+        vector = self.chunk_vectors.get(text)
+        return vector if vector is not None else self.chunk_vectors.get_persistent(text)
+
+    def remove_source(self, source_name: str) -> bool:
+        """
+        Deletes every chunk of a source. The removal is logged like an ingest, so
+        all processes apply it; the rows are masked out of searches at once and
+        physically dropped by the next compaction.
+        """
+        if not self.wait_ready(timeout=None):
+            print("[ERROR] RAG System not fully initialized. Cannot remove documents.")
+            return False
+        try:
+            self._append_segment([], [], remove=[source_name])
+            print(f"[OK] Removed {source_name} from the RAG index.")
+            if self.role == 'serve':
+                self._maybe_compact()
+            return True
+        except Exception as e:
+            print(f"[ERROR] Failed to remove {source_name} from the RAG index: {e}")
+            return False
+
+    def _append_segment(self, records: List[Dict], vectors: List[np.ndarray], file: Optional[Dict] = None,
+                        remove: Optional[List[str]] = None):
+        """Persists chunks as a delta segment, then applies every logged segment in sequence order (including ours)."""
+        dimension = self.model.get_sentence_embedding_dimension()
+        matrix = np.vstack(vectors).astype('float32') if vectors else np.zeros((0, dimension), dtype='float32')
+        self.store.append(matrix, records, file=file, remove=remove)
+        if self.role == 'serve':
+            self._apply_pending_segments()
+
+    def _apply_pending_segments(self):
+        """Applies logged delta segments this process has not seen yet, in sequence order."""
+        with self.lock:
+            for attempt in range(2):
+                manifest = self.store.read_manifest()
+                if manifest and manifest['base_seq'] > self.applied_seq:
+                    # Another process compacted segments we have not applied into a new base.
+                    self._reload_base()
+                elif manifest and (manifest.get('ann') or {}).get('file') != self.ann_file:
+                    # `rag_ann.py rebuild` attached a new ANN index to the current generation.
+                    self._reload_ann(manifest)
+                try:
+                    self._apply_segments(self.store.pending(self.applied_seq))
+                    return
+                except FileNotFoundError:
+                    # A concurrent compaction removed a segment file between listing and reading.
+                    if attempt:
+                        raise
+
+    def _reload_ann(self, manifest: Dict):
+        """Starts serving the ANN index named by the manifest, if it matches the loaded base. Caller holds self.lock."""
+        self.ann_file = (manifest.get('ann') or {}).get('file')
+        ann_index, trained_rows = (None, 0) if self.ann_file is None else \
+            self.store.load_ann(manifest, self.index.base.ntotal)
+        if ann_index is None:
+            # The previous ANN file was dropped with the manifest entry; fall back to the exact index.
+            self._install_ann_index(None, 0)
+            print("[OK] Serving the exact index until a matching ANN index is published.")
+            return
+        rag_ann.configure(ann_index)
+        self._install_ann_index(ann_index, trained_rows)
+        print(f"[OK] Serving rebuilt '{rag_ann.tier_of(ann_index)}' ANN index {self.ann_file}.")
+
+    def _apply_segments(self, entries: List[Dict]):
+        """Adds segment vectors and chunks to the in-memory index. Caller holds self.lock."""
+        for entry in entries:
+            segment = self.store.read_segment(entry)
+            vectors, chunks, file, removed = segment['vectors'], segment['chunks'], segment['file'], segment['remove']
+            with self._rw.write():
+                for source in removed:
+                    self._deleted.update(self._source_rows.pop(source, []))
+                    self._source_hashes.pop(source, None)
+                    self.chunk_map.remove_files(source)
+            for source in removed:
+                self._source_indexes.invalidate(source)
+            self.shards.invalidate(removed)
+            # Drop chunks their source already holds (e.g. written by a worker that could not see the index).
+            keep = []
+            for position, chunk in enumerate(chunks):
+                if 'hash' not in chunk:
+                    chunk['hash'] = chunk_hash(chunk['content'])
+                hashes = self._source_hashes.setdefault(chunk['source'], set())
+                if chunk['hash'] not in hashes:
+                    hashes.add(chunk['hash'])
+                    keep.append(position)
+            chunks = [chunks[position] for position in keep]
+            vectors = np.ascontiguousarray(vectors[keep], dtype='float32') if len(keep) else None
+            term_counts = KeywordIndex.prepare(chunks)
+            with self._rw.write():
+                # Add to chunk map first so every id the index can return is resolvable
+                first_row = len(self.chunk_map)
+                self.chunk_map.extend(chunks)
+                for offset, (chunk, counts) in enumerate(zip(chunks, term_counts)):
+                    self.keywords.add(first_row + offset, chunk['source'], counts)
+                if vectors is not None:
+                    self.index.add(vectors)
+                    if self.ann_index is not None:
+                        self.ann_index.add(vectors)
+                for offset, chunk in enumerate(chunks):
+                    self._source_rows.setdefault(chunk['source'], []).append(first_row + offset)
+                    self._chunk_rows.setdefault(chunk['hash'], first_row + offset)
+                if file:
+                    self.chunk_map.add_file(file['source'], file['hash'])
+                self.applied_seq = entry['seq']
+            touched = {chunk['source'] for chunk in chunks}
+            for source in touched:
+                self._source_indexes.invalidate(source)
+            self.shards.invalidate(touched)
+
+    def _maybe_compact(self, force: bool = False):
+        """Starts a background compaction once enough delta segments have piled up."""
+        manifest = self.store.read_manifest()
+        base_seq = manifest['base_seq'] if manifest else 0
+        mostly_deleted = self.index is not None and len(self._deleted) > COMPACT_DELETED_FRACTION * self.index.ntotal
+        if self._compacting or (not force and not mostly_deleted and self.applied_seq - base_seq < COMPACT_AFTER_SEGMENTS):
+            return
+        self._compacting = True
+        threading.Thread(target=self.compact, daemon=True).start()
+
+    def _storage_changed(self) -> bool:
+        """True when the exact index is not in the configured vector storage (float32/float16/int8)."""
+        return self.index is not None and self.index.ntotal > 0 and self.index.storage != rag_ann.VECTOR_STORAGE
+
+    def _base_outdated(self) -> bool:
+        """True when the loaded base needs rewriting even without new segments."""
+        return bool(self._deleted) or self._storage_changed() or self.chunk_map.path is None or self.keywords.path is None
+
+    def compact(self):
+        """
+        Folds all applied segments into a new base generation on disk. Rows of
+        removed documents are dropped, which renumbers the index, and vectors are
+        re-encoded if the configured storage changed; in both cases the process
+        then reloads the new generation like any other reader.
+
+        Only one process compacts at a time: the others skip, and pick up the new
+        generation through refresh once it is published.
+        """
+        if not self.store.compact_lock.acquire(blocking=False):
+            self._compacting = False
+            return
+        try:
+            # Start from the latest generation, which another process may have just published.
+            self._apply_pending_segments()
+            manifest = self.store.read_manifest()
+            if manifest and manifest['base_seq'] >= self.applied_seq and not self._base_outdated():
+                return
+            ann_tier = (manifest or {}).get('ann_tier')
+            with self._rw.read():
+                chunk_map = self.chunk_map.snapshot()
+                keywords = self.keywords.snapshot()
+                base_seq = self.applied_seq
+                live_rows = None
+                if self._deleted or self._storage_changed():
+                    live_rows = np.setdiff1d(np.arange(self.index.ntotal, dtype='int64'),
+                                             np.fromiter(self._deleted, dtype='int64'))
+                    vectors = self.index.reconstruct_batch(live_rows) if live_rows.size else \
+                        np.zeros((0, self.index.d), dtype='float32')
+                    live_index = rag_ann.new_exact_index(vectors, self.index.metric_type)
+                    index_bytes = faiss.serialize_index(live_index).tobytes()
+                    rows = live_index.ntotal
+                    del live_index
+                    rebuild_ann = True
+                else:
+                    index_bytes = self.index.serialize()
+                    rows = self.index.ntotal
+                    rebuild_ann = rag_ann.needs_rebuild(self.ann_index, self.ann_trained_rows, rows,
+                                                        ann_tier or rag_ann.ANN_TIER)
+                    if rebuild_ann:
+                        vectors = rag_ann.all_vectors(self.index)
+                if not rebuild_ann and self.ann_index is not None:
+                    # The live ANN index already covers every applied row; carry it forward.
+                    ann = (rag_ann.tier_of(self.ann_index), faiss.serialize_index(self.ann_index).tobytes(), self.ann_trained_rows)
+            if rebuild_ann:
+                tier = rag_ann.choose_tier(rows, ann_tier or rag_ann.ANN_TIER)
+                print(f"--- Building '{tier}' ANN index over {rows} vectors... ---")
+                new_ann_index = rag_ann.build_index(vectors, self.index.metric_type, tier)
+                del vectors
+                ann = None if new_ann_index is None else (tier, faiss.serialize_index(new_ann_index).tobytes(), rows)
+            elif self.ann_index is None:
+                ann = None
+            manifest = self.store.write_base(index_bytes, chunk_map, base_seq, ann, rows=live_rows, keywords=keywords,
+                                             ann_tier=ann_tier)
+            if live_rows is not None:
+                with self.lock:
+                    self._reload_base()
+                    self._apply_segments(self.store.pending(self.applied_seq))
+            else:
+                self._swap_base(manifest, len(chunk_map))
+                if rebuild_ann:
+                    self._swap_ann_index(new_ann_index, rows)
+            print(f"[OK] Compacted RAG index into generation {manifest['generation']} ({rows} chunks, "
+                  f"'{rag_ann.tier_of(self.ann_index)}' search tier).")
+        except Exception as e:
+            print(f"[ERROR] RAG index compaction failed: {e}")
+        finally:
+            self.store.compact_lock.release()
+            self._compacting = False
+
+    def _swap_base(self, manifest: Dict, compacted_rows: int):
+        """Re-opens the index, chunk map and keyword index on the new mmapped generation, keeping rows applied since the snapshot."""
+        fresh_index = self.store.load_index(manifest)
+        fresh = ChunkStore(self.store.chunks_path(manifest))
+        fresh_keywords = KeywordIndex(self.store.keywords_path(manifest))
+        with self.lock:
+            with self._rw.write():
+                if self.index.ntotal > compacted_rows:
+                    fresh_index.add(self.index.reconstruct_n(compacted_rows, self.index.ntotal - compacted_rows))
+                self.index = fresh_index
+                fresh.extend(self.chunk_map[row] for row in range(compacted_rows, len(self.chunk_map)))
+                fresh_keywords.extend_from(self.keywords, compacted_rows)
+                self.keywords = fresh_keywords
+                for source, hashes in self.chunk_map.files.items():
+                    for file_hash in hashes:
+                        fresh.add_file(source, file_hash)
+                # The old store stays mapped until in-flight readers drop their reference.
+                self.chunk_map = fresh
+                self.ann_file = (manifest.get('ann') or {}).get('file')
+
+    def _swap_ann_index(self, ann_index, trained_rows: int):
+        """Starts serving a freshly built ANN index, first adding rows applied while it was built."""
+        with self.lock:
+            self._install_ann_index(ann_index, trained_rows)
+
+    def _install_ann_index(self, ann_index, trained_rows: int):
+        """Caller holds self.lock. Rows beyond those the ANN index covers are added before it serves."""
+        with self._rw.write():
+            if ann_index is not None and self.index.ntotal > ann_index.ntotal:
+                ann_index.add(self.index.reconstruct_n(ann_index.ntotal, self.index.ntotal - ann_index.ntotal))
+            self.ann_index = ann_index
+            self.ann_trained_rows = trained_rows
 
 # Create a single, global instance of our RAG system
 rag_system = RAGSystem()
@@ -0,0 +1,122 @@
+import os
+import threading
+import time
+from collections import deque
+from typing import List, Dict, Optional
+
+from rag_embedding import percentile
+
+# --- CONFIGURATION ---
+RERANK_ENABLED = os.getenv('RAG_RERANK_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+RERANK_MODEL_NAME = os.getenv('RAG_RERANK_MODEL', 'cross-encoder/ms-marco-MiniLM-L-6-v2')
+# Candidates retrieved for reranking (the final k is smaller).
+RERANK_CANDIDATES = int(os.getenv('RAG_RERANK_CANDIDATES', '20'))
+# Scoring stops once the next batch would overrun this budget; unscored candidates keep retrieval order.
+RERANK_BUDGET_MS = float(os.getenv('RAG_RERANK_BUDGET_MS', '150'))
+RERANK_BATCH = 8
+# Chunks scoring below this cross-encoder logit are dropped, but at least RERANK_MIN_KEEP are returned.
+RERANK_MIN_SCORE = float(os.getenv('RAG_RERANK_MIN_SCORE', '0'))
+RERANK_MIN_KEEP = int(os.getenv('RAG_RERANK_MIN_KEEP', '2'))
+RERANK_SAMPLES = 1000
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough prompt-token count (~4 characters per token for English text)."""
+    return max(1, len(text) // 4)
+
+
+class Reranker:
+    """
+    Second-stage ranking with a small CPU cross-encoder. Retrieval over-fetches
+    cheaply; the cross-encoder scores (query, chunk) pairs in retrieval order
+    until the latency budget is spent, and only the chunks it rates relevant
+    go into the prompt.
+    """
+    def __init__(self, model_name: str = RERANK_MODEL_NAME, budget_ms: float = RERANK_BUDGET_MS):
+        self.model_name = model_name
+        self.budget_ms = budget_ms
+        self.model = None
+        self.failed = False
+        self._load_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        # Per-pair scoring cost, smoothed, used to decide whether another batch fits in the budget.
+        self._pair_ms = None
+        self.calls = 0
+        self.budget_exhausted = 0
+        self.tokens_before = 0
+        self.tokens_after = 0
+        self._rerank_ms = deque(maxlen=RERANK_SAMPLES)
+
+    def load(self) -> bool:
+        if self.model is not None or self.failed:
+            return self.model is not None
+        with self._load_lock:
+            if self.model is None and not self.failed:
+                try:
+                    from sentence_transformers import CrossEncoder
+                    self.model = CrossEncoder(self.model_name, device='cpu')
+                    print(f"[OK] Loaded reranker {self.model_name}.")
+                except Exception as e:
+                    print(f"[WARN] Reranker {self.model_name} unavailable, returning retrieval order: {e}")
+                    self.failed = True
+        return self.model is not None
+
+    def rerank(self, query: str, chunks: List[Dict], k: int) -> List[Dict]:
+        """
+        Returns at most k of the candidate chunks, best first, each with a
+        'rerank_score' if it was scored. Logs the time spent and the prompt
+        tokens saved compared with taking the first k retrieved chunks.
+        """
+        if not chunks:
+            return []
+        if not self.load():
+            return chunks[:k]
+        started = time.perf_counter()
+        scores: List[float] = []
+        exhausted = False
+        while len(scores) < len(chunks):
+            elapsed = (time.perf_counter() - started) * 1000
+            batch = chunks[len(scores):len(scores) + RERANK_BATCH]
+            if scores and self._pair_ms is not None and elapsed + self._pair_ms * len(batch) > self.budget_ms:
+                exhausted = True
+                break
+            batch_started = time.perf_counter()
+            scores.extend(float(score) for score in self.model.predict([(query, chunk['content']) for chunk in batch]))
+            pair_ms = (time.perf_counter() - batch_started) * 1000 / len(batch)
+            self._pair_ms = pair_ms if self._pair_ms is None else 0.8 * self._pair_ms + 0.2 * pair_ms
+
+        scored = sorted(({**chunk, 'rerank_score': score} for chunk, score in zip(chunks, scores)),
+                        key=lambda chunk: chunk['rerank_score'], reverse=True)
+        relevant = [chunk for chunk in scored if chunk['rerank_score'] >= RERANK_MIN_SCORE]
+        kept = relevant if len(relevant) >= RERANK_MIN_KEEP else scored[:RERANK_MIN_KEEP]
+        # Candidates the budget did not reach are only used to fill up to the minimum.
+        results = (kept + chunks[len(scores):][:max(0, RERANK_MIN_KEEP - len(kept))])[:k]
+
+        rerank_ms = (time.perf_counter() - started) * 1000
+        tokens_before = sum(estimate_tokens(chunk['content']) for chunk in chunks[:k])
+        tokens_after = sum(estimate_tokens(chunk['content']) for chunk in results)
+        with self._stats_lock:
+            self.calls += 1
+            self.budget_exhausted += int(exhausted)
+            self.tokens_before += tokens_before
+            self.tokens_after += tokens_after
+            self._rerank_ms.append(rerank_ms)
+        print(f"[RERANK] {len(scores)}/{len(chunks)} candidates scored in {rerank_ms:.0f} ms"
+              f"{' (budget reached)' if exhausted else ''}; kept {len(results)} of k={k}, "
+              f"~{tokens_before - tokens_after} prompt tokens saved ({tokens_after}/{tokens_before}).")
+        return results
+
+    def stats(self) -> Dict:
+        with self._stats_lock:
+            return {
+                "enabled": RERANK_ENABLED,
+                "model": self.model_name if self.model is not None else None,
+                "budget_ms": self.budget_ms,
+                "calls": self.calls,
+                "budget_exhausted": self.budget_exhausted,
+                "rerank_ms_p50": round(percentile(self._rerank_ms, 0.5), 2),
+                "rerank_ms_p95": round(percentile(self._rerank_ms, 0.95), 2),
+                "prompt_tokens_before": self.tokens_before,
+                "prompt_tokens_after": self.tokens_after,
+                "prompt_tokens_saved": f"{(1 - self.tokens_after / self.tokens_before) * 100:.1f}%" if self.tokens_before else "0.0%",
+            }
@@ -0,0 +1,455 @@
+import json
+import os
+import pickle
+import threading
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Optional, List, Dict
+
+import faiss
+import numpy as np
+
+import rag_ann
+from rag_chunk_store import ChunkStore, remove_store
+from rag_keyword import KeywordIndex
+
+# --- CONFIGURATION ---
+SEGMENT_DIR = os.getenv('RAG_SEGMENT_DIR', 'synergyai_segments')
+MANIFEST_NAME = 'MANIFEST.json'
+LOG_NAME = 'segments.log'
+LOCK_NAME = 'store.lock'
+# Held by the one process compacting at a time; other processes skip compaction while it is taken.
+COMPACT_LOCK_NAME = 'compact.lock'
+# Map base generation indexes read-only so all workers share one copy through the page cache.
+INDEX_MMAP = os.getenv('RAG_INDEX_MMAP', 'true').lower() in ('1', 'true', 'yes')
+
+
+def atomic_write(path: str, data: bytes):
+    """Writes a file via a temp name + rename so readers never see a partial file."""
+    tmp_path = f"{path}.tmp-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    fsync_dir(os.path.dirname(path))
+
+
+def fsync_dir(path: str):
+    """Makes a rename durable on POSIX; a no-op on Windows."""
+    if os.name != 'posix':
+        return
+    fd = os.open(path or '.', os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class FileLock:
+    """Exclusive lock on a file, held across processes (fcntl on POSIX, msvcrt on Windows)."""
+    def __init__(self, path: str):
+        self.path = path
+        self._thread_lock = threading.Lock()
+        self._file = None
+
+    def acquire(self, blocking: bool = True) -> bool:
+        """Takes the lock; with blocking=False returns False at once if any thread or process holds it."""
+        if not self._thread_lock.acquire(blocking):
+            return False
+        self._file = open(self.path, 'a+b')
+        try:
+            if os.name == 'nt':
+                import msvcrt
+                self._file.seek(0)
+                msvcrt.locking(self._file.fileno(), msvcrt.LK_LOCK if blocking else msvcrt.LK_NBLCK, 1)
+            else:
+                import fcntl
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            self._file.close()
+            self._file = None
+            self._thread_lock.release()
+            if blocking:
+                raise
+            return False
+        return True
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
+
+    def release(self):
+        try:
+            if os.name == 'nt':
+                import msvcrt
+                self._file.seek(0)
+                msvcrt.locking(self._file.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                import fcntl
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+        finally:
+            self._file.close()
+            self._file = None
+            self._thread_lock.release()
+
+
+class ReadWriteLock:
+    """Many concurrent readers (searches) or a single writer (index mutation)."""
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._readers = 0
+        self._writer = False
+        self._waiting_writers = 0
+
+    @contextmanager
+    def read(self):
+        with self._cond:
+            while self._writer or self._waiting_writers:
+                self._cond.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if not self._readers:
+                    self._cond.notify_all()
+
+    @contextmanager
+    def write(self):
+        with self._cond:
+            self._waiting_writers += 1
+            while self._writer or self._readers:
+                self._cond.wait()
+            self._waiting_writers -= 1
+            self._writer = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writer = False
+                self._cond.notify_all()
+
+
+class MappedIndex:
+    """
+    The exact index of a base generation plus a private in-memory tail for rows
+    applied from later segments. The base is memory-mapped read-only, so every
+    worker serving the generation shares one copy through the page cache; only
+    the tail is per process. Row ids continue from the base into the tail.
+    Provides the faiss.Index methods the pipeline uses.
+    """
+    def __init__(self, base: faiss.Index, mapped: bool = False):
+        self.base = base
+        self.mapped = mapped
+        self.d = base.d
+        self.metric_type = base.metric_type
+        self.tail = rag_ann.new_exact_index(np.zeros((0, base.d), dtype='float32'), base.metric_type,
+                                            rag_ann.storage_of(base))
+
+    @property
+    def ntotal(self) -> int:
+        return self.base.ntotal + self.tail.ntotal
+
+    @property
+    def storage(self) -> str:
+        return rag_ann.storage_of(self.base)
+
+    def add(self, vectors: np.ndarray):
+        self.tail.add(vectors)
+
+    def search(self, queries: np.ndarray, k: int):
+        if not self.tail.ntotal:
+            return self.base.search(queries, k)
+        base_distances, base_ids = self.base.search(queries, k)
+        tail_distances, tail_ids = self.tail.search(queries, k)
+        distances = np.hstack([base_distances, tail_distances])
+        ids = np.hstack([base_ids, np.where(tail_ids >= 0, tail_ids + self.base.ntotal, -1)])
+        # Missing results are padded with the worst possible distance, so they sort last.
+        keys = -distances if self.metric_type == faiss.METRIC_INNER_PRODUCT else distances
+        order = np.argsort(keys, axis=1, kind='stable')[:, :k]
+        return np.take_along_axis(distances, order, 1), np.take_along_axis(ids, order, 1)
+
+    def reconstruct(self, row: int) -> np.ndarray:
+        if row < self.base.ntotal:
+            return self.base.reconstruct(int(row))
+        return self.tail.reconstruct(int(row) - self.base.ntotal)
+
+    def reconstruct_batch(self, rows) -> np.ndarray:
+        rows = np.asarray(rows, dtype='int64')
+        vectors = np.empty((len(rows), self.d), dtype='float32')
+        in_base = rows < self.base.ntotal
+        if in_base.any():
+            vectors[in_base] = self.base.reconstruct_batch(rows[in_base])
+        if not in_base.all():
+            vectors[~in_base] = self.tail.reconstruct_batch(rows[~in_base] - self.base.ntotal)
+        return vectors
+
+    def reconstruct_n(self, start: int, n: int) -> np.ndarray:
+        return self.reconstruct_batch(np.arange(start, start + n, dtype='int64'))
+
+    def serialize(self) -> bytes:
+        """Base and tail as one index in the base's storage, for writing a new generation."""
+        if not self.tail.ntotal:
+            return faiss.serialize_index(self.base).tobytes()
+        merged = rag_ann.new_exact_index(self.reconstruct_n(0, self.ntotal), self.metric_type, self.storage)
+        return faiss.serialize_index(merged).tobytes()
+
+
+def read_exact_index(path: str) -> MappedIndex:
+    if INDEX_MMAP:
+        try:
+            return MappedIndex(faiss.read_index(path, faiss.IO_FLAG_MMAP_IFC), mapped=True)
+        except Exception as e:
+            print(f"[WARN] Could not memory-map {path}, loading a private copy: {e}")
+    return MappedIndex(faiss.read_index(path))
+
+
+class SegmentStore:
+    """
+    Append-only persistence for the RAG index.
+
+    A compacted base snapshot (FAISS index + chunk map) is referenced by a small
+    MANIFEST. Every ingest writes one delta segment and appends a line to the
+    segment log, so an upload costs O(new chunks). Compaction folds the logged
+    segments into a new base generation and trims the log.
+    """
+    def __init__(self, root: str = SEGMENT_DIR):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        self.manifest_path = os.path.join(root, MANIFEST_NAME)
+        self.log_path = os.path.join(root, LOG_NAME)
+        self.lock = FileLock(os.path.join(root, LOCK_NAME))
+        self.compact_lock = FileLock(os.path.join(root, COMPACT_LOCK_NAME))
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.root, name)
+
+    # --- Base snapshot ---
+
+    def read_manifest(self) -> Optional[Dict]:
+        try:
+            with open(self.manifest_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def version(self):
+        """Changes whenever a segment is logged or a generation is published; cheap enough to poll."""
+        version = []
+        for path in (self.manifest_path, self.log_path):
+            try:
+                stat = os.stat(path)
+                version.append((stat.st_mtime_ns, stat.st_size))
+            except FileNotFoundError:
+                version.append(None)
+        return tuple(version)
+
+    def load_index(self, manifest: Dict) -> MappedIndex:
+        return read_exact_index(self._path(manifest['index']))
+
+    def load_base(self, manifest: Dict):
+        """
+        Returns the (index, chunk_map) of the base generation named by the manifest.
+        Generations written before the columnar format still carry a pickled list;
+        those are wrapped in a ChunkStore and rewritten on the next compaction.
+        """
+        index = self.load_index(manifest)
+        chunks_path = self.chunks_path(manifest)
+        if manifest['chunks'].endswith('.pkl'):
+            with open(chunks_path, 'rb') as f:
+                return index, ChunkStore.from_list(pickle.load(f))
+        return index, ChunkStore(chunks_path)
+
+    def chunks_path(self, manifest: Dict) -> str:
+        return self._path(manifest['chunks'])
+
+    def keywords_path(self, manifest: Dict) -> str:
+        return self._path(manifest['keywords'])
+
+    def load_keywords(self, manifest: Dict, rows: int) -> Optional[KeywordIndex]:
+        """The generation's BM25 index, or None if it predates keyword indexing or does not match."""
+        if not manifest.get('keywords'):
+            return None
+        try:
+            keywords = KeywordIndex(self.keywords_path(manifest))
+        except Exception as e:
+            print(f"[WARN] Could not load keyword index {manifest['keywords']}: {e}")
+            return None
+        if len(keywords) != rows:
+            print(f"[WARN] Ignoring keyword index {manifest['keywords']}: covers {len(keywords)} of {rows} base rows.")
+            return None
+        return keywords
+
+    def load_ann(self, manifest: Dict, rows: int):
+        """Returns (ann_index, trained_rows) for the generation, or (None, 0) if it has none or it is stale."""
+        ann = manifest.get('ann')
+        if not ann:
+            return None, 0
+        try:
+            index = faiss.read_index(self._path(ann['file']))
+        except Exception as e:
+            print(f"[WARN] Could not load ANN index {ann['file']}: {e}")
+            return None, 0
+        if index.ntotal != rows:
+            print(f"[WARN] Ignoring ANN index {ann['file']}: covers {index.ntotal} of {rows} base rows.")
+            return None, 0
+        return index, ann['trained_rows']
+
+    def _write_ann_file(self, generation: int, ann) -> Optional[Dict]:
+        if ann is None:
+            return None
+        tier, ann_bytes, trained_rows = ann
+        entry = {'file': f"ann-{generation:06d}-{tier}.faiss", 'tier': tier, 'trained_rows': trained_rows}
+        atomic_write(self._path(entry['file']), ann_bytes)
+        return entry
+
+    def write_ann(self, generation: int, ann, forced_tier: Optional[str] = None) -> bool:
+        """
+        Attaches an ANN index (tier, bytes, trained_rows) built offline to an
+        existing generation. forced_tier, if set, is recorded as 'ann_tier' so
+        compactions keep that tier instead of choosing one from the corpus size.
+        Returns False if that generation is no longer current.
+        """
+        entry = self._write_ann_file(generation, ann)
+        with self.lock:
+            manifest = self.read_manifest()
+            if not manifest or manifest['generation'] != generation:
+                return False
+            replaced = manifest.get('ann')
+            manifest['ann'] = entry
+            manifest['ann_tier'] = forced_tier
+            atomic_write(self.manifest_path, json.dumps(manifest).encode('utf-8'))
+        if replaced and (entry is None or replaced['file'] != entry['file']):
+            try:
+                os.remove(self._path(replaced['file']))
+            except OSError:
+                pass
+        return True
+
+    def write_base(self, index_bytes: bytes, chunk_map: ChunkStore, base_seq: int, ann=None,
+                   rows: Optional[np.ndarray] = None, keywords: Optional[KeywordIndex] = None,
+                   ann_tier: Optional[str] = None) -> Dict:
+        """
+        Publishes a new base generation covering every segment up to base_seq.
+        The data files are written first and the manifest is swapped last, so a
+        crash at any point leaves the previous generation intact. rows selects
+        the chunk map rows matching index_bytes when deleted chunks were dropped.
+        """
+        previous = self.read_manifest() or {'generation': 0}
+        generation = previous['generation'] + 1
+        manifest = {
+            'generation': generation,
+            'index': f"base-{generation:06d}.faiss",
+            'chunks': f"base-{generation:06d}.chunks",
+            'keywords': f"base-{generation:06d}.bm25" if keywords is not None else None,
+            'base_seq': base_seq,
+            # Tier forced with `rag_ann.py rebuild --tier`, carried across generations.
+            'ann_tier': ann_tier,
+            'created_at': datetime.utcnow().isoformat()
+        }
+        manifest['ann'] = self._write_ann_file(generation, ann)
+        atomic_write(self._path(manifest['index']), index_bytes)
+        chunk_map.write(self._path(manifest['chunks']), rows)
+        if keywords is not None:
+            keywords.write(self.keywords_path(manifest), rows)
+        fsync_dir(self.root)
+
+        with self.lock:
+            atomic_write(self.manifest_path, json.dumps(manifest).encode('utf-8'))
+            remaining = [entry for entry in self._read_log() if entry['seq'] > base_seq]
+            atomic_write(self.log_path, b''.join(self._encode_entry(entry) for entry in remaining))
+
+        self._remove_stale_files(manifest, remaining)
+        return manifest
+
+    def _remove_stale_files(self, manifest: Dict, live_entries: List[Dict]):
+        live = {manifest['index'], manifest['chunks'], MANIFEST_NAME, LOG_NAME, LOCK_NAME, COMPACT_LOCK_NAME}
+        if manifest.get('ann'):
+            live.add(manifest['ann']['file'])
+        if manifest.get('keywords'):
+            live.add(manifest['keywords'])
+        live.update(entry['file'] for entry in live_entries)
+        for name in os.listdir(self.root):
+            if name in live or '.tmp-' in name:
+                continue
+            if name.startswith(('base-', 'seg-', 'ann-')):
+                try:
+                    if os.path.isdir(self._path(name)):
+                        remove_store(self._path(name))
+                    else:
+                        os.remove(self._path(name))
+                except OSError as e:
+                    print(f"[WARN] Could not remove stale index file {name}: {e}")
+
+    # --- Delta segments ---
+
+    @staticmethod
+    def _encode_entry(entry: Dict) -> bytes:
+        return (json.dumps(entry) + "\n").encode('utf-8')
+
+    def _read_log(self) -> List[Dict]:
+        """Parses the segment log, ignoring a torn trailing line left by a crash."""
+        entries = []
+        try:
+            with open(self.log_path, 'rb') as f:
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        break
+                    try:
+                        entries.append(json.loads(line))
+                    except ValueError:
+                        continue
+        except FileNotFoundError:
+            pass
+        return entries
+
+    def last_seq(self) -> int:
+        manifest = self.read_manifest()
+        seq = manifest['base_seq'] if manifest else 0
+        for entry in self._read_log():
+            seq = max(seq, entry['seq'])
+        return seq
+
+    def append(self, vectors: np.ndarray, chunks: List[Dict], file: Optional[Dict] = None,
+               remove: Optional[List[str]] = None) -> int:
+        """
+        Persists one delta segment and records it in the log. Returns its sequence number.
+        file ({'source', 'hash'}) marks the segment that completes a document's ingestion;
+        remove lists sources whose previously applied chunks this segment deletes.
+        """
+        payload = pickle.dumps({'vectors': vectors, 'chunks': chunks, 'file': file, 'remove': remove or []},
+                               protocol=pickle.HIGHEST_PROTOCOL)
+        with self.lock:
+            seq = self.last_seq() + 1
+            entry = {'seq': seq, 'file': f"seg-{seq:010d}.pkl", 'count': len(chunks)}
+            atomic_write(self._path(entry['file']), payload)
+
+            with open(self.log_path, 'ab') as f:
+                # Start on a fresh line if a previous writer crashed mid-line.
+                if f.tell() > 0:
+                    with open(self.log_path, 'rb') as tail:
+                        tail.seek(-1, os.SEEK_END)
+                        if tail.read(1) != b"\n":
+                            f.write(b"\n")
+                f.write(self._encode_entry(entry))
+                f.flush()
+                os.fsync(f.fileno())
+        return seq
+
+    def pending(self, after_seq: int) -> List[Dict]:
+        """Log entries newer than after_seq, in the order they must be applied."""
+        return sorted((e for e in self._read_log() if e['seq'] > after_seq), key=lambda e: e['seq'])
+
+    def read_segment(self, entry: Dict) -> Dict:
+        """The segment payload: 'vectors', 'chunks', 'file' and 'remove' (older segments lack the last two)."""
+        with open(self._path(entry['file']), 'rb') as f:
+            payload = pickle.load(f)
+        payload.setdefault('file', None)
+        payload.setdefault('remove', [])
+        return payload
@@ -0,0 +1,137 @@
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Callable, Dict, FrozenSet, Iterable, List, Optional, Tuple
+
+import faiss
+import numpy as np
+
+from rag_embedding import percentile
+
+# --- CONFIGURATION ---
+# Memory budget for tenant shards; the least recently searched shards are evicted beyond it.
+SHARD_CACHE_MB = int(os.getenv('RAG_SHARD_CACHE_MB', '512'))
+SHARD_BUILD_SAMPLES = 1000
+
+
+class TenantShard:
+    """
+    Exact index over the live chunks of one tenant (a project's data room or a
+    user's library). Shard positions map back to global chunk-map rows, so
+    results resolve exactly like searches of the global index.
+    """
+    __slots__ = ('tenant', 'sources', 'index', 'rows', 'nbytes', 'searches')
+
+    def __init__(self, tenant: str, sources: FrozenSet[str], index: faiss.Index, rows: np.ndarray):
+        self.tenant = tenant
+        self.sources = sources
+        self.index = index
+        self.rows = rows
+        self.nbytes = rows.nbytes + index.ntotal * index.sa_code_size()
+        self.searches = 0
+
+    def search(self, query_embedding: np.ndarray, k: int) -> List[int]:
+        """Global rows of the k nearest chunks, best first."""
+        _, positions = self.index.search(query_embedding, min(k, self.index.ntotal))
+        return [int(self.rows[position]) for position in positions[0] if position != -1]
+
+
+class ShardManager:
+    """
+    Lazily built, LRU-evicted tenant shards. A tenant's shard is built from its
+    documents' rows on first search and reused until one of those documents
+    changes or the tenant's document set does, so a scoped search costs one
+    search over the tenant's chunks and memory follows the active tenants.
+    """
+    def __init__(self, max_bytes: int = SHARD_CACHE_MB * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self._shards: "OrderedDict[str, TenantShard]" = OrderedDict()
+        # Bumped whenever a source's rows change; a build that raced a change is used once but not cached.
+        self._versions: Dict[str, int] = {}
+        self._generation = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.builds = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._build_ms = deque(maxlen=SHARD_BUILD_SAMPLES)
+
+    def get(self, tenant: str, sources: FrozenSet[str],
+            build: Callable[[FrozenSet[str]], Optional[Tuple[faiss.Index, np.ndarray]]]) -> Optional[TenantShard]:
+        """The tenant's shard over exactly these sources, built with build(sources) -> (index, rows) on a miss."""
+        with self._lock:
+            shard = self._shards.get(tenant)
+            if shard is not None and shard.sources == sources:
+                self._shards.move_to_end(tenant)
+                self.hits += 1
+                shard.searches += 1
+                return shard
+            generation = self._generation
+            versions = {source: self._versions.get(source, 0) for source in sources}
+        started = time.perf_counter()
+        built = build(sources)
+        if built is None:
+            return None
+        shard = TenantShard(tenant, sources, *built)
+        shard.searches = 1
+        with self._lock:
+            self.builds += 1
+            self._build_ms.append((time.perf_counter() - started) * 1000)
+            if generation != self._generation or any(self._versions.get(source, 0) != version
+                                                     for source, version in versions.items()):
+                return shard
+            self._drop(tenant)
+            self._shards[tenant] = shard
+            self.current_bytes += shard.nbytes
+            # Always keep the shard we just built, even if it alone exceeds the budget.
+            while self.current_bytes > self.max_bytes and len(self._shards) > 1:
+                evicted_tenant = next(iter(self._shards))
+                self._drop(evicted_tenant)
+                self.evictions += 1
+        return shard
+
+    def _drop(self, tenant: str):
+        shard = self._shards.pop(tenant, None)
+        if shard is not None:
+            self.current_bytes -= shard.nbytes
+
+    def invalidate(self, sources: Iterable[str]):
+        """Drops every shard holding one of the sources, whose rows were added or removed."""
+        sources = set(sources)
+        if not sources:
+            return
+        with self._lock:
+            for source in sources:
+                self._versions[source] = self._versions.get(source, 0) + 1
+            stale = [tenant for tenant, shard in self._shards.items() if not shard.sources.isdisjoint(sources)]
+            for tenant in stale:
+                self._drop(tenant)
+            self.invalidations += len(stale)
+
+    def clear(self):
+        """Drops all shards, e.g. after rows were renumbered by a new base generation."""
+        with self._lock:
+            self._generation += 1
+            self._shards.clear()
+            self.current_bytes = 0
+
+    def stats(self) -> Dict:
+        with self._lock:
+            lookups = self.hits + self.builds
+            return {
+                "shards": len(self._shards),
+                "memory_mb": round(self.current_bytes / 2 ** 20, 1),
+                "max_memory_mb": round(self.max_bytes / 2 ** 20, 1),
+                "hits": self.hits,
+                "builds": self.builds,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "hit_rate": f"{self.hits / max(1, lookups) * 100:.1f}%",
+                "build_ms_p50": round(percentile(self._build_ms, 0.5), 2),
+                "build_ms_p95": round(percentile(self._build_ms, 0.95), 2),
+                "largest": [{"tenant": shard.tenant, "chunks": int(shard.index.ntotal), "searches": shard.searches}
+                            for shard in sorted(self._shards.values(), key=lambda shard: shard.index.ntotal,
+                                                reverse=True)[:5]],
+            }